@@ -0,0 +1,132 @@
+import pytest
+import xdg.BaseDirectory
+from werkzeug import Response
+
+from openconnect_sso import config
+from tests.conftest import Gateway
+
+LOGIN_FORM = """<!DOCTYPE html>
+<html>
+<head><title>Sign in</title></head>
+<body>
+<form method="post" action="/login">
+    <input type="email" name="login">
+    <input type="password" name="passwd">
+    <input type="submit" value="Sign in" data-report-event="Signin_Submit">
+</form>
+</body>
+</html>
+"""
+
+SAML_POST = """<!DOCTYPE html>
+<html>
+<body onload="document.forms[0].submit()">
+<form method="post" action="{acs_url}">
+    <input type="hidden" name="SAMLResponse" value="{assertion}">
+</form>
+</body>
+</html>
+"""
+
+
+class IdentityProvider:
+    """A SAML identity provider with a login form at the gateway's `login_url`
+
+    Valid credentials are answered with an assertion posted back to the
+    gateway, which sets the token cookie and redirects to `login_final_url`.
+    """
+
+    username = "user@example.com"
+    password = "secret"
+
+    def __init__(self, httpserver, gateway):
+        self.gateway = gateway
+        self.logins = 0
+        self.acs_url = httpserver.url_for("/+CSCOE+/saml/sp/acs")
+        httpserver.expect_request("/login", method="GET").respond_with_data(
+            LOGIN_FORM, content_type="text/html"
+        )
+        httpserver.expect_request("/login", method="POST").respond_with_handler(
+            self.login
+        )
+        httpserver.expect_request(
+            "/+CSCOE+/saml/sp/acs", method="POST"
+        ).respond_with_handler(self.assertion_consumer)
+        httpserver.expect_request("/+CSCOE+/saml_ac_login.html").respond_with_data(
+            "<html><body>Logged in</body></html>", content_type="text/html"
+        )
+
+    def auto_fill_rules(self):
+        rules = [
+            config.AutoFillRule(selector="input[type=email]", fill="username"),
+            config.AutoFillRule(selector="input[name=passwd]", fill="password"),
+            config.AutoFillRule(
+                selector="input[data-report-event=Signin_Submit]", action="click"
+            ),
+        ]
+        return {f"{self.gateway.login_url}*": [rule.as_dict() for rule in rules]}
+
+    def login(self, request):
+        if (
+            request.form.get("login") != self.username
+            or request.form.get("passwd") != self.password
+        ):
+            return Response(LOGIN_FORM, status=401, content_type="text/html")
+        self.logins += 1
+        return Response(
+            SAML_POST.format(
+                acs_url=self.acs_url, assertion=f"assertion-{self.logins}"
+            ),
+            content_type="text/html",
+        )
+
+    def assertion_consumer(self, request):
+        assertion = request.form["SAMLResponse"]
+        return Response(
+            status=302,
+            headers={
+                "Location": self.gateway.login_final_url,
+                "Set-Cookie": f"{self.gateway.token_cookie_name}=sso-{assertion}; Path=/",
+            },
+        )
+
+
+@pytest.fixture
+def gateway(httpserver):
+    return Gateway(httpserver)
+
+
+@pytest.fixture
+def identity_provider(httpserver, gateway):
+    return IdentityProvider(httpserver, gateway)
+
+
+@pytest.fixture
+def isolated_browser(monkeypatch, tmp_path, identity_provider):
+    """Use the fake identity provider's autofill rules and a temporary profile
+
+    The browser process is forked, so it inherits the patches made here.
+    """
+    passwords = {}
+    monkeypatch.setattr(
+        config.keyring, "get_password", lambda service, key: passwords.get(key)
+    )
+    monkeypatch.setattr(
+        config.keyring,
+        "set_password",
+        lambda service, key, value: passwords.__setitem__(key, value),
+    )
+    monkeypatch.setattr(config, "_secrets_cache", {})
+    monkeypatch.setattr(
+        config,
+        "load",
+        lambda: config.Config(auto_fill_rules=identity_provider.auto_fill_rules()),
+    )
+    for name, path in [("data", tmp_path / "data"), ("cache", tmp_path / "cache")]:
+        # pyxdg reads the environment only when imported
+        monkeypatch.setenv(f"XDG_{name.upper()}_HOME", str(path))
+        monkeypatch.setattr(xdg.BaseDirectory, f"xdg_{name}_home", str(path))
+
+    credentials = config.Credentials(identity_provider.username)
+    credentials.password = identity_provider.password
+    return credentials
@@ -0,0 +1,100 @@
+"""Measures how long it takes until a message sent by the browser process is
+handled by :class:`Browser`.
+
+Compares the current socket based channel of
+:class:`process.Process` to the previous implementation, which polled
+a :class:`multiprocessing.Queue` every 10 ms.
+
+Usage: python benchmarks/ipc_latency.py [MESSAGES]
+"""
+
+import asyncio
+import multiprocessing
+import queue
+import random
+import statistics
+import sys
+import time
+
+from openconnect_sso.browser import ipc
+from openconnect_sso.browser.process import Process
+from openconnect_sso.config import DisplayMode
+
+INTERVAL = 0.02  # seconds between messages sent by the browser process
+
+
+def send_timestamps(send, count):
+    for _ in range(count):
+        time.sleep(INTERVAL * random.random())
+        send(ipc.SetCookie("sent", time.monotonic()))
+    # The polling implementation drops messages still queued when the process
+    # has already exited
+    time.sleep(0.5)
+
+
+class SocketProcess(Process):
+    def __init__(self, count):
+        super().__init__(None, DisplayMode.HIDDEN, None)
+        self.count = count
+
+    def run(self):
+        channel = self._child_channel
+        send_timestamps(lambda msg: channel.sendall(ipc.encode(msg)), self.count)
+
+
+class PollingProcess(multiprocessing.Process):
+    """The former implementation of `Process`"""
+
+    def __init__(self, count):
+        super().__init__()
+        self._states = multiprocessing.Queue()
+        self.count = count
+
+    def run(self):
+        send_timestamps(self._states.put, self.count)
+
+    async def get_state_async(self):
+        while self.is_alive():
+            try:
+                return self._states.get_nowait()
+            except queue.Empty:
+                await asyncio.sleep(0.01)
+        if not self.is_alive():
+            raise EOFError()
+
+    async def wait(self):
+        while self.is_alive():
+            await asyncio.sleep(0.01)
+        self.join()
+
+
+async def measure(proc):
+    latencies = []
+    proc.start()
+    for _ in range(proc.count):
+        state = await proc.get_state_async()
+        latencies.append(time.monotonic() - state.value)
+    await proc.wait()
+    return latencies
+
+
+def report(name, latencies):
+    latencies = sorted(latencies)
+    p50 = statistics.median(latencies)
+    p95 = latencies[int(len(latencies) * 0.95)]
+    print(
+        f"{name:>8}: p50={p50 * 1000:7.3f} ms  p95={p95 * 1000:7.3f} ms  "
+        f"max={latencies[-1] * 1000:7.3f} ms"
+    )
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    report("polling", loop.run_until_complete(measure(PollingProcess(count))))
+    report("socket", loop.run_until_complete(measure(SocketProcess(count))))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""End-to-end latency of :meth:`Authenticator.authenticate`
+
+Logs in to a local stand-in of an AnyConnect gateway through a fake SAML
+identity provider, whose login form is filled in by `auto_fill_rules` in a
+hidden browser. Each phase of the login is timed over several runs and
+compared to the baseline of the previous runs on this machine, which is
+kept in the pytest cache (`.pytest_cache`) as it depends on the hardware.
+
+Usage: pytest -s benchmarks
+
+Environment variables:
+    BENCHMARK_RUNS              number of logins, defaults to 10
+    BENCHMARK_TOLERANCE         allowed slowdown factor, defaults to 1.5
+    BENCHMARK_UPDATE_BASELINE   set to 1 to store the results as the baseline
+"""
+
+import os
+import time
+
+import pytest
+
+from openconnect_sso import config
+from openconnect_sso.authenticator import Authenticator
+from openconnect_sso.config import DisplayMode, HostProfile
+
+BASELINE_KEY = "openconnect-sso/auth_latency_baseline"
+RUNS = int(os.environ.get("BENCHMARK_RUNS", 10))
+TOLERANCE = float(os.environ.get("BENCHMARK_TOLERANCE", 1.5))
+UPDATE_BASELINE = os.environ.get("BENCHMARK_UPDATE_BASELINE") == "1"
+# Phases taking a few milliseconds are too noisy to be compared relatively
+SLACK = 0.02  # seconds
+
+PHASES = ["detect", "init", "browser", "complete", "total"]
+
+
+class TimedAuthenticator(Authenticator):
+    """Records the duration of each phase of the login in `timings`"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.timings = {}
+
+    async def _timed(self, phase, coro):
+        start = time.perf_counter()
+        try:
+            return await coro
+        finally:
+            self.timings[phase] = time.perf_counter() - start
+
+    async def authenticate(self, *args, **kwargs):
+        return await self._timed("total", super().authenticate(*args, **kwargs))
+
+    async def _detect_authentication_target_url(self):
+        return await self._timed("detect", super()._detect_authentication_target_url())
+
+    async def _start_authentication(self):
+        return await self._timed("init", super()._start_authentication())
+
+    async def _authenticate_in_browser(self, *args, **kwargs):
+        # Includes waiting for the browser process to start up
+        return await self._timed(
+            "browser", super()._authenticate_in_browser(*args, **kwargs)
+        )
+
+    async def _complete_authentication(self, *args, **kwargs):
+        return await self._timed(
+            "complete", super()._complete_authentication(*args, **kwargs)
+        )
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+def summarize(runs):
+    return {
+        phase: {
+            "p50": percentile([timings[phase] for timings in runs], 50),
+            "p95": percentile([timings[phase] for timings in runs], 95),
+        }
+        for phase in PHASES
+    }
+
+
+def report(summary, baseline):
+    lines = [f"{'phase':<10} {'p50 ms':>10} {'p95 ms':>10} {'baseline p95':>14}"]
+    for phase, stats in summary.items():
+        reference = baseline.get(phase, {}).get("p95") if baseline else None
+        lines.append(
+            f"{phase:<10} {stats['p50'] * 1000:>10.1f} {stats['p95'] * 1000:>10.1f} "
+            + (f"{reference * 1000:>14.1f}" if reference is not None else f"{'-':>14}")
+        )
+    return "\n".join(lines)
+
+
+def regressions(summary, baseline):
+    return [
+        f"{phase} {stat}: {stats[stat] * 1000:.1f} ms "
+        f"(baseline {baseline[phase][stat] * 1000:.1f} ms)"
+        for phase, stats in summary.items()
+        if phase in baseline
+        for stat in ("p50", "p95")
+        if stats[stat] > baseline[phase][stat] * TOLERANCE + SLACK
+    ]
+
+
+@pytest.mark.asyncio
+async def test_authentication_latency(
+    gateway, identity_provider, isolated_browser, pytestconfig
+):
+    runs = []
+    for _ in range(RUNS):
+        auth = TimedAuthenticator(
+            HostProfile(gateway.url, "", "group"),
+            credentials=isolated_browser,
+            version="4.7.00136",
+            cfg=config.load(),
+        )
+        response = await auth.authenticate(DisplayMode.HIDDEN)
+        assert response.session_token == gateway.session_token
+        runs.append(auth.timings)
+
+    assert identity_provider.logins == RUNS
+    assert len(gateway.sso_tokens) == RUNS
+
+    summary = summarize(runs)
+    stored = pytestconfig.cache.get(BASELINE_KEY, None)
+    baseline = stored["phases"] if stored else None
+    print(f"\nAuthentication latency over {RUNS} runs\n{report(summary, baseline)}")
+
+    if UPDATE_BASELINE or baseline is None:
+        pytestconfig.cache.set(BASELINE_KEY, {"runs": RUNS, "phases": summary})
+        return
+
+    slower = regressions(summary, baseline)
+    assert not slower, "Authentication got slower than the baseline:\n" + "\n".join(
+        slower
+    )
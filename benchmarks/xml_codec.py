@@ -0,0 +1,168 @@
+"""Measures how long it takes to build config-auth requests and parse the
+responses of the gateway.
+
+Compares the current template and precompiled XPath based codec of
+:mod:`openconnect_sso.authenticator` to the previous implementation, which
+built requests with :class:`lxml.objectify.ElementMaker` and parsed
+responses with :func:`lxml.objectify.fromstring`.
+
+Usage: python -m benchmarks.xml_codec [ITERATIONS]
+"""
+
+import logging
+import sys
+import timeit
+
+import attr
+from lxml import etree, objectify
+
+from openconnect_sso import authenticator
+from openconnect_sso.config import HostProfile
+from tests.conftest import AUTH_COMPLETE, AUTH_REQUEST
+
+HOST = HostProfile("https://vpn.example.com", "", "group")
+VERSION = "4.7.00136"
+REQUEST = AUTH_REQUEST.format(
+    login_url="https://idp.example.com/login",
+    login_final_url="https://vpn.example.com/+CSCOE+/saml_ac_login.html",
+    token_cookie_name="acSamlv2Token",
+).encode()
+COMPLETE = AUTH_COMPLETE.format(
+    session_token="session-token", server_cert_hash="pin-sha256:hash"
+).encode()
+
+
+class Response:
+    def __init__(self, content):
+        self.content = content
+
+    def raise_for_status(self):
+        pass
+
+
+E = objectify.ElementMaker(annotate=False)
+
+
+def objectify_init_request(host, url, version):
+    root = getattr(E, "config-auth")(
+        {"client": "vpn", "type": "init", "aggregate-auth-version": "2"},
+        E.version({"who": "vpn"}, version),
+        getattr(E, "device-id")("linux-64"),
+        getattr(E, "group-select")(host.name),
+        getattr(E, "group-access")(url),
+        E.capabilities(getattr(E, "auth-method")("single-sign-on-v2")),
+    )
+    return etree.tostring(
+        root, pretty_print=True, xml_declaration=True, encoding="UTF-8"
+    )
+
+
+def objectify_finish_request(host, auth_info, sso_token, version):
+    root = getattr(E, "config-auth")(
+        {"client": "vpn", "type": "auth-reply", "aggregate-auth-version": "2"},
+        E.version({"who": "vpn"}, version),
+        getattr(E, "device-id")("linux-64"),
+        getattr(E, "session-token")(),
+        getattr(E, "session-id")(),
+        auth_info.opaque,
+        E.auth(getattr(E, "sso-token")(sso_token)),
+    )
+    return etree.tostring(
+        root, pretty_print=True, xml_declaration=True, encoding="UTF-8"
+    )
+
+
+@attr.s
+class ObjectifyRequestResponse:
+    auth_id = attr.ib(converter=str)
+    auth_title = attr.ib(converter=str)
+    auth_message = attr.ib(converter=str)
+    auth_error = attr.ib(converter=str)
+    login_url = attr.ib(converter=str)
+    login_final_url = attr.ib(converter=str)
+    token_cookie_name = attr.ib(converter=str)
+    opaque = attr.ib()
+
+
+@attr.s
+class ObjectifyCompleteResponse:
+    auth_id = attr.ib(converter=str)
+    auth_message = attr.ib(converter=str)
+    session_token = attr.ib(converter=str)
+    server_cert_hash = attr.ib(converter=str)
+
+
+def objectify_parse_response(resp):
+    xml = objectify.fromstring(resp.content)
+    t = xml.get("type")
+    if t == "auth-request":
+        return ObjectifyRequestResponse(
+            auth_id=xml.auth.get("id"),
+            auth_title=getattr(xml.auth, "title", ""),
+            auth_message=xml.auth.message,
+            auth_error=getattr(xml.auth, "error", ""),
+            opaque=xml.opaque,
+            login_url=xml.auth["sso-v2-login"],
+            login_final_url=xml.auth["sso-v2-login-final"],
+            token_cookie_name=xml.auth["sso-v2-token-cookie-name"],
+        )
+    elif t == "complete":
+        return ObjectifyCompleteResponse(
+            auth_id=xml.auth.get("id"),
+            auth_message=xml.auth.message,
+            session_token=xml["session-token"],
+            server_cert_hash=xml.config["vpn-base-config"]["server-cert-hash"],
+        )
+
+
+def login(init_request, parse, finish_request):
+    """The XML handled by one login"""
+    init_request(HOST, HOST.vpn_url, VERSION)
+    auth_info = parse(Response(REQUEST))
+    finish_request(HOST, auth_info, "sso-token", VERSION)
+    parse(Response(COMPLETE))
+
+
+def report(name, iterations, seconds, baseline=None):
+    per_login = seconds / iterations * 1e6
+    speedup = f"  ({baseline / seconds:.1f}x)" if baseline else ""
+    print(f"{name:>10}: {per_login:7.1f} us per login{speedup}")
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    # Log messages of the parser would dominate the measurement
+    authenticator.logger = authenticator.structlog.get_logger(
+        wrapper_class=authenticator.structlog.make_filtering_bound_logger(
+            logging.CRITICAL
+        )
+    )
+
+    previous = min(
+        timeit.repeat(
+            lambda: login(
+                objectify_init_request,
+                objectify_parse_response,
+                objectify_finish_request,
+            ),
+            number=iterations,
+            repeat=3,
+        )
+    )
+    current = min(
+        timeit.repeat(
+            lambda: login(
+                authenticator.create_auth_init_request,
+                authenticator.parse_response,
+                authenticator._create_auth_finish_request,
+            ),
+            number=iterations,
+            repeat=3,
+        )
+    )
+    report("objectify", iterations, previous)
+    report("codec", iterations, current, previous)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 import asyncio
+import contextlib
 import getpass
 import json
 import logging
@@ -10,13 +11,18 @@ from pathlib import Path
 import shlex
 import shutil
 import structlog
-from prompt_toolkit import HTML
-from prompt_toolkit.shortcuts import radiolist_dialog
-
-from openconnect_sso import config
-from openconnect_sso.authenticator import Authenticator, AuthResponseError
-from openconnect_sso.browser import Terminated
+import xdg.BaseDirectory
+
+from openconnect_sso import config, metrics, supervisor, token_cache, tunnel
+from openconnect_sso.authenticator import (
+    Authenticator,
+    AuthCompleteResponse,
+    AuthResponseError,
+    authenticate_batch,
+)
+from openconnect_sso.browser import Browser, Terminated
 from openconnect_sso.config import Credentials
+from openconnect_sso.probe import probe_gateways
 from openconnect_sso.profile import get_profiles
 
 from requests.exceptions import HTTPError
@@ -24,17 +30,33 @@ from requests.exceptions import HTTPError
 logger = structlog.get_logger()
 
 
-def run(args):
+def run(args, cfg=None):
     configure_logger(logging.getLogger(), args.log_level)
 
-    cfg = config.load()
+    try:
+        return _main(args, config.load() if cfg is None else cfg)
+    finally:
+        export_metrics(args)
+
+
+def export_metrics(args):
+    metrics.export(args.metrics_json, args.metrics_prometheus)
+
+
+def _main(args, cfg):
+    batch = args.server is not None and len(args.server) > 1
 
     try:
         if os.name == "nt":
             asyncio.set_event_loop(asyncio.ProactorEventLoop())
-        auth_response, selected_profile = asyncio.get_event_loop().run_until_complete(
-            _run(args, cfg)
-        )
+        if batch:
+            results = asyncio.get_event_loop().run_until_complete(_run_batch(args, cfg))
+        else:
+            (
+                auth_response,
+                selected_profile,
+                session_key,
+            ) = asyncio.get_event_loop().run_until_complete(_run(args, cfg))
     except KeyboardInterrupt:
         logger.warn("CTRL-C pressed, exiting")
         return 130
@@ -54,15 +76,23 @@ def run(args):
         logger.error(f"Request error: {exc}")
         return 4
 
+    # The tunnel may run for hours, the login is not reported only then
+    export_metrics(args)
     config.save(cfg)
 
+    if batch:
+        logger.warn("Exiting after login, as requested")
+        print(
+            json.dumps(
+                [_auth_details(host, response) for host, response in results],
+                indent=4,
+            )
+        )
+        return 0
+
     if args.authenticate:
         logger.warn("Exiting after login, as requested")
-        details = {
-            "host": selected_profile.vpn_url,
-            "cookie": auth_response.session_token,
-            "fingerprint": auth_response.server_cert_hash,
-        }
+        details = _auth_details(selected_profile, auth_response)
         if args.authenticate == "json":
             print(json.dumps(details, indent=4))
         elif args.authenticate == "shell":
@@ -72,20 +102,75 @@ def run(args):
         return 0
 
     try:
-        return run_openconnect(
-            auth_response,
-            selected_profile,
-            args.proxy,
-            args.ac_version,
-            args.openconnect_args,
-        )
+        if args.reconnect:
+            retval = _supervise(args, cfg, auth_response, selected_profile, session_key)
+        else:
+            retval = run_openconnect(
+                auth_response,
+                selected_profile,
+                args.proxy,
+                args.ac_version,
+                args.openconnect_args,
+            )
+        if retval in (0, 2):
+            # Either the session is logged out or the server rejected it
+            token_cache.invalidate(*session_key)
+        return retval
     except KeyboardInterrupt:
         logger.warn("CTRL-C pressed, exiting")
+        token_cache.invalidate(*session_key)
         return 0
+    except Terminated:
+        # The browser window was closed while logging in again
+        logger.warn("Browser window terminated, exiting")
+        return 2
     finally:
         handle_disconnect(cfg.on_disconnect)
 
 
+def _supervise(args, cfg, auth_response, host, session_key):
+    """Run openconnect and restart it until the user disconnects
+
+    A rejected session token is replaced by logging in again, first by
+    replaying the identity provider session, then with the browser.
+    """
+
+    def connect(auth_response):
+        return run_openconnect(
+            auth_response, host, args.proxy, args.ac_version, args.openconnect_args
+        )
+
+    def authenticate():
+        token_cache.invalidate(*session_key)
+        display_mode = config.DisplayMode[args.browser_display_mode.upper()]
+        auth_response = asyncio.get_event_loop().run_until_complete(
+            authenticate_to(
+                host,
+                args.proxy,
+                _load_credentials(args, cfg),
+                display_mode,
+                args.ac_version,
+                args.browser_daemon,
+                sso_replay=True,
+                identity=args.identity,
+                cfg=cfg,
+            )
+        )
+        _store_session(args, session_key, host, auth_response)
+        return auth_response
+
+    retval, _ = supervisor.supervise(auth_response, connect, authenticate)
+    return retval
+
+
+def _auth_details(host, auth_response):
+    return {
+        "host": host.vpn_url,
+        "cookie": auth_response.session_token,
+        "fingerprint": auth_response.server_cert_hash,
+    }
+
+
 def configure_logger(logger, level):
     structlog.configure(
         processors=[
@@ -108,35 +193,37 @@ def configure_logger(logger, level):
 
 
 async def _run(args, cfg):
-    credentials = None
-    if cfg.credentials:
-        credentials = cfg.credentials
-    elif args.user:
-        credentials = Credentials(args.user)
+    async with contextlib.AsyncExitStack() as stack:
+        return await _login(args, cfg, stack)
 
-    if credentials and not credentials.password:
-        credentials.password = getpass.getpass(prompt=f"Password ({args.user}): ")
-        cfg.credentials = credentials
 
-    if credentials and not credentials.totp:
-        credentials.totp = getpass.getpass(
-            prompt=f"TOTP secret (leave blank if not required) ({args.user}): "
-        )
-        cfg.credentials = credentials
+async def _login(args, cfg, stack):
+    display_mode = config.DisplayMode[args.browser_display_mode.upper()]
+    browser = None
+    credentials = _load_credentials(args, cfg)
 
-    if cfg.default_profile and not (args.use_profile_selector or args.server):
+    if cfg.default_profile and not (
+        args.use_profile_selector or args.fastest or args.server
+    ):
         selected_profile = cfg.default_profile
-    elif args.use_profile_selector or args.profile_path:
+    elif args.use_profile_selector or args.fastest or args.profile_path:
         profiles = get_profiles(Path(args.profile_path))
         if not profiles:
             raise ValueError("No profile found", 17)
 
-        selected_profile = await select_profile(profiles)
+        # Let the browser start up while the user is choosing
+        browser = await stack.enter_async_context(
+            Browser(args.proxy, display_mode, args.browser_daemon, cfg)
+        )
+        if args.fastest:
+            selected_profile = await select_fastest_profile(profiles, args.ac_version)
+        else:
+            selected_profile = await select_profile(profiles)
         if not selected_profile:
             raise ValueError("No profile selected", 18)
     elif args.server:
         selected_profile = config.HostProfile(
-            args.server, args.usergroup, args.authgroup
+            args.server[0], args.usergroup, args.authgroup
         )
     else:
         raise ValueError(
@@ -147,19 +234,156 @@ async def _run(args, cfg):
         selected_profile.address, selected_profile.user_group, selected_profile.name
     )
 
-    display_mode = config.DisplayMode[args.browser_display_mode.upper()]
+    if args.on_disconnect and not cfg.on_disconnect:
+        cfg.on_disconnect = args.on_disconnect
+
+    session_key = (
+        selected_profile.vpn_url,
+        credentials and credentials.username,
+        args.identity,
+    )
+    auth_response = _load_cached_session(args, selected_profile, session_key)
+    if auth_response:
+        return auth_response, selected_profile, session_key
+
+    _ask_password(args, cfg, credentials)
 
     auth_response = await authenticate_to(
-        selected_profile, args.proxy, credentials, display_mode, args.ac_version
+        selected_profile,
+        args.proxy,
+        credentials,
+        display_mode,
+        args.ac_version,
+        args.browser_daemon,
+        browser,
+        args.sso_replay,
+        args.identity,
+        cfg=cfg,
     )
 
-    if args.on_disconnect and not cfg.on_disconnect:
-        cfg.on_disconnect = args.on_disconnect
+    _store_session(args, session_key, selected_profile, auth_response)
+
+    return auth_response, selected_profile, session_key
+
+
+async def _run_batch(args, cfg):
+    """Log in to every gateway given by `--server` sharing one SSO session"""
+    display_mode = config.DisplayMode[args.browser_display_mode.upper()]
+    credentials = _load_credentials(args, cfg)
+    username = credentials and credentials.username
+
+    hosts = [
+        config.HostProfile(server, args.usergroup, args.authgroup)
+        for server in args.server
+    ]
+    session_keys = [(host.vpn_url, username, args.identity) for host in hosts]
+    responses = [
+        _load_cached_session(args, host, session_key)
+        for host, session_key in zip(hosts, session_keys)
+    ]
 
-    return auth_response, selected_profile
+    pending = [i for i, auth_response in enumerate(responses) if auth_response is None]
+    if pending:
+        _ask_password(args, cfg, credentials)
+        logger.info(
+            "Authenticating to VPN endpoints",
+            addresses=[hosts[i].address for i in pending],
+        )
+        authenticated = await authenticate_batch(
+            [
+                Authenticator(
+                    hosts[i],
+                    args.proxy,
+                    credentials,
+                    args.ac_version,
+                    args.identity,
+                    cfg=cfg,
+                )
+                for i in pending
+            ],
+            display_mode,
+            args.browser_daemon,
+        )
+        for i, auth_response in zip(pending, authenticated):
+            responses[i] = auth_response
+            _store_session(args, session_keys[i], hosts[i], auth_response)
+
+    return list(zip(hosts, responses))
+
+
+def _load_credentials(args, cfg):
+    if args.identity:
+        credentials = _identity(args, cfg).credentials
+        if credentials:
+            return credentials
+    elif cfg.credentials:
+        return cfg.credentials
+    if args.user:
+        return Credentials(args.user)
+    return None
+
+
+def _identity(args, cfg):
+    try:
+        return cfg.identities[args.identity]
+    except KeyError:
+        raise ValueError(f"Unknown identity: {args.identity}", 21) from None
+
+
+def _ask_password(args, cfg, credentials):
+    if credentials and not credentials.password:
+        credentials.password = getpass.getpass(
+            prompt=f"Password ({credentials.username}): "
+        )
+        _save_credentials(args, cfg, credentials)
+
+    if credentials and not credentials.totp:
+        credentials.totp = getpass.getpass(
+            prompt=f"TOTP secret (leave blank if not required) ({credentials.username}): "
+        )
+        _save_credentials(args, cfg, credentials)
+
+
+def _save_credentials(args, cfg, credentials):
+    if args.identity:
+        _identity(args, cfg).username = credentials.username
+    else:
+        cfg.credentials = credentials
+
+
+def _load_cached_session(args, host, session_key):
+    if args.session_cache_lifetime <= 0:
+        return None
+    cached = token_cache.load(*session_key)
+    if not cached:
+        return None
+    logger.info("Reusing cached session", address=cached.host)
+    host.address = cached.host
+    return AuthCompleteResponse(
+        auth_id="success",
+        auth_message="",
+        session_token=cached.session_token,
+        server_cert_hash=cached.server_cert_hash,
+    )
+
+
+def _store_session(args, session_key, host, auth_response):
+    if args.session_cache_lifetime > 0:
+        vpn_url, username, identity = session_key
+        token_cache.store(
+            vpn_url,
+            username,
+            host.vpn_url,
+            auth_response,
+            args.session_cache_lifetime,
+            identity,
+        )
 
 
 async def select_profile(profile_list):
+    from prompt_toolkit import HTML
+    from prompt_toolkit.shortcuts import radiolist_dialog
+
     selection = await radiolist_dialog(
         title="Select AnyConnect profile",
         text=HTML(
@@ -178,9 +402,42 @@ async def select_profile(profile_list):
     return selection
 
 
-def authenticate_to(host, proxy, credentials, display_mode, version):
-    logger.info("Authenticating to VPN endpoint", name=host.name, address=host.address)
-    return Authenticator(host, proxy, credentials, version).authenticate(display_mode)
+async def select_fastest_profile(profile_list, version):
+    ranked = await probe_gateways(profile_list, version)
+    selection, result = ranked[0]
+    if not result.ok:
+        logger.error("None of the gateways responded")
+        return None
+    logger.info(
+        "Selected fastest profile",
+        profile=selection.name,
+        total_ms=round(result.total * 1000, 1),
+    )
+    return selection
+
+
+def authenticate_to(
+    host,
+    proxy,
+    credentials,
+    display_mode,
+    version,
+    use_browser_daemon=False,
+    browser=None,
+    sso_replay=False,
+    identity=None,
+    *,
+    cfg,
+):
+    logger.info(
+        "Authenticating to VPN endpoint",
+        name=host.name,
+        address=host.address,
+        identity=identity,
+    )
+    return Authenticator(
+        host, proxy, credentials, version, identity, cfg=cfg
+    ).authenticate(display_mode, use_browser_daemon, browser, sso_replay)
 
 
 def run_openconnect(auth_info, host, proxy, version, args):
@@ -217,7 +474,28 @@ def run_openconnect(auth_info, host, proxy, version, args):
 
     session_token = auth_info.session_token.encode("utf-8")
     logger.debug("Starting OpenConnect", command_line=command_line)
-    return subprocess.run(command_line, input=session_token).returncode
+    log_path = Path(xdg.BaseDirectory.save_cache_path(config.APP_NAME)) / (
+        "openconnect.log"
+    )
+    loop = asyncio.get_event_loop()
+    with metrics.span("openconnect", gateway=host.vpn_url) as span, tunnel.OutputLog(
+        log_path
+    ) as output_log:
+        state = tunnel.TunnelState(host.vpn_url)
+        task = asyncio.ensure_future(
+            tunnel.run(command_line, session_token, state, output_log)
+        )
+        try:
+            returncode = loop.run_until_complete(task)
+        except KeyboardInterrupt:
+            # Let openconnect log out, it has been interrupted as well
+            task.cancel()
+            loop.run_until_complete(asyncio.gather(task, return_exceptions=True))
+            raise
+        if returncode:
+            span.error = f"exit code {returncode}"
+        span.labels["dtls"] = state.dtls_up
+    return returncode
 
 
 def handle_disconnect(command):
@@ -1,26 +1,102 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import functools
+from urllib.parse import urlparse
+from xml.sax.saxutils import escape
+
 import attr
 import requests
 import structlog
-from lxml import etree, objectify
+from lxml import etree
 
-from openconnect_sso.saml_authenticator import authenticate_in_browser
+from openconnect_sso import metrics
+from openconnect_sso.browser import Browser
+from openconnect_sso.saml_authenticator import (
+    authenticate_in_browser,
+    authenticate_with_form,
+    authenticate_with_http,
+    login_backend,
+)
 
 
 logger = structlog.get_logger()
 
 
 class Authenticator:
-    def __init__(self, host, proxy=None, credentials=None, version=None):
+    def __init__(
+        self, host, proxy=None, credentials=None, version=None, identity=None, *, cfg
+    ):
         self.host = host
         self.proxy = proxy
         self.credentials = credentials
         self.version = version
+        # Name of the identity whose browser profile is used
+        self.identity = identity
+        # Configuration snapshot of the run, the file is not read again
+        self.cfg = cfg
         self.session = create_http_session(proxy, version)
-
-    async def authenticate(self, display_mode):
-        self._detect_authentication_target_url()
-
-        response = self._start_authentication()
+        self._executor = None
+
+    async def authenticate(
+        self, display_mode, use_browser_daemon=False, browser=None, sso_replay=False
+    ):
+        """Log in to the gateway
+
+        Unless an already running `browser` is given, one is started here, so
+        that it boots while the gateway is being contacted. With `sso_replay`,
+        the login is first attempted without a browser, which is only started
+        if that fails. Identity providers configured to be logged in to with
+        the "form" backend, see `Config.login_backends`, are tried without the
+        browser as well, which is then only used if that fails.
+        """
+        try:
+            return await self._authenticate(
+                display_mode, use_browser_daemon, browser, sso_replay
+            )
+        finally:
+            self.close()
+
+    def close(self):
+        if self._executor:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    async def _authenticate(
+        self, display_mode, use_browser_daemon, browser, sso_replay
+    ):
+        async with contextlib.AsyncExitStack() as stack:
+            if browser is None and not sso_replay:
+                # Started speculatively, it is closed unused if the identity
+                # provider is logged in to with the form backend
+                browser = await stack.enter_async_context(
+                    Browser(self.proxy, display_mode, use_browser_daemon, self.cfg)
+                )
+
+            auth_request_response = await self._initiate()
+
+            sso_token = None
+            if sso_replay:
+                sso_token = await self._authenticate_with_http(auth_request_response)
+
+            if sso_token is None:
+                sso_token = await self._authenticate_with_form(auth_request_response)
+
+            if sso_token is None:
+                if browser is None:
+                    browser = await stack.enter_async_context(
+                        Browser(self.proxy, display_mode, use_browser_daemon, self.cfg)
+                    )
+                sso_token = await self._authenticate_in_browser(
+                    browser, auth_request_response
+                )
+
+        return await self._finish(auth_request_response, sso_token)
+
+    async def _initiate(self):
+        await self._detect_authentication_target_url()
+
+        response = await self._start_authentication()
         if not isinstance(response, AuthRequestResponse):
             logger.error(
                 "Could not start authentication. Invalid response type in current state",
@@ -36,13 +112,10 @@ class Authenticator:
             )
             raise AuthenticationError(response)
 
-        auth_request_response = response
-
-        sso_token = await self._authenticate_in_browser(
-            auth_request_response, display_mode
-        )
+        return response
 
-        response = self._complete_authentication(auth_request_response, sso_token)
+    async def _finish(self, auth_request_response, sso_token):
+        response = await self._complete_authentication(auth_request_response, sso_token)
         if not isinstance(response, AuthCompleteResponse):
             logger.error(
                 "Could not finish authentication. Invalid response type in current state",
@@ -52,36 +125,139 @@ class Authenticator:
 
         return response
 
-    def _detect_authentication_target_url(self):
+    async def _request(self, method, url, **kwargs):
+        # Requests are made from a single worker thread, as `requests.Session`
+        # is not thread-safe. This way all requests of a login share the same
+        # keep-alive connection while the event loop is free to run the browser.
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="openconnect-sso-http"
+            )
+        return await asyncio.get_event_loop().run_in_executor(
+            self._executor,
+            functools.partial(self.session.request, method, url, **kwargs),
+        )
+
+    async def _detect_authentication_target_url(self):
         # Follow possible redirects in a GET request
         # Authentication will occur using a POST request on the final URL
-        response = requests.get(self.host.vpn_url)
-        response.raise_for_status()
+        with metrics.span("detect", gateway=self.host.vpn_url):
+            response = await self._request("GET", self.host.vpn_url)
+            response.raise_for_status()
         self.host.address = response.url
         logger.debug("Auth target url", url=self.host.vpn_url)
 
-    def _start_authentication(self):
-        request = _create_auth_init_request(self.host, self.host.vpn_url, self.version)
+    async def _start_authentication(self):
+        request = create_auth_init_request(self.host, self.host.vpn_url, self.version)
         logger.debug("Sending auth init request", content=request)
-        response = self.session.post(self.host.vpn_url, request)
+        with metrics.span("init", gateway=self.host.vpn_url):
+            response = await self._request("POST", self.host.vpn_url, data=request)
         logger.debug("Auth init response received", content=response.content)
         return parse_response(response)
 
-    async def _authenticate_in_browser(self, auth_request_response, display_mode):
+    async def _authenticate_in_browser(self, browser, auth_request_response, page=0):
         return await authenticate_in_browser(
-            self.proxy, auth_request_response, self.credentials, display_mode
+            browser, auth_request_response, self.credentials, page, self.identity
         )
 
-    def _complete_authentication(self, auth_request_response, sso_token):
+    async def _authenticate_with_http(self, auth_request_response):
+        return await authenticate_with_http(
+            auth_request_response, self.proxy, identity=self.identity
+        )
+
+    async def _authenticate_with_form(self, auth_request_response):
+        """Return the token of a login without a browser, if configured so"""
+        cfg = self.cfg
+        if login_backend(cfg.login_backends, auth_request_response.login_url) != "form":
+            return None
+        return await authenticate_with_form(
+            auth_request_response, self.credentials, cfg.auto_fill_rules, self.proxy
+        )
+
+    async def _complete_authentication(self, auth_request_response, sso_token):
         request = _create_auth_finish_request(
             self.host, auth_request_response, sso_token, self.version
         )
         logger.debug("Sending auth finish request", content=request)
-        response = self.session.post(self.host.vpn_url, request)
+        with metrics.span("complete", gateway=self.host.vpn_url):
+            response = await self._request("POST", self.host.vpn_url, data=request)
         logger.debug("Auth finish response received", content=response.content)
         return parse_response(response)
 
 
+async def authenticate_batch(authenticators, display_mode, use_browser_daemon=False):
+    """Log in to several gateways using one browser
+
+    Gateways are contacted concurrently and each of them gets its own page in
+    the browser. The identity provider login is done on the first gateway of
+    every identity, the other gateways of the same identity are logged in to
+    with the SSO session it leaves behind. Identities have separate browser
+    profiles, so they log in at the same time.
+
+    Gateways whose token cookie is set on the same host, e.g. several groups
+    of one server, are logged in to one after another, as the cookie could not
+    be told apart otherwise.
+    """
+    try:
+        async with contextlib.AsyncExitStack() as stack:
+            browser = await stack.enter_async_context(
+                Browser(
+                    authenticators[0].proxy,
+                    display_mode,
+                    use_browser_daemon,
+                    authenticators[0].cfg,
+                )
+            )
+
+            auth_requests = await asyncio.gather(
+                *(auth._initiate() for auth in authenticators)
+            )
+
+            sso_tokens = [None] * len(authenticators)
+
+            async def login(page):
+                auth = authenticators[page]
+                sso_tokens[page] = await auth._authenticate_with_form(
+                    auth_requests[page]
+                ) or await auth._authenticate_in_browser(
+                    browser, auth_requests[page], page=page
+                )
+
+            async def login_in_turn(pages):
+                for page in pages:
+                    await login(page)
+
+            first_pages = {}
+            for page, auth in enumerate(authenticators):
+                first_pages.setdefault(auth.identity, page)
+            await asyncio.gather(*(login(page) for page in first_pages.values()))
+
+            same_cookie = {}
+            for page, (auth, auth_request) in enumerate(
+                zip(authenticators, auth_requests)
+            ):
+                if page not in first_pages.values():
+                    key = (
+                        auth.identity,
+                        auth_request.token_cookie_name,
+                        urlparse(auth_request.login_final_url).hostname,
+                    )
+                    same_cookie.setdefault(key, []).append(page)
+            await asyncio.gather(*(login_in_turn(p) for p in same_cookie.values()))
+
+        return await asyncio.gather(
+            *(
+                auth._finish(auth_request, sso_token)
+                for auth, auth_request, sso_token in zip(
+                    authenticators, auth_requests, sso_tokens
+                )
+            )
+        )
+    finally:
+        for auth in authenticators:
+            auth.close()
+
+
 class AuthenticationError(Exception):
     pass
 
@@ -108,35 +284,89 @@ def create_http_session(proxy, version):
     return session
 
 
-E = objectify.ElementMaker(annotate=False)
-
-
-def _create_auth_init_request(host, url, version):
-    ConfigAuth = getattr(E, "config-auth")
-    Version = E.version
-    DeviceId = getattr(E, "device-id")
-    GroupSelect = getattr(E, "group-select")
-    GroupAccess = getattr(E, "group-access")
-    Capabilities = E.capabilities
-    AuthMethod = getattr(E, "auth-method")
-
-    root = ConfigAuth(
-        {"client": "vpn", "type": "init", "aggregate-auth-version": "2"},
-        Version({"who": "vpn"}, version),
-        DeviceId("linux-64"),
-        GroupSelect(host.name),
-        GroupAccess(url),
-        Capabilities(AuthMethod("single-sign-on-v2")),
-    )
-    return etree.tostring(
-        root, pretty_print=True, xml_declaration=True, encoding="UTF-8"
-    )
+# Requests are rendered from templates, only the dynamic fields are escaped and
+# substituted. The layout is the same as the one of the AnyConnect client.
+_AUTH_INIT_REQUEST = """<?xml version='1.0' encoding='UTF-8'?>
+<config-auth client="vpn" type="init" aggregate-auth-version="2">
+  <version who="vpn">{version}</version>
+  <device-id>linux-64</device-id>
+  <group-select>{group}</group-select>
+  <group-access>{url}</group-access>
+  <capabilities>
+    <auth-method>single-sign-on-v2</auth-method>
+  </capabilities>
+</config-auth>
+"""
+
+_AUTH_FINISH_REQUEST = """<?xml version='1.0' encoding='UTF-8'?>
+<config-auth client="vpn" type="auth-reply" aggregate-auth-version="2">
+  <version who="vpn">{version}</version>
+  <device-id>linux-64</device-id>
+  <session-token/>
+  <session-id/>
+  {opaque}
+  <auth>
+    <sso-token>{sso_token}</sso-token>
+  </auth>
+</config-auth>
+"""
+
+
+def _escape(value):
+    return escape(str(value or ""))
+
+
+def create_auth_init_request(host, url, version):
+    """Return the body of the request starting a login to `url` of `host`"""
+    return _AUTH_INIT_REQUEST.format(
+        version=_escape(version), group=_escape(host.name), url=_escape(url)
+    ).encode()
+
+
+# Entities are not expanded and nothing is fetched, the gateway is not trusted
+_parser = etree.XMLParser(resolve_entities=False, no_network=True, huge_tree=False)
+
+_type = etree.XPath("string(/config-auth/@type)")
+_auth_id = etree.XPath("string(/config-auth/auth/@id)")
+_opaque = etree.XPath("/config-auth/opaque")
+_REQUEST_FIELDS = {
+    "auth_title": (etree.XPath("/config-auth/auth/title"), False),
+    "auth_message": (etree.XPath("/config-auth/auth/message"), True),
+    "auth_error": (etree.XPath("/config-auth/auth/error"), False),
+    "login_url": (etree.XPath("/config-auth/auth/sso-v2-login"), True),
+    "login_final_url": (etree.XPath("/config-auth/auth/sso-v2-login-final"), True),
+    "token_cookie_name": (
+        etree.XPath("/config-auth/auth/sso-v2-token-cookie-name"),
+        True,
+    ),
+}
+_COMPLETE_FIELDS = {
+    "auth_message": (etree.XPath("/config-auth/auth/message"), True),
+    "session_token": (etree.XPath("/config-auth/session-token"), True),
+    "server_cert_hash": (
+        etree.XPath("/config-auth/config/vpn-base-config/server-cert-hash"),
+        True,
+    ),
+}
+
+
+def _fields(xml, fields):
+    values = {}
+    for name, (xpath, required) in fields.items():
+        elements = xpath(xml)
+        if not elements and required:
+            raise AuthResponseError(f"{name} not found in response")
+        values[name] = (elements[0].text or "") if elements else ""
+    return values
 
 
 def parse_response(resp):
     resp.raise_for_status()
-    xml = objectify.fromstring(resp.content)
-    t = xml.get("type")
+    try:
+        xml = etree.fromstring(resp.content, _parser)
+    except (etree.XMLSyntaxError, ValueError) as exc:
+        raise AuthResponseError(exc)
+    t = _type(xml)
     if t == "auth-request":
         return parse_auth_request_response(xml)
     elif t == "complete":
@@ -144,21 +374,18 @@ def parse_response(resp):
 
 
 def parse_auth_request_response(xml):
-    assert xml.auth.get("id") == "main"
-
-    try:
-        resp = AuthRequestResponse(
-            auth_id=xml.auth.get("id"),
-            auth_title=getattr(xml.auth, "title", ""),
-            auth_message=xml.auth.message,
-            auth_error=getattr(xml.auth, "error", ""),
-            opaque=xml.opaque,
-            login_url=xml.auth["sso-v2-login"],
-            login_final_url=xml.auth["sso-v2-login-final"],
-            token_cookie_name=xml.auth["sso-v2-token-cookie-name"],
-        )
-    except AttributeError as exc:
-        raise AuthResponseError(exc)
+    auth_id = _auth_id(xml)
+    if auth_id != "main":
+        raise AuthResponseError(f"Unexpected auth id: {auth_id!r}")
+    opaque = _opaque(xml)
+    if not opaque:
+        raise AuthResponseError("opaque not found in response")
+
+    resp = AuthRequestResponse(
+        auth_id=auth_id,
+        opaque=etree.tostring(opaque[0], with_tail=False),
+        **_fields(xml, _REQUEST_FIELDS),
+    )
 
     logger.info(
         "Response received",
@@ -169,7 +396,7 @@ def parse_auth_request_response(xml):
     return resp
 
 
-@attr.s
+@attr.s(slots=True)
 class AuthRequestResponse:
     auth_id = attr.ib(converter=str)
     auth_title = attr.ib(converter=str)
@@ -178,22 +405,19 @@ class AuthRequestResponse:
     login_url = attr.ib(converter=str)
     login_final_url = attr.ib(converter=str)
     token_cookie_name = attr.ib(converter=str)
-    opaque = attr.ib()
+    opaque = attr.ib()  # serialized <opaque> element, sent back as is
 
 
 def parse_auth_complete_response(xml):
-    assert xml.auth.get("id") == "success"
-    resp = AuthCompleteResponse(
-        auth_id=xml.auth.get("id"),
-        auth_message=xml.auth.message,
-        session_token=xml["session-token"],
-        server_cert_hash=xml.config["vpn-base-config"]["server-cert-hash"],
-    )
+    auth_id = _auth_id(xml)
+    if auth_id != "success":
+        raise AuthResponseError(f"Unexpected auth id: {auth_id!r}")
+    resp = AuthCompleteResponse(auth_id=auth_id, **_fields(xml, _COMPLETE_FIELDS))
     logger.info("Response received", id=resp.auth_id, message=resp.auth_message)
     return resp
 
 
-@attr.s
+@attr.s(slots=True)
 class AuthCompleteResponse:
     auth_id = attr.ib(converter=str)
     auth_message = attr.ib(converter=str)
@@ -202,23 +426,8 @@ class AuthCompleteResponse:
 
 
 def _create_auth_finish_request(host, auth_info, sso_token, version):
-    ConfigAuth = getattr(E, "config-auth")
-    Version = E.version
-    DeviceId = getattr(E, "device-id")
-    SessionToken = getattr(E, "session-token")
-    SessionId = getattr(E, "session-id")
-    Auth = E.auth
-    SsoToken = getattr(E, "sso-token")
-
-    root = ConfigAuth(
-        {"client": "vpn", "type": "auth-reply", "aggregate-auth-version": "2"},
-        Version({"who": "vpn"}, version),
-        DeviceId("linux-64"),
-        SessionToken(),
-        SessionId(),
-        auth_info.opaque,
-        Auth(SsoToken(sso_token)),
-    )
-    return etree.tostring(
-        root, pretty_print=True, xml_declaration=True, encoding="UTF-8"
-    )
+    return _AUTH_FINISH_REQUEST.format(
+        version=_escape(version),
+        opaque=auth_info.opaque.decode(),
+        sso_token=_escape(sso_token),
+    ).encode()
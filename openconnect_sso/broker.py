@@ -0,0 +1,343 @@
+"""Serve gateway session cookies to local clients
+
+The broker logs in once per gateway and user, and hands out the resulting
+session cookie and certificate fingerprint (what `--authenticate json` prints)
+to any number of clients of the same user, e.g. tools on a build agent.
+Concurrent requests for the same gateway and user share one login.
+
+Clients send one JSON object per line on a Unix socket and get one back::
+
+    {"server": "vpn.example.com/group", "user": "user@example.com"}
+    {"host": "https://vpn.example.com/group", "cookie": "...", "fingerprint": "..."}
+
+Sending `"invalidate": true` drops the cached session instead, e.g. when the
+gateway rejected the cookie. With `"identity"`, the login is made as a named
+identity of the configuration file, in a browser profile of its own.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import struct
+import sys
+import time
+from pathlib import Path
+
+import structlog
+import xdg.BaseDirectory
+
+from openconnect_sso import config, metrics, token_cache
+from openconnect_sso.authenticator import AuthenticationError, Authenticator
+from openconnect_sso.browser import Terminated
+
+logger = structlog.get_logger()
+
+MODULE = "openconnect_sso.broker"
+
+DEFAULT_TOKEN_LIFETIME = token_cache.DEFAULT_LIFETIME
+# Connecting to a Unix socket with a full backlog fails instead of retrying
+BACKLOG = 1024
+
+_PEERCRED = struct.Struct("3i")
+
+
+def socket_path():
+    runtime_dir = (
+        Path(xdg.BaseDirectory.get_runtime_dir(strict=False)) / config.APP_NAME
+    )
+    runtime_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+    return str(runtime_dir / "broker.sock")
+
+
+class BrokerError(Exception):
+    pass
+
+
+class Broker:
+    """Caches sessions in memory and deduplicates concurrent logins
+
+    `authenticate(host, username, identity)` is a coroutine function returning
+    an :class:`AuthCompleteResponse`.
+    """
+
+    def __init__(self, authenticate, lifetime=DEFAULT_TOKEN_LIFETIME, clock=time.time):
+        self._authenticate = authenticate
+        self._lifetime = lifetime
+        self._clock = clock
+        self._sessions = {}
+        self._logins = {}
+
+    async def get(self, host, username=None, identity=None):
+        """Return the :class:`token_cache.CachedSession` of `host` and `username`"""
+        key = (host.vpn_url, username, identity)
+        session = self._sessions.get(key)
+        if session is not None and session.is_valid(self._clock()):
+            return session
+
+        login = self._logins.get(key)
+        if login is None:
+            login = asyncio.ensure_future(self._login(key, host, username, identity))
+            self._logins[key] = login
+            login.add_done_callback(lambda _: self._logins.pop(key, None))
+        else:
+            logger.debug(
+                "Waiting for login in progress",
+                host=key[0],
+                user=username,
+                identity=identity,
+            )
+        # A client going away must not cancel the login shared with others
+        return await asyncio.shield(login)
+
+    async def _login(self, key, host, username, identity):
+        logger.info("Logging in", host=key[0], user=username, identity=identity)
+        auth_response = await self._authenticate(host, username, identity)
+        session = token_cache.CachedSession(
+            host=host.vpn_url,
+            session_token=auth_response.session_token,
+            server_cert_hash=auth_response.server_cert_hash,
+            expires_at=self._clock() + self._lifetime,
+        )
+        self._sessions[key] = session
+        return session
+
+    def invalidate(self, host, username=None, identity=None):
+        self._sessions.pop((host.vpn_url, username, identity), None)
+
+    def evict(self):
+        """Forget expired sessions"""
+        now = self._clock()
+        expired = [k for k, s in self._sessions.items() if not s.is_valid(now)]
+        for key in expired:
+            del self._sessions[key]
+        if expired:
+            logger.debug("Evicted expired sessions", count=len(expired))
+
+    async def handle(self, request):
+        """Answer one request of a client"""
+        try:
+            host = config.HostProfile(
+                request["server"],
+                request.get("usergroup", ""),
+                request.get("authgroup", ""),
+            )
+            username = request.get("user")
+            identity = request.get("identity")
+            if identity is not None:
+                config.check_identity_name(identity)
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return {"error": "Invalid request"}
+
+        if request.get("invalidate"):
+            self.invalidate(host, username, identity)
+            return {}
+        try:
+            session = await self.get(host, username, identity)
+        except (AuthenticationError, Terminated, OSError) as exc:
+            logger.warn("Login failed", host=host.vpn_url, error=repr(exc))
+            return {"error": f"Login failed: {exc!r}"}
+        except Exception as exc:
+            # The client gets an answer whatever goes wrong
+            logger.error("Login failed", host=host.vpn_url, exc_info=True)
+            return {"error": f"Login failed: {exc!r}"}
+        return {
+            "host": session.host,
+            "cookie": session.session_token,
+            "fingerprint": session.server_cert_hash,
+        }
+
+
+def _peer_allowed(sock):
+    """Only processes of the same user may talk to the broker"""
+    if not hasattr(socket, "SO_PEERCRED"):
+        # Access is still limited by the permissions of the socket file
+        return True
+    pid, uid, gid = _PEERCRED.unpack(
+        sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, _PEERCRED.size)
+    )
+    if uid != os.getuid():
+        logger.warn("Rejected client of another user", pid=pid, uid=uid)
+        return False
+    return True
+
+
+async def serve(broker, path, sweep_interval=60):
+    """Serve `broker` on the Unix socket `path` until cancelled"""
+
+    async def on_client(reader, writer):
+        try:
+            if not _peer_allowed(writer.get_extra_info("socket")):
+                # Read the request first, closing the connection with unread
+                # data would reset it before the client sees the answer
+                await reader.readline()
+                writer.write(b'{"error": "Permission denied"}\n')
+                await writer.drain()
+                return
+            async for line in reader:
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    response = {"error": "Invalid request"}
+                else:
+                    response = await broker.handle(request)
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    if os.path.exists(path):
+        try:
+            _, writer = await asyncio.open_unix_connection(path)
+        except OSError:
+            # Left behind by a broker which did not exit cleanly
+            os.unlink(path)
+        else:
+            writer.close()
+            raise BrokerError(f"Another broker is already serving {path}")
+    server = await asyncio.start_unix_server(on_client, path=path, backlog=BACKLOG)
+    os.chmod(path, 0o600)
+    logger.info("Broker started", path=path)
+    try:
+        while True:
+            await asyncio.sleep(sweep_interval)
+            broker.evict()
+    finally:
+        server.close()
+        await server.wait_closed()
+        os.unlink(path)
+
+
+async def request(path, server, user=None, usergroup="", authgroup="", **fields):
+    """Ask the broker at `path` for the session of `server`"""
+    reader, writer = await asyncio.open_unix_connection(path)
+    try:
+        message = {
+            "server": server,
+            "user": user,
+            "usergroup": usergroup,
+            "authgroup": authgroup,
+            **fields,
+        }
+        writer.write(json.dumps(message).encode() + b"\n")
+        await writer.drain()
+        line = await reader.readline()
+    finally:
+        writer.close()
+    if not line:
+        raise BrokerError("Connection closed by broker")
+    response = json.loads(line)
+    if "error" in response:
+        raise BrokerError(response["error"])
+    return response
+
+
+def _authenticator(args, cfg):
+    display_mode = config.DisplayMode[args.browser_display_mode.upper()]
+
+    async def authenticate(host, username, identity):
+        if identity is None:
+            credentials = cfg.credentials
+        elif identity in cfg.identities:
+            credentials = cfg.identities[identity].credentials
+        else:
+            raise AuthenticationError(f"Unknown identity: {identity}")
+        if username:
+            credentials = config.Credentials(username)
+        try:
+            return await Authenticator(
+                host, args.proxy, credentials, args.ac_version, identity, cfg=cfg
+            ).authenticate(
+                display_mode, args.browser_daemon, sso_replay=args.sso_replay
+            )
+        finally:
+            # Exported after every login, then forgotten, as the broker runs
+            # for a long time
+            metrics.export(args.metrics_json, args.metrics_prometheus)
+            metrics.reset()
+
+    return authenticate
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog=f"{sys.executable} -m {MODULE}",
+        description="Log in to VPN gateways once and serve the session cookies "
+        "to other processes of the same user",
+    )
+    parser.add_argument("command", choices=["serve", "get", "invalidate"])
+    parser.add_argument("--socket", help="Path of the socket", default=None)
+    parser.add_argument("-s", "--server", help="VPN server (get, invalidate)")
+    parser.add_argument("-g", "--usergroup", default="")
+    parser.add_argument("--authgroup", default="")
+    parser.add_argument("-u", "--user", help="Authenticate as the given user")
+    parser.add_argument(
+        "-i", "--identity", help="Authenticate as the named identity (get, invalidate)"
+    )
+    parser.add_argument("--proxy", help="Use a proxy server (serve)")
+    parser.add_argument("--ac-version", default="4.7.00136")
+    parser.add_argument(
+        "--browser-display-mode",
+        choices=["shown", "hidden", "headless"],
+        default="hidden",
+    )
+    parser.add_argument("--browser-daemon", action="store_true", default=False)
+    parser.add_argument("--sso-replay", action="store_true", default=False)
+    parser.add_argument(
+        "--metrics-json",
+        help="Append the duration of each phase of every login to this file (serve)",
+        metavar="FILE",
+    )
+    parser.add_argument(
+        "--metrics-prometheus",
+        help="Write the metrics of the last login to this file (serve)",
+        metavar="FILE",
+    )
+    parser.add_argument(
+        "--token-lifetime",
+        help="Serve a session for this many seconds, defaults to %(default)s",
+        type=float,
+        default=DEFAULT_TOKEN_LIFETIME,
+    )
+    args = parser.parse_args(argv)
+    path = args.socket or socket_path()
+
+    if args.command == "serve":
+        structlog.configure(logger_factory=structlog.PrintLoggerFactory(sys.stderr))
+        broker = Broker(_authenticator(args, config.load()), args.token_lifetime)
+        try:
+            asyncio.run(serve(broker, path))
+        except KeyboardInterrupt:
+            pass
+        except BrokerError as exc:
+            print(exc, file=sys.stderr)
+            return 1
+        return 0
+
+    if not args.server:
+        parser.error("--server is required")
+    try:
+        response = asyncio.run(
+            request(
+                path,
+                args.server,
+                args.user,
+                args.usergroup,
+                args.authgroup,
+                identity=args.identity,
+                invalidate=args.command == "invalidate",
+            )
+        )
+    except (OSError, BrokerError) as exc:
+        print(f"Broker request failed: {exc}", file=sys.stderr)
+        return 1
+    if response:
+        print(json.dumps(response, indent=4))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
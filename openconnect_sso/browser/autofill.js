@@ -0,0 +1,89 @@
+// Applies auto-fill rules as soon as their elements appear in the page.
+//
+// Rules are evaluated in order whenever the DOM changes:
+//  - stop:  if the element exists, auto-filling stops on this page
+//  - fill:  sets the value of the element
+//  - click: clicks on the element
+//
+// Each element is filled only once per rule. An element is clicked again only
+// if something has been filled in since, as single page login flows tend to
+// reuse the same button for each step. Nothing runs while the page is not
+// changing.
+function autoFill(rules) {
+    var observer = new MutationObserver(apply);
+    var filled = 0;
+    var done = rules.map(function () {
+        return new WeakMap();
+    });
+
+    function apply() {
+        for (var i = 0; i < rules.length; i++) {
+            var rule = rules[i];
+            var elem = document.querySelector(rule.selector);
+            if (!elem) {
+                continue;
+            }
+            if (rule.action === "stop") {
+                observer.disconnect();
+                return false;
+            }
+            if (done[i].has(elem)) {
+                if (rule.action === "fill" || done[i].get(elem) === filled) {
+                    continue;
+                }
+            }
+            elem.dispatchEvent(new Event("focus"));
+            if (rule.action === "fill") {
+                elem.value = rule.value;
+                elem.dispatchEvent(new Event("blur"));
+                filled++;
+            } else if (rule.action === "click") {
+                elem.click();
+            }
+            done[i].set(elem, filled);
+        }
+        return true;
+    }
+
+    if (apply()) {
+        observer.observe(document, {
+            childList: true,
+            subtree: true,
+            attributes: true,
+        });
+    }
+}
+
+// Runs the rules of each URL pattern matching the current page.
+//
+// `index.hosts` maps host names to the entries of patterns for that host,
+// `index.wildcard` lists patterns with a wildcard in the host name. Values to
+// fill in are looked up from `credentials` by the `fill` attribute of rules.
+function autoFillDispatch(index, credentials) {
+    var candidates = (index.hosts[location.hostname.toLowerCase()] || []).concat(
+        index.wildcard
+    );
+    // Keep the order of the configuration
+    candidates.sort(function (a, b) {
+        return a - b;
+    });
+    candidates.forEach(function (id) {
+        var entry = index.entries[id];
+        if (!new RegExp(entry.pattern).test(location.href)) {
+            return;
+        }
+        var rules = [];
+        entry.rules.forEach(function (rule) {
+            if (rule.action !== "fill") {
+                rules.push(rule);
+            } else if (credentials[rule.fill]) {
+                rules.push({
+                    selector: rule.selector,
+                    action: "fill",
+                    value: credentials[rule.fill],
+                });
+            }
+        });
+        autoFill(rules);
+    });
+}
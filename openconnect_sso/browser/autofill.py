@@ -0,0 +1,264 @@
+"""Scripts filling in login forms of identity providers
+
+The rules of :attr:`config.Config.auto_fill_rules` are compiled into a single
+script, which looks up the rules of the current page by its host name and
+applies them using `autofill.js` as soon as their elements appear. Compiled
+scripts are cached on disk, keyed by the hash of the rules.
+
+Credentials are not part of the compiled script, they are injected by a
+separate script created by :func:`get_credentials_script`.
+
+Rules are also applied without a browser, to pages parsed with lxml, see
+:func:`rules_for_url` and :func:`css_to_xpath`.
+"""
+
+import functools
+import hashlib
+import json
+import os
+import re
+import tempfile
+from pathlib import Path
+
+import pkg_resources
+import structlog
+import xdg.BaseDirectory
+from lxml import etree
+
+from openconnect_sso.config import APP_NAME
+
+logger = structlog.get_logger()
+
+CREDENTIALS_VARIABLE = "openconnectSsoCredentials"
+
+_PATTERN = re.compile(r"^[^:/]*://(?P<host>[^/]*)")
+
+
+def _engine():
+    return pkg_resources.resource_string(__name__, "autofill.js").decode()
+
+
+def _glob_to_regex(pattern):
+    return "^" + ".*".join(re.escape(part) for part in pattern.split("*")) + "$"
+
+
+def url_matches(pattern, url):
+    """Whether `url` matches the URL pattern of auto-fill rules"""
+    return re.match(_glob_to_regex(pattern), url) is not None
+
+
+def rules_for_url(auto_fill_rules, url):
+    """Return the rules applied to the page at `url`, in the order of the configuration"""
+    return [
+        rule
+        for pattern, rules in auto_fill_rules.items()
+        if url_matches(pattern, url)
+        for rule in rules
+    ]
+
+
+_CSS_TOKEN = re.compile(
+    r"""
+      \s*(?P<combinator>[>+~,])\s*
+    | (?P<descendant>\s+)
+    | (?P<tag>\*|[A-Za-z][\w-]*)
+    | \#(?P<id>[\w-]+)
+    | \.(?P<cls>[\w-]+)
+    | \[\s*(?P<attr>[\w:-]+)\s*
+      (?:(?P<op>[~|^$*]?=)\s*(?P<value>"[^"]*"|'[^']*'|[^\]\s"']+)\s*)?\]
+    """,
+    re.VERBOSE,
+)
+
+
+def _literal(value):
+    if "'" not in value:
+        return f"'{value}'"
+    if '"' not in value:
+        return f'"{value}"'
+    raise ValueError("Unsupported quotes in selector value", value)
+
+
+def _contains_word(expression, word):
+    return (
+        f"contains(concat(' ', normalize-space({expression}), ' '), "
+        f"{_literal(f' {word} ')})"
+    )
+
+
+def _attribute_condition(name, op, value):
+    attr = f"@{name.lower()}"
+    if op is None:
+        return attr
+    if value[0] in "'\"":
+        value = value[1:-1]
+    literal = _literal(value)
+    if op == "=":
+        return f"{attr}={literal}"
+    if op == "~=":
+        return _contains_word(attr, value)
+    if op == "|=":
+        return f"({attr}={literal} or starts-with({attr}, {_literal(value + '-')}))"
+    if op == "^=":
+        return f"starts-with({attr}, {literal})"
+    if op == "$=":
+        return f"substring({attr}, string-length({attr}) - {len(value) - 1})={literal}"
+    return f"contains({attr}, {literal})"
+
+
+@functools.lru_cache(maxsize=None)
+def css_to_xpath(selector):
+    """Translate a CSS selector to a compiled XPath expression
+
+    Only the selectors used by auto-fill rules are supported: type, universal,
+    ID, class and attribute selectors, combined with descendant and child
+    combinators or grouped by commas. Other selectors raise `ValueError`.
+    """
+    paths = []
+    path = "descendant-or-self::"
+    step = None
+    conditions = []
+
+    def finish_step():
+        nonlocal path, step, conditions
+        if step is None and not conditions:
+            raise ValueError("Empty selector", selector)
+        path += (step or "*") + "".join(f"[{c}]" for c in conditions)
+        step, conditions = None, []
+
+    position = 0
+    selector = selector.strip()
+    while position < len(selector):
+        match = _CSS_TOKEN.match(selector, position)
+        if not match or match.end() == position:
+            raise ValueError("Unsupported selector", selector)
+        position = match.end()
+        if match.group("combinator") or match.group("descendant"):
+            combinator = match.group("combinator")
+            finish_step()
+            if combinator == ",":
+                paths.append(path)
+                path = "descendant-or-self::"
+            elif combinator == ">":
+                path += "/"
+            elif combinator is None:
+                path += "//"
+            else:
+                raise ValueError("Unsupported combinator", selector)
+        elif match.group("tag"):
+            if step is not None or conditions:
+                raise ValueError("Unsupported selector", selector)
+            step = match.group("tag").lower()
+        elif match.group("id"):
+            conditions.append(f"@id={_literal(match.group('id'))}")
+        elif match.group("cls"):
+            conditions.append(_contains_word("@class", match.group("cls")))
+        else:
+            conditions.append(
+                _attribute_condition(
+                    match.group("attr"), match.group("op"), match.group("value")
+                )
+            )
+    finish_step()
+    paths.append(path)
+    return etree.XPath(" | ".join(paths))
+
+
+def _host(pattern):
+    """Return the host name of `pattern`, or `None` if it has wildcards"""
+    match = _PATTERN.match(pattern)
+    if not match:
+        return None
+    host = match.group("host").rsplit("@", 1)[-1].split(":", 1)[0].lower()
+    if not host or "*" in host:
+        return None
+    return host
+
+
+def _compile_rule(rule):
+    if rule.action == "stop":
+        return {"selector": rule.selector, "action": "stop"}
+    elif rule.fill:
+        return {"selector": rule.selector, "action": "fill", "fill": rule.fill}
+    elif rule.action == "click":
+        return {"selector": rule.selector, "action": "click"}
+    return None
+
+
+def build_index(auto_fill_rules):
+    """Index the patterns of `auto_fill_rules` by host name"""
+    index = {"hosts": {}, "wildcard": [], "entries": []}
+    for url_pattern, rules in auto_fill_rules.items():
+        entry_id = len(index["entries"])
+        index["entries"].append(
+            {
+                "pattern": _glob_to_regex(url_pattern),
+                "rules": [r for r in map(_compile_rule, rules) if r is not None],
+            }
+        )
+        host = _host(url_pattern)
+        if host is None:
+            index["wildcard"].append(entry_id)
+        else:
+            index["hosts"].setdefault(host, []).append(entry_id)
+    return index
+
+
+def compile_rules(auto_fill_rules):
+    index = json.dumps(build_index(auto_fill_rules), separators=(",", ":"))
+    return f"""{_engine()}
+autoFillDispatch({index}, window.{CREDENTIALS_VARIABLE} || {{}});
+"""
+
+
+def _rules_hash(auto_fill_rules):
+    rules = {
+        pattern: [rule.as_dict() for rule in rules]
+        for pattern, rules in auto_fill_rules.items()
+    }
+    digest = hashlib.sha256(json.dumps(rules, sort_keys=True).encode())
+    # Scripts compiled by another version are not reused
+    digest.update(_engine().encode())
+    return digest.hexdigest()[:16]
+
+
+def get_script(auto_fill_rules, cache_dir=None):
+    """Return the compiled script of `auto_fill_rules`, cached on disk"""
+    if cache_dir is None:
+        cache_dir = xdg.BaseDirectory.save_cache_path(APP_NAME)
+    cache_dir = Path(cache_dir)
+    path = cache_dir / f"autofill-{_rules_hash(auto_fill_rules)}.js"
+    try:
+        return path.read_text()
+    except FileNotFoundError:
+        pass
+
+    script = compile_rules(auto_fill_rules)
+    try:
+        # Scripts of previous rules are not needed anymore
+        for stale in cache_dir.glob("autofill-*.js"):
+            stale.unlink()
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix=".autofill-")
+        with os.fdopen(fd, "w") as f:
+            f.write(script)
+        os.replace(tmp_path, path)
+    except OSError:
+        logger.warn("Could not cache auto-fill script", path=str(path))
+    return script
+
+
+def get_credentials_script(auto_fill_rules, credentials):
+    """Return a script providing the credentials referred to by the rules"""
+    values = {}
+    names = {rule.fill for rules in auto_fill_rules.values() for rule in rules}
+    for name in sorted(filter(None, names)):
+        value = getattr(credentials, name, None)
+        if value:
+            values[name] = value
+        else:
+            logger.warning(
+                "Credential info not available",
+                type=name,
+                possibilities=dir(credentials),
+            )
+    return f"var {CREDENTIALS_VARIABLE} = {json.dumps(values)};\n"
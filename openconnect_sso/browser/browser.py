@@ -1,83 +1,253 @@
 import asyncio
+from urllib.parse import urlparse
 
 import structlog
 
-from . import webengine_process as web
+from openconnect_sso import metrics
+from . import daemon, ipc, memory
+from .cookie_store import domain_matches
+from .process import Process
+from .. import config
 from ..config import DisplayMode
 
 logger = structlog.get_logger()
 
 
 class Browser:
-    def __init__(self, proxy=None, display_mode=DisplayMode.SHOWN):
+    def __init__(
+        self, proxy=None, display_mode=DisplayMode.SHOWN, use_daemon=False, cfg=None
+    ):
         self.browser_proc = None
+        self._starting = None
+        self._error = None
         self.updater = None
         self.running = False
-        self._urls = asyncio.Queue()
+        self._urls = {}
         self.url = None
         self.cookies = {}
+        self._cookie_jar = {}
+        self._cookie_waiters = []
+        self._startup = None
+        self._page_spans = {}
+        self._memory = None
+        self._sampler = None
         self.loop = asyncio.get_event_loop()
         self.proxy = proxy
         self.display_mode = display_mode
+        self.use_daemon = use_daemon
+        # Passed to the browser process, so that it does not load it again.
+        # The daemon loads the configuration itself, as it outlives this.
+        self.cfg = config.load() if cfg is None else cfg
 
     async def spawn(self):
-        self.browser_proc = web.Process(self.proxy, self.display_mode)
-        self.browser_proc.start()
+        self._startup = metrics.start("browser_start", daemon=self.use_daemon)
+        if self.use_daemon:
+            # Starting the daemon may take a while, let the caller continue
+            # and wait for it only when the browser is needed
+            self._starting = asyncio.ensure_future(
+                daemon.connect(self.proxy, self.display_mode)
+            )
+        else:
+            self.browser_proc = Process(self.proxy, self.display_mode, self.cfg)
+            self.browser_proc.start()
         self.running = True
 
         self.updater = asyncio.ensure_future(self._update_status())
 
+    async def _started(self):
+        if self.browser_proc is None:
+            self.browser_proc = await self._starting
+        return self.browser_proc
+
+    async def _update_status(self):
+        try:
+            browser_proc = await self._started()
+        except Exception as exc:
+            self._startup.finish(error=type(exc).__name__)
+            self._error = exc
+            self.running = False
+            self._wake_pages()
+            return
+        if self.use_daemon:
+            # The daemon is already up and running when it accepts connections
+            self._startup.finish()
+        if browser_proc.pid and memory.PeakRss.supported():
+            self._memory = memory.PeakRss(browser_proc.pid)
+            self._sampler = asyncio.ensure_future(self._memory.run())
+
         def stop(_task):
             self.running = False
 
-        asyncio.ensure_future(self.browser_proc.wait()).add_done_callback(stop)
+        asyncio.ensure_future(browser_proc.wait()).add_done_callback(stop)
 
-    async def _update_status(self):
         while self.running:
             logger.debug("Waiting for message from browser process")
 
             try:
-                state = await self.browser_proc.get_state_async()
+                state = await browser_proc.get_state_async()
             except EOFError:
                 if self.running:
                     logger.warn("Connection terminated with browser")
                     self.running = False
                 else:
                     logger.info("Browser exited")
-                await self._urls.put(None)
+                self._wake_pages()
+                return
+            except ipc.ProtocolError:
+                logger.error("Invalid message from browser", exc_info=True)
+                self.running = False
+                self._wake_pages()
                 return
             logger.debug("Message received from browser", message=state)
 
-            if isinstance(state, web.Url):
-                await self._urls.put(state.url)
-            elif isinstance(state, web.SetCookie):
-                self.cookies[state.name] = state.value
+            if isinstance(state, ipc.Ready):
+                self._startup.finish()
+            elif isinstance(state, ipc.Url):
+                self._page_load_finished(state.page, state.url)
+                self._queue(state.page).put_nowait(state.url)
+            elif isinstance(state, ipc.SetCookie):
+                self._set_cookie(state)
             else:
                 logger.error("Message unrecognized", message=state)
 
-    async def authenticate_at(self, url, credentials):
+    def _set_cookie(self, state):
+        self.cookies[state.name] = state.value
+        self._cookie_jar[
+            state.identity, state.domain.lstrip("."), state.name
+        ] = state.value
+        # Each cookie is the token of one page only, pages logging in to the
+        # same host must not get the token of another one
+        for name, host, identity, page, future in self._cookie_waiters:
+            if (
+                name == state.name
+                and identity == state.identity
+                and domain_matches(host, state.domain)
+                and (None in (page, state.page) or page == state.page)
+                and not future.done()
+            ):
+                future.set_result(state.value)
+                break
+        self._cookie_waiters = [w for w in self._cookie_waiters if not w[-1].done()]
+
+    def _queue(self, page):
+        return self._urls.setdefault(page, asyncio.Queue())
+
+    def _page_load_finished(self, page, url):
+        # Query strings are left out, they may contain secrets and would
+        # make every URL distinct
+        parts = urlparse(url)
+        span = self._page_spans.pop(page, None)
+        if span:
+            span.finish(page=page, url=f"{parts.scheme}://{parts.netloc}{parts.path}")
+        # Time spent on the next page, including any user interaction
+        self._page_spans[page] = metrics.start("page_load")
+
+    def _wake_pages(self):
+        for urls in self._urls.values():
+            urls.put_nowait(None)
+
+    async def authenticate_at(
+        self, url, credentials, page=0, token_cookie=None, identity=None
+    ):
+        """Load `url` in `page`
+
+        Pages are separate browser windows sharing the same cookies, so a
+        login made in one of them is visible to the others. Pages of different
+        identities use separate browser profiles and do not share cookies,
+        even when they log in at the same time.
+
+        If `token_cookie` is given as a `(name, url)` pair, only that cookie
+        is sent back by the browser, which stops loading the page as soon as
+        the cookie is set. Other cookies are not available then.
+
+        The secrets of `credentials` are sent to the browser process, so that
+        it does not need to access the keyring.
+        """
         assert self.running
-        self.browser_proc.authenticate_at(url, credentials)
-
-    async def page_loaded(self):
-        rv = await self._urls.get()
+        if identity is not None:
+            # Fail here rather than in the browser process
+            config.check_identity_name(identity)
+        if credentials:
+            credentials = credentials.resolve()
+        browser_proc = await self._started()
+        self._page_spans[page] = metrics.start("page_load")
+        browser_proc.authenticate_at(
+            url, credentials, page, token_cookie or (None, None), identity
+        )
+
+    async def page_loaded(self, page=0):
+        rv = await self._queue(page).get() if self.running else None
         if not self.running:
+            if self._error:
+                raise self._error
             raise Terminated()
-        self.url = rv
+        if page == 0:
+            self.url = rv
+        return rv
+
+    def expect_cookie(self, name, url, identity=None, page=None):
+        """Return a future of the next value of the cookie `name` sent along with `url`
+
+        Cookies set before calling this are not considered. With `page`, only
+        the token cookie of that page is. Otherwise, of several waiters for
+        the same cookie, the one waiting longest gets it.
+        """
+        future = self.loop.create_future()
+        self._cookie_waiters.append(
+            (name, urlparse(url).hostname, identity, page, future)
+        )
+        return future
+
+    def cookie(self, name, url, identity=None):
+        """Return the value of the cookie `name` which is sent along with `url`"""
+        host = urlparse(url).hostname
+        matches = [
+            (domain, value)
+            for (
+                cookie_identity,
+                domain,
+                cookie_name,
+            ), value in self._cookie_jar.items()
+            if cookie_identity == identity
+            and cookie_name == name
+            and domain_matches(host, domain)
+        ]
+        if not matches:
+            raise KeyError(name)
+        # The most specific domain wins
+        return max(matches, key=lambda match: len(match[0]))[1]
 
     async def __aenter__(self):
         await self.spawn()
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.running = False
         try:
-            self.running = False
-            self.browser_proc.terminate()
-        except ProcessLookupError:
-            # already stopped
-            pass
-        await self.browser_proc.wait()
+            browser_proc = await self._started()
+        except Exception:
+            # could not connect to the daemon, nothing to stop
+            browser_proc = None
+        if self._sampler is not None:
+            self._sampler.cancel()
+            await asyncio.gather(self._sampler, return_exceptions=True)
+            self._memory.sample()
+        if browser_proc:
+            try:
+                browser_proc.terminate()
+            except ProcessLookupError:
+                # already stopped
+                pass
+            await browser_proc.wait()
         await self.updater
+        if self._memory is not None:
+            # Includes the pages of other clients when the daemon is used
+            metrics.gauge(
+                "browser_peak_rss_bytes",
+                self._memory.peak,
+                daemon=self.use_daemon,
+                display_mode=self.display_mode.name.lower(),
+            )
 
 
 class Terminated(Exception):
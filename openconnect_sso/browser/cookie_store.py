@@ -0,0 +1,101 @@
+"""Access to the cookies persisted by the browser profile
+
+QtWebEngine stores cookies in a Chromium SQLite database under the persistent
+storage path of the profile. They are read without starting the browser, e.g.
+to replay an SSO login with plain HTTP requests.
+"""
+
+import sqlite3
+import time
+from http.cookiejar import CookieJar
+from pathlib import Path
+
+import structlog
+import xdg.BaseDirectory
+from requests.cookies import create_cookie
+
+from openconnect_sso.config import APP_NAME, check_identity_name
+
+logger = structlog.get_logger()
+
+PROFILE_NAME = "openconnect-sso"
+
+# Chromium counts microseconds since 1601-01-01
+_CHROMIUM_EPOCH_OFFSET = 11644473600
+
+
+def profile_name(identity=None):
+    """Return the name of the browser profile of `identity`
+
+    Each identity has a profile of its own, the default profile is used
+    without one.
+    """
+    if identity is None:
+        return PROFILE_NAME
+    return f"{PROFILE_NAME}-{check_identity_name(identity)}"
+
+
+def storage_path(identity=None):
+    """Return the persistent storage path of the browser profile of `identity`"""
+    return str(
+        Path(xdg.BaseDirectory.save_data_path(APP_NAME))
+        / "QtWebEngine"
+        / profile_name(identity)
+    )
+
+
+def domain_matches(host, domain):
+    """Whether a cookie set for `domain` is sent along with requests to `host`"""
+    domain = domain.lstrip(".").lower()
+    host = host.lower()
+    return not domain or host == domain or host.endswith("." + domain)
+
+
+def load_cookies(path=None, now=None, identity=None):
+    """Return the unexpired cookies of the browser profile as a `CookieJar`"""
+    if path is None:
+        path = Path(storage_path(identity)) / "Cookies"
+    if now is None:
+        now = time.time()
+    jar = CookieJar()
+    if not Path(path).exists():
+        return jar
+
+    # The database is not locked, as the browser daemon may be holding it
+    try:
+        db = sqlite3.connect(f"file:{path}?mode=ro&immutable=1", uri=True)
+    except sqlite3.Error:
+        logger.warn("Cannot open browser cookies", path=str(path), exc_info=True)
+        return jar
+    try:
+        columns = {row[1] for row in db.execute("PRAGMA table_info(cookies)")}
+        secure = "is_secure" if "is_secure" in columns else "secure"
+        rows = db.execute(
+            f"SELECT host_key, name, value, path, expires_utc, {secure} FROM cookies"
+        ).fetchall()
+    except sqlite3.Error:
+        logger.warn("Cannot read browser cookies", path=str(path), exc_info=True)
+        return jar
+    finally:
+        db.close()
+
+    for host_key, name, value, cookie_path, expires_utc, is_secure in rows:
+        # Encrypted values are left empty in the value column
+        if not value:
+            continue
+        expires = None
+        if expires_utc:
+            expires = int(expires_utc / 1_000_000 - _CHROMIUM_EPOCH_OFFSET)
+            if expires < now:
+                continue
+        jar.set_cookie(
+            create_cookie(
+                name,
+                value,
+                domain=host_key,
+                path=cookie_path or "/",
+                secure=bool(is_secure),
+                expires=expires,
+            )
+        )
+    return jar
@@ -0,0 +1,246 @@
+"""Long-lived browser process shared between authentication runs
+
+Booting Qt and Chromium is the most expensive part of a login. The daemon
+keeps a browser process running in the background which serves
+authentication jobs on a Unix socket and exits after being idle for a while.
+"""
+
+import argparse
+import asyncio
+import collections
+import hashlib
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import structlog
+import xdg.BaseDirectory
+
+from openconnect_sso import config
+from . import headless, ipc
+
+logger = structlog.get_logger()
+
+MODULE = "openconnect_sso.browser.daemon"
+
+DEFAULT_IDLE_TIMEOUT = 600  # seconds
+STARTUP_TIMEOUT = 30  # seconds
+PING_TIMEOUT = 2  # seconds
+
+
+def socket_path(proxy, display_mode):
+    # Proxy and display mode are fixed for the lifetime of a Qt application,
+    # so each combination is served by its own daemon
+    digest = hashlib.sha256(f"{proxy or ''}|{display_mode.name}".encode())
+    runtime_dir = (
+        Path(xdg.BaseDirectory.get_runtime_dir(strict=False)) / config.APP_NAME
+    )
+    runtime_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+    return str(runtime_dir / f"browser-{digest.hexdigest()[:16]}.sock")
+
+
+class DaemonConnection:
+    """Client side of a browser daemon session
+
+    Implements the same interface as :class:`process.Process`, so
+    :class:`Browser` can use either of them.
+    """
+
+    def __init__(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+        self._decoder = ipc.Decoder()
+        self._messages = collections.deque()
+        # Process ID of the daemon, known once it answered a ping
+        self.pid = None
+
+    def send(self, message):
+        self._writer.write(ipc.encode(message))
+
+    async def receive(self):
+        while not self._messages:
+            try:
+                data = await self._reader.read(65536)
+            except ConnectionError:
+                data = b""
+            if not data:
+                raise EOFError()
+            self._messages.extend(self._decoder.feed(data))
+        return self._messages.popleft()
+
+    async def ping(self, timeout=PING_TIMEOUT):
+        self.send(ipc.Ping())
+        try:
+            message = await asyncio.wait_for(self.receive(), timeout)
+        except (asyncio.TimeoutError, EOFError, ipc.ProtocolError):
+            return None
+        return message if isinstance(message, ipc.Pong) else None
+
+    def authenticate_at(
+        self, url, credentials, page=0, token_cookie=(None, None), identity=None
+    ):
+        self.send(ipc.StartupInfo(url, credentials, page, *token_cookie, identity))
+
+    async def get_state_async(self):
+        return await self.receive()
+
+    def terminate(self):
+        self._writer.close()
+
+    async def wait(self):
+        try:
+            await self._writer.wait_closed()
+        except ConnectionError:
+            pass
+
+
+async def connect(proxy, display_mode, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+    """Connect to the browser daemon, starting it when it is not running"""
+    path = socket_path(proxy, display_mode)
+    connection = await _open(path)
+    if connection is None:
+        await _spawn(path, proxy, display_mode, idle_timeout)
+        connection = await _open(path)
+    if connection is None:
+        raise RuntimeError("Cannot connect to browser daemon", path)
+    return connection
+
+
+async def _open(path):
+    try:
+        reader, writer = await asyncio.open_unix_connection(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        return None
+
+    connection = DaemonConnection(reader, writer)
+    status = await connection.ping()
+    if status is None:
+        logger.warn("Browser daemon is not responding", path=path)
+        connection.terminate()
+        return None
+    connection.pid = status.pid
+    logger.debug(
+        "Connected to browser daemon",
+        path=path,
+        pid=status.pid,
+        sessions=status.sessions,
+        uptime=status.uptime,
+    )
+    return connection
+
+
+async def _spawn(path, proxy, display_mode, idle_timeout):
+    command_line = [
+        sys.executable,
+        "-m",
+        MODULE,
+        "serve",
+        "--display-mode",
+        display_mode.name.lower(),
+        "--idle-timeout",
+        str(idle_timeout),
+    ]
+    if proxy:
+        command_line.extend(["--proxy", proxy])
+
+    log_path = Path(xdg.BaseDirectory.save_cache_path(config.APP_NAME)) / (
+        Path(path).stem + ".log"
+    )
+    logger.info("Starting browser daemon", path=path, log=str(log_path))
+    with log_path.open("ab") as log:
+        proc = subprocess.Popen(
+            command_line,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=log,
+            start_new_session=True,
+        )
+    # The daemon writes a line to stdout as soon as it accepts connections
+    loop = asyncio.get_event_loop()
+    try:
+        await asyncio.wait_for(
+            loop.run_in_executor(None, proc.stdout.readline), STARTUP_TIMEOUT
+        )
+    except asyncio.TimeoutError:
+        logger.error("Browser daemon did not start in time", log=str(log_path))
+    finally:
+        proc.stdout.close()
+
+
+def _notify_ready():
+    sys.stdout.write("ready\n")
+    sys.stdout.flush()
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+    os.close(devnull)
+
+
+async def _control(command, proxy, display_mode, idle_timeout):
+    path = socket_path(proxy, display_mode)
+    if command == "start":
+        connection = await connect(proxy, display_mode, idle_timeout)
+    else:
+        connection = await _open(path)
+        if connection is None:
+            print(f"Browser daemon is not running ({path})")
+            return 1
+
+    if command == "stop":
+        connection.send(ipc.Shutdown())
+    else:
+        status = await connection.ping()
+        print(
+            f"Browser daemon is running ({path}): pid={status.pid} "
+            f"sessions={status.sessions - 1} uptime={status.uptime:.0f}s"
+        )
+    connection.terminate()
+    await connection.wait()
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog=f"{sys.executable} -m {MODULE}",
+        description="Manage the long-lived browser used by openconnect-sso --browser-daemon",
+    )
+    parser.add_argument("command", choices=["start", "status", "stop", "serve"])
+    parser.add_argument("--proxy", help="Use a proxy server")
+    parser.add_argument(
+        "--browser-display-mode",
+        "--display-mode",
+        dest="display_mode",
+        choices=["shown", "hidden", "headless"],
+        default="shown",
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        help="Exit after being idle for this many seconds, defaults to %(default)s",
+        type=float,
+        default=DEFAULT_IDLE_TIMEOUT,
+    )
+    args = parser.parse_args(argv)
+
+    structlog.configure(logger_factory=structlog.PrintLoggerFactory(sys.stderr))
+    display_mode = config.DisplayMode[args.display_mode.upper()]
+
+    if args.command == "serve":
+        if display_mode == config.DisplayMode.HEADLESS:
+            headless.configure()
+        from . import webengine_process
+
+        return webengine_process.serve_daemon(
+            socket_path(args.proxy, display_mode),
+            args.proxy,
+            display_mode,
+            args.idle_timeout,
+            _notify_ready,
+        )
+
+    return asyncio.run(
+        _control(args.command, args.proxy, display_mode, args.idle_timeout)
+    )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,41 @@
+"""Settings of the low-memory headless browser
+
+Used with `--browser-display-mode headless`. Pages are rendered offscreen
+without a GPU, all pages share one renderer process and Chromium services not
+needed to log in are turned off. Chromium reads its flags from the
+environment when QtWebEngine starts up, so they are set before Qt is loaded.
+"""
+
+import os
+
+RENDERER_PROCESS_LIMIT = 1
+
+CHROMIUM_FLAGS = [
+    "--disable-gpu",
+    "--disable-gpu-compositing",
+    "--disable-software-rasterizer",
+    "--in-process-gpu",
+    f"--renderer-process-limit={RENDERER_PROCESS_LIMIT}",
+    # Otherwise each site gets a renderer process of its own
+    "--disable-site-isolation-trials",
+    "--disable-features=BackForwardCache,MediaRouter,OptimizationHints",
+    "--disable-background-networking",
+    "--disable-component-update",
+    "--disable-extensions",
+    "--disable-sync",
+    # /dev/shm is small in containers
+    "--disable-dev-shm-usage",
+    "--js-flags=--optimize-for-size",
+]
+
+
+def configure(environ=os.environ):
+    """Set the Chromium flags of the headless browser in `environ`
+
+    Flags already set by the user come last, so they take precedence.
+    """
+    flags = " ".join(CHROMIUM_FLAGS)
+    user_flags = environ.get("QTWEBENGINE_CHROMIUM_FLAGS")
+    environ["QTWEBENGINE_CHROMIUM_FLAGS"] = (
+        f"{flags} {user_flags}" if user_flags else flags
+    )
@@ -0,0 +1,116 @@
+"""Messages exchanged between :class:`Browser` and the browser process
+
+Messages are serialized as length-prefixed JSON frames, so they can be sent
+through any byte stream, e.g. a Unix socket.
+"""
+
+import json
+import struct
+
+import attr
+
+from openconnect_sso import config
+
+_HEADER = struct.Struct(">I")
+
+
+def _to_credentials(value):
+    if isinstance(value, dict):
+        return config.ResolvedCredentials.from_dict(value)
+    return value
+
+
+@attr.s
+class Ready:
+    pass
+
+
+@attr.s
+class Url:
+    url = attr.ib()
+    page = attr.ib(default=0)
+
+
+@attr.s
+class StartupInfo:
+    url = attr.ib()
+    credentials = attr.ib(converter=_to_credentials)
+    page = attr.ib(default=0)
+    # Only this cookie of the host of `login_final_url` is sent back when set
+    token_cookie_name = attr.ib(default=None)
+    login_final_url = attr.ib(default=None)
+    # Name of the identity whose browser profile the page uses
+    identity = attr.ib(default=None)
+
+
+@attr.s
+class SetCookie:
+    name = attr.ib()
+    value = attr.ib()
+    domain = attr.ib(default="")
+    identity = attr.ib(default=None)
+    # Page whose token cookie this is, if any
+    page = attr.ib(default=None)
+
+
+@attr.s
+class Ping:
+    pass
+
+
+@attr.s
+class Pong:
+    pid = attr.ib()
+    sessions = attr.ib()
+    uptime = attr.ib()
+
+
+@attr.s
+class Shutdown:
+    pass
+
+
+MESSAGES = {
+    cls.__name__: cls
+    for cls in (Ready, Url, StartupInfo, SetCookie, Ping, Pong, Shutdown)
+}
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode(message):
+    payload = json.dumps(
+        {"type": type(message).__name__, **attr.asdict(message)},
+        separators=(",", ":"),
+    ).encode()
+    return _HEADER.pack(len(payload)) + payload
+
+
+def decode(payload):
+    try:
+        fields = json.loads(payload)
+        cls = MESSAGES[fields.pop("type")]
+        return cls(**fields)
+    except (ValueError, KeyError, TypeError) as exc:
+        raise ProtocolError(exc) from exc
+
+
+class Decoder:
+    """Incrementally splits a byte stream into messages"""
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        self._buffer += data
+        messages = []
+        while len(self._buffer) >= _HEADER.size:
+            (length,) = _HEADER.unpack_from(self._buffer)
+            end = _HEADER.size + length
+            if len(self._buffer) < end:
+                break
+            messages.append(decode(bytes(self._buffer[_HEADER.size : end])))
+            del self._buffer[:end]
+        return messages
@@ -0,0 +1,72 @@
+"""Resident memory of the browser
+
+QtWebEngine runs Chromium's zygote, renderer and GPU processes as descendants
+of the browser process, so its memory usage is that of the whole process
+tree. It is read from `/proc`, and is not available on other platforms.
+"""
+
+import asyncio
+import os
+from pathlib import Path
+
+SAMPLE_INTERVAL = 0.2  # seconds
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def process_tree(pid, proc="/proc"):
+    """Return `pid` and the IDs of all of its descendants"""
+    children = {}
+    for stat in Path(proc).glob("[0-9]*/stat"):
+        try:
+            content = stat.read_text()
+        except OSError:
+            # The process has exited meanwhile
+            continue
+        # The name of the executable may contain spaces and parentheses
+        fields = content[content.rindex(")") + 2 :].split()
+        children.setdefault(int(fields[1]), []).append(int(stat.parent.name))
+
+    tree = [pid]
+    for parent in tree:
+        tree.extend(children.get(parent, []))
+    return tree
+
+
+def rss(pid, proc="/proc"):
+    """Return the resident memory of `pid` in bytes, 0 if it has exited"""
+    try:
+        statm = (Path(proc) / str(pid) / "statm").read_text()
+    except OSError:
+        return 0
+    return int(statm.split()[1]) * _PAGE_SIZE
+
+
+def tree_rss(pid, proc="/proc"):
+    return sum(rss(p, proc) for p in process_tree(pid, proc))
+
+
+class PeakRss:
+    """Keeps track of the highest resident memory of the process tree of `pid`"""
+
+    def __init__(self, pid, interval=SAMPLE_INTERVAL, proc="/proc"):
+        self.pid = pid
+        self.peak = 0
+        self._interval = interval
+        self._proc = proc
+
+    @staticmethod
+    def supported(proc="/proc"):
+        return (Path(proc) / "self" / "statm").exists()
+
+    def sample(self):
+        self.peak = max(self.peak, tree_rss(self.pid, self._proc))
+        return self.peak
+
+    async def run(self):
+        """Sample until cancelled"""
+        loop = asyncio.get_event_loop()
+        while True:
+            # Reading /proc takes a while with many processes running
+            await loop.run_in_executor(None, self.sample)
+            await asyncio.sleep(self._interval)
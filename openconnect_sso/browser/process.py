@@ -0,0 +1,87 @@
+import asyncio
+import collections
+import multiprocessing
+import multiprocessing.connection
+import socket
+
+from . import headless
+from .ipc import Decoder, StartupInfo, encode
+from ..config import DisplayMode
+
+
+class Process(multiprocessing.Process):
+    def __init__(self, proxy, display_mode, cfg):
+        super().__init__()
+
+        # Messages are exchanged through a socket pair, so that both sides
+        # can wait for them in their event loops instead of polling
+        self._channel, self._child_channel = socket.socketpair()
+        self._decoder = Decoder()
+        self._states = collections.deque()
+        self._exited = None
+        self.proxy = proxy
+        self.display_mode = display_mode
+        self.cfg = cfg
+
+    def start(self):
+        super().start()
+        self._child_channel.close()
+        self._channel.setblocking(False)
+
+    def authenticate_at(
+        self, url, credentials, page=0, token_cookie=(None, None), identity=None
+    ):
+        self._channel.sendall(
+            encode(StartupInfo(url, credentials, page, *token_cookie, identity))
+        )
+
+    async def get_state_async(self):
+        loop = asyncio.get_event_loop()
+        while not self._states:
+            try:
+                data = await loop.sock_recv(self._channel, 65536)
+            except ConnectionError:
+                data = b""
+            if not data:
+                raise EOFError()
+            self._states.extend(self._decoder.feed(data))
+        return self._states.popleft()
+
+    def run(self):
+        if self.display_mode == DisplayMode.HEADLESS:
+            # Read by Chromium when Qt starts it
+            headless.configure()
+        # Qt is only imported in the browser process
+        from . import webengine_process
+
+        self._channel.close()
+        return webengine_process.run(
+            self._child_channel, self.proxy, self.display_mode, self.cfg
+        )
+
+    async def wait(self):
+        if self._exited is None:
+            self._exited = asyncio.ensure_future(self._wait_for_exit())
+        await asyncio.shield(self._exited)
+
+    async def _wait_for_exit(self):
+        loop = asyncio.get_event_loop()
+        exited = loop.create_future()
+
+        def on_exit():
+            if not exited.done():
+                exited.set_result(None)
+
+        try:
+            loop.add_reader(self.sentinel, on_exit)
+        except NotImplementedError:
+            # e.g. ProactorEventLoop on Windows
+            await loop.run_in_executor(
+                None, multiprocessing.connection.wait, [self.sentinel]
+            )
+        else:
+            try:
+                await exited
+            finally:
+                loop.remove_reader(self.sentinel)
+        self.join()
@@ -0,0 +1,46 @@
+"""Decides which requests of the browser are blocked
+
+Used by the request interceptor of the browser process, but kept free of Qt,
+so that the policy can be tested on its own.
+"""
+
+import collections
+
+
+def _matches(host, domains):
+    return any(host == domain or host.endswith("." + domain) for domain in domains)
+
+
+class RequestPolicy:
+    """Applies :class:`config.RequestFilter` and counts the blocked requests"""
+
+    def __init__(self, request_filter):
+        self._resource_types = set(request_filter.block_resource_types)
+        self._block_domains = [
+            d.lower().lstrip(".") for d in request_filter.block_domains
+        ]
+        self._allow_domains = [
+            d.lower().lstrip(".") for d in request_filter.allow_domains
+        ]
+        self.blocked_types = collections.Counter()
+        self.blocked_hosts = collections.Counter()
+
+    def should_block(self, resource_type, host):
+        # Blocking navigation would break the login itself
+        if resource_type == "main_frame":
+            return False
+        host = host.lower()
+        if _matches(host, self._allow_domains):
+            return False
+        if resource_type in self._resource_types or _matches(host, self._block_domains):
+            self.blocked_types[resource_type] += 1
+            self.blocked_hosts[host] += 1
+            return True
+        return False
+
+    def summary(self):
+        return {
+            "blocked": sum(self.blocked_types.values()),
+            "by_type": dict(self.blocked_types.most_common()),
+            "by_host": dict(self.blocked_hosts.most_common(10)),
+        }
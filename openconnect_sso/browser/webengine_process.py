@@ -1,131 +1,485 @@
-import asyncio
-import json
-import multiprocessing
+import functools
+import os
 import signal
 import sys
+import time
 from urllib.parse import urlparse
 
 import attr
 import pkg_resources
 import structlog
 
-from PyQt6.QtCore import QUrl, QTimer, pyqtSlot, Qt
-from PyQt6.QtNetwork import QNetworkCookie, QNetworkProxy
-from PyQt6.QtWebEngineCore import QWebEngineScript, QWebEngineProfile, QWebEnginePage
+from PyQt6.QtCore import QSocketNotifier, QUrl, QTimer, pyqtSlot, Qt
+from PyQt6.QtNetwork import QLocalServer, QNetworkCookie, QNetworkProxy
+from PyQt6.QtWebEngineCore import (
+    QWebEnginePage,
+    QWebEngineProfile,
+    QWebEngineScript,
+    QWebEngineUrlRequestInfo,
+    QWebEngineUrlRequestInterceptor,
+)
 from PyQt6.QtWebEngineWidgets import QWebEngineView
 from PyQt6.QtWidgets import QApplication, QWidget, QSizePolicy, QVBoxLayout
 
 from openconnect_sso import config
+from . import autofill, cookie_store
+from .request_filter import RequestPolicy
+from .ipc import (
+    Decoder,
+    Ping,
+    Pong,
+    Ready,
+    SetCookie,
+    Shutdown,
+    StartupInfo,
+    Url,
+    encode,
+)
 
 
 app = None
-profile = None
+# Browser profiles of identities, the default profile being that of `None`
+profiles = {}
+request_interceptor = None
+# Set when any page has been requested, so cookies may need to be saved
+pages_requested = False
 logger = structlog.get_logger("webengine")
 
 
-@attr.s
-class Url:
-    url = attr.ib()
-
-
 @attr.s
 class Credentials:
     credentials = attr.ib()
 
 
-@attr.s
-class StartupInfo:
-    url = attr.ib()
-    credentials = attr.ib()
-
-
-@attr.s
-class SetCookie:
-    name = attr.ib()
-    value = attr.ib()
+def run(channel, proxy, display_mode, cfg):
+    """Entry point of the browser process started by :class:`process.Process`
+
+    `cfg` is the configuration already loaded by the parent process.
+    """
+    signal.signal(signal.SIGTERM, on_sigterm)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+    force_python_execution = _create_application(  # noqa: F841
+        proxy, display_mode, cfg.request_filter
+    )
+
+    def send(state):
+        channel.sendall(encode(state))
+
+    session = BrowserSession(
+        send,
+        cfg.auto_fill_rules,
+        release_pages=display_mode == config.DisplayMode.HEADLESS,
+    )
+    # Create the first page in advance, while waiting for the parent process
+    session.page(0)
+    send(Ready())
+
+    def on_command(command):
+        if not isinstance(command, StartupInfo):
+            logger.error("Message unrecognized", message=command)
+            return
+
+        logger.info("Browser started", startup_info=command)
+        session.start(command)
+
+    reader = CommandReader(channel, on_command)  # noqa: F841
+    rc = app.exec()
+
+    _log_blocked_requests()
+    logger.info("Exiting browser")
+    return rc
+
+
+def get_profile(identity=None):
+    """Return the browser profile of `identity`, creating it when first used
+
+    Profiles of different identities share nothing but the request filter.
+    """
+    profile = profiles.get(identity)
+    if profile is None:
+        profile = QWebEngineProfile(cookie_store.profile_name(identity))
+        # The default location depends on the name of the executable, which is
+        # different for the browser daemon
+        profile.setPersistentStoragePath(cookie_store.storage_path(identity))
+        if request_interceptor is not None:
+            profile.setUrlRequestInterceptor(request_interceptor)
+        profiles[identity] = profile
+    return profile
+
+
+class BrowserSession:
+    """Pages opened by one :class:`Browser`
+
+    Each page is a separate window, e.g. one for every gateway being logged in
+    to. Pages of the same identity share a profile, so an SSO login made in
+    one page is reused by the others. Pages of different identities are
+    isolated from each other and can log in at the same time.
+    """
+
+    def __init__(self, send, auto_fill_rules, on_page_closed=None, release_pages=False):
+        self._send = send
+        self._on_page_closed = on_page_closed
+        # Whether pages are deleted as soon as their token cookie is set,
+        # which stops their renderer process
+        self._release_pages = release_pages
+        self._auto_fill_rules = auto_fill_rules
+        self._auto_fill_script = None
+        # Identity, name and host of the token cookie of each page, only these
+        # cookies are sent to the parent process
+        self._token_cookies = {}
+        self._send_all_cookies = False
+        # Slots connected to the cookie store of each identity's profile
+        self._cookie_slots = {}
+        self.pages = {}
+
+    def page(self, page_id, identity=None):
+        web = self.pages.get(page_id)
+        if web is not None and web.identity != identity:
+            # e.g. created in advance, before the identity was known
+            self._discard(web)
+            web = None
+        if web is None:
+            if self._auto_fill_script is None:
+                self._auto_fill_script = autofill.get_script(self._auto_fill_rules)
+            web = WebBrowser(
+                self._auto_fill_rules,
+                self._send,
+                self._profile(identity),
+                page_id,
+                self._auto_fill_script,
+                identity,
+            )
+            if self._on_page_closed:
+                web.setAttribute(Qt.WidgetAttribute.WA_DeleteOnClose)
+                web.destroyed.connect(self._on_page_closed)
+            self.pages[page_id] = web
+        return web
+
+    def _profile(self, identity):
+        profile = get_profile(identity)
+        if identity not in self._cookie_slots:
+            slot = functools.partial(self._on_cookie_added, identity)
+            profile.cookieStore().cookieAdded.connect(slot)
+            self._cookie_slots[identity] = slot
+        return profile
+
+    def _discard(self, web):
+        if self._on_page_closed:
+            web.destroyed.disconnect(self._on_page_closed)
+        web.deleteLater()
+
+    def start(self, startup_info):
+        logger.info(
+            "Loading page",
+            url=startup_info.url,
+            page=startup_info.page,
+            identity=startup_info.identity,
+        )
+        web = self.page(startup_info.page, startup_info.identity)
+        if startup_info.token_cookie_name:
+            self._token_cookies[startup_info.page] = (
+                startup_info.identity,
+                startup_info.token_cookie_name,
+                urlparse(startup_info.login_final_url).hostname,
+            )
+        else:
+            self._send_all_cookies = True
+        web.authenticate_at(QUrl(startup_info.url), startup_info.credentials)
+        web.show()
 
+    def close(self):
+        slots, self._cookie_slots = self._cookie_slots, {}
+        for identity, slot in slots.items():
+            profiles[identity].cookieStore().cookieAdded.disconnect(slot)
+        pages, self.pages = self.pages, {}
+        for web in pages.values():
+            web.close()
+
+    def _on_cookie_added(self, identity, cookie):
+        name = to_str(cookie.name())
+        logger.debug("Cookie set", name=name, domain=cookie.domain(), identity=identity)
+        # Pages logging in to the same host wait for the same cookie, it is the
+        # token of the one which started first
+        page_id = next(
+            (
+                page_id
+                for page_id, (*token, host) in self._token_cookies.items()
+                if token == [identity, name]
+                and cookie_store.domain_matches(host, cookie.domain())
+            ),
+            None,
+        )
+        if page_id is None and not self._send_all_cookies:
+            return
 
-class Process(multiprocessing.Process):
-    def __init__(self, proxy, display_mode):
+        self._send(
+            SetCookie(name, to_str(cookie.value()), cookie.domain(), identity, page_id)
+        )
+        if page_id is not None:
+            logger.info("Token cookie set", name=name, page=page_id)
+            del self._token_cookies[page_id]
+            # The rest of the final page is not needed anymore
+            if self._release_pages:
+                self._discard(self.pages.pop(page_id))
+            else:
+                self.pages[page_id].stop()
+
+
+class CommandReader:
+    """Dispatches messages received from the parent process in the Qt event loop"""
+
+    def __init__(self, channel, on_command):
+        self._channel = channel
+        self._decoder = Decoder()
+        self._on_command = on_command
+        self._notifier = QSocketNotifier(channel.fileno(), QSocketNotifier.Type.Read)
+        self._notifier.activated.connect(self._on_activated)
+
+    def _on_activated(self):
+        data = self._channel.recv(65536)
+        if not data:
+            logger.info("Parent process closed the connection")
+            self._notifier.setEnabled(False)
+            on_sigterm(None, None)
+            return
+        for command in self._decoder.feed(data):
+            self._on_command(command)
+
+
+def _create_application(proxy, display_mode, request_filter):
+    # To work around funky GC conflicts with C++ code by ensuring QApplication terminates last
+    global app
+    global request_interceptor
+
+    argv = sys.argv.copy()
+    if display_mode == config.DisplayMode.HIDDEN:
+        argv += ["-platform", "minimal"]
+    elif display_mode == config.DisplayMode.HEADLESS:
+        # Renders without a window system or GPU, see `headless`
+        argv += ["-platform", "offscreen"]
+    app = QApplication(argv)
+
+    if request_filter.is_enabled(display_mode):
+        request_interceptor = RequestInterceptor(RequestPolicy(request_filter))
+    # Profiles of identities are only created when they are used
+    get_profile()
+
+    if proxy:
+        parsed = urlparse(proxy)
+        if parsed.scheme.startswith("socks5"):
+            proxy_type = QNetworkProxy.Socks5Proxy
+        elif parsed.scheme.startswith("http"):
+            proxy_type = QNetworkProxy.HttpProxy
+        else:
+            raise ValueError("Unsupported proxy type", parsed.scheme)
+        proxy = QNetworkProxy(proxy_type, parsed.hostname, parsed.port)
+
+        QNetworkProxy.setApplicationProxy(proxy)
+
+    # In order to make Python able to handle signals
+    force_python_execution = QTimer()
+    force_python_execution.start(200)
+
+    def ignore():
+        pass
+
+    force_python_execution.timeout.connect(ignore)
+    return force_python_execution
+
+
+_ResourceType = QWebEngineUrlRequestInfo.ResourceType
+RESOURCE_TYPES = {
+    _ResourceType.ResourceTypeMainFrame: "main_frame",
+    _ResourceType.ResourceTypeSubFrame: "sub_frame",
+    _ResourceType.ResourceTypeStylesheet: "stylesheet",
+    _ResourceType.ResourceTypeScript: "script",
+    _ResourceType.ResourceTypeImage: "image",
+    _ResourceType.ResourceTypeFontResource: "font",
+    _ResourceType.ResourceTypeSubResource: "sub_resource",
+    _ResourceType.ResourceTypeObject: "object",
+    _ResourceType.ResourceTypeMedia: "media",
+    _ResourceType.ResourceTypeWorker: "worker",
+    _ResourceType.ResourceTypeSharedWorker: "shared_worker",
+    _ResourceType.ResourceTypePrefetch: "prefetch",
+    _ResourceType.ResourceTypeFavicon: "favicon",
+    _ResourceType.ResourceTypeXhr: "xhr",
+    _ResourceType.ResourceTypePing: "ping",
+    _ResourceType.ResourceTypeServiceWorker: "service_worker",
+    _ResourceType.ResourceTypeCspReport: "csp_report",
+    _ResourceType.ResourceTypePluginResource: "plugin",
+    _ResourceType.ResourceTypeNavigationPreloadMainFrame: "main_frame",
+    _ResourceType.ResourceTypeNavigationPreloadSubFrame: "sub_frame",
+}
+
+
+class RequestInterceptor(QWebEngineUrlRequestInterceptor):
+    """Blocks requests which are not needed to log in, see :class:`RequestPolicy`"""
+
+    def __init__(self, policy):
         super().__init__()
+        self.policy = policy
+
+    def interceptRequest(self, info):
+        resource_type = RESOURCE_TYPES.get(info.resourceType(), "unknown")
+        url = info.requestUrl()
+        if self.policy.should_block(resource_type, url.host()):
+            logger.debug(
+                "Request blocked", type=resource_type, host=url.host(), path=url.path()
+            )
+            info.block(True)
+
+
+def _log_blocked_requests():
+    # The size of blocked responses is unknown, as they are never requested
+    if request_interceptor is not None:
+        logger.info("Requests blocked", **request_interceptor.policy.summary())
+
+
+def serve_daemon(path, proxy, display_mode, idle_timeout, on_ready):
+    """Run a long-lived browser serving authentication jobs on a Unix socket
+
+    The process exits after `idle_timeout` seconds without connected clients.
+    """
+    signal.signal(signal.SIGTERM, on_sigterm)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+    force_python_execution = _create_application(  # noqa: F841
+        proxy, display_mode, config.load().request_filter
+    )
+    app.setQuitOnLastWindowClosed(False)
+
+    server = DaemonServer(
+        path, idle_timeout, release_pages=display_mode == config.DisplayMode.HEADLESS
+    )
+    if not server.listen():
+        on_ready()
+        return 1
+    on_ready()
+
+    logger.info("Browser daemon started", path=path, idle_timeout=idle_timeout)
+    rc = app.exec()
+    _log_blocked_requests()
+    logger.info("Exiting browser daemon")
+    return rc
+
+
+class DaemonServer:
+    def __init__(self, path, idle_timeout, release_pages=False):
+        self._path = path
+        self.release_pages = release_pages
+        self._server = QLocalServer()
+        self._server.setSocketOptions(QLocalServer.SocketOption.UserAccessOption)
+        self._server.newConnection.connect(self._on_new_connection)
+        self._sessions = set()
+        self._started = time.monotonic()
+        self._idle_timer = QTimer()
+        self._idle_timer.setSingleShot(True)
+        self._idle_timer.setInterval(int(idle_timeout * 1000))
+        self._idle_timer.timeout.connect(self._on_idle)
+
+    def listen(self):
+        QLocalServer.removeServer(self._path)
+        if not self._server.listen(self._path):
+            logger.error(
+                "Cannot listen on browser daemon socket",
+                path=self._path,
+                error=self._server.errorString(),
+            )
+            return False
+        self._idle_timer.start()
+        return True
+
+    def status(self):
+        return Pong(
+            pid=os.getpid(),
+            sessions=len(self._sessions),
+            uptime=time.monotonic() - self._started,
+        )
 
-        self._commands = multiprocessing.Queue()
-        self._states = multiprocessing.Queue()
-        self.proxy = proxy
-        self.display_mode = display_mode
+    def shutdown(self):
+        logger.info("Shutting down browser daemon")
+        self._idle_timer.stop()
+        self._server.close()
+        for session in list(self._sessions):
+            session.close()
+        on_sigterm(None, None)
+
+    def _on_new_connection(self):
+        while self._server.hasPendingConnections():
+            self._idle_timer.stop()
+            self._sessions.add(
+                DaemonSession(self, self._server.nextPendingConnection())
+            )
 
-    def authenticate_at(self, url, credentials):
-        self._commands.put(StartupInfo(url, credentials))
-
-    async def get_state_async(self):
-        while self.is_alive():
-            try:
-                return self._states.get_nowait()
-            except multiprocessing.queues.Empty:
-                await asyncio.sleep(0.01)
-        if not self.is_alive():
-            raise EOFError()
-
-    def run(self):
-        # To work around funky GC conflicts with C++ code by ensuring QApplication terminates last
-        global app
-        global profile
-
-        signal.signal(signal.SIGTERM, on_sigterm)
-        signal.signal(signal.SIGINT, signal.SIG_DFL)
-
-        cfg = config.load()
-
-        argv = sys.argv.copy()
-        if self.display_mode == config.DisplayMode.HIDDEN:
-            argv += ["-platform", "minimal"]
-        app = QApplication(argv)
-        profile = QWebEngineProfile("openconnect-sso")
-
-        if self.proxy:
-            parsed = urlparse(self.proxy)
-            if parsed.scheme.startswith("socks5"):
-                proxy_type = QNetworkProxy.Socks5Proxy
-            elif parsed.scheme.startswith("http"):
-                proxy_type = QNetworkProxy.HttpProxy
+    def _on_session_closed(self, session):
+        self._sessions.discard(session)
+        if not self._sessions and self._server.isListening():
+            self._idle_timer.start()
+
+    def _on_idle(self):
+        logger.info("Browser daemon is idle")
+        self.shutdown()
+
+
+class DaemonSession:
+    """Serves one :class:`Browser` connected to the daemon"""
+
+    def __init__(self, server, connection):
+        self._server = server
+        self._connection = connection
+        self._decoder = Decoder()
+        # Loaded for every client, as the configuration may have changed since
+        # the daemon started. It is only parsed again if it did.
+        self._browser = BrowserSession(
+            self.send,
+            config.load().auto_fill_rules,
+            self._on_window_destroyed,
+            server.release_pages,
+        )
+        connection.readyRead.connect(self._on_ready_read)
+        connection.disconnected.connect(self.close)
+
+    def send(self, message):
+        if self._connection is None:
+            return
+        self._connection.write(encode(message))
+        self._connection.flush()
+
+    def close(self):
+        if self._connection is None:
+            return
+        connection, self._connection = self._connection, None
+        self._browser.close()
+        connection.disconnectFromServer()
+        connection.deleteLater()
+        self._server._on_session_closed(self)
+
+    def _on_ready_read(self):
+        for message in self._decoder.feed(bytes(self._connection.readAll())):
+            if isinstance(message, StartupInfo):
+                self._browser.start(message)
+            elif isinstance(message, Ping):
+                self.send(self._server.status())
+            elif isinstance(message, Shutdown):
+                self._server.shutdown()
             else:
-                raise ValueError("Unsupported proxy type", parsed.scheme)
-            proxy = QNetworkProxy(proxy_type, parsed.hostname, parsed.port)
-
-            QNetworkProxy.setApplicationProxy(proxy)
+                logger.error("Message unrecognized", message=message)
+            if self._connection is None:
+                return
 
-        # In order to make Python able to handle signals
-        force_python_execution = QTimer()
-        force_python_execution.start(200)
-
-        def ignore():
-            pass
-
-        force_python_execution.timeout.connect(ignore)
-        web = WebBrowser(cfg.auto_fill_rules, self._states.put, profile)
-
-        startup_info = self._commands.get()
-        logger.info("Browser started", startup_info=startup_info)
-
-        logger.info("Loading page", url=startup_info.url)
-
-        web.authenticate_at(QUrl(startup_info.url), startup_info.credentials)
-
-        web.show()
-        rc = app.exec()
-
-        logger.info("Exiting browser")
-        return rc
-
-    async def wait(self):
-        while self.is_alive():
-            await asyncio.sleep(0.01)
-        self.join()
+    def _on_window_destroyed(self):
+        # Closing any of the windows aborts the login
+        self.close()
 
 
 def on_sigterm(signum, frame):
-    global profile
     logger.info("Terminate requested.")
+    if not pages_requested:
+        # e.g. the browser was started in advance but turned out to be unneeded
+        QApplication.quit()
+        return
+
     # Force flush cookieStore to disk. Without this hack the cookieStore may
     # not be synced at all if the browser lives only for a short amount of
     # time. Something is off with the call order of destructors as there is no
@@ -133,7 +487,8 @@ def on_sigterm(signum, frame):
 
     # See: https://github.com/qutebrowser/qutebrowser/commit/8d55d093f29008b268569cdec28b700a8c42d761
     cookie = QNetworkCookie()
-    profile.cookieStore().deleteCookie(cookie)
+    for profile in profiles.values():
+        profile.cookieStore().deleteCookie(cookie)
 
     # Give some time to actually save cookies
     exit_timer = QTimer(app)
@@ -142,14 +497,26 @@ def on_sigterm(signum, frame):
 
 
 class WebBrowser(QWebEngineView):
-    def __init__(self, auto_fill_rules, on_update, profile):
+    def __init__(
+        self,
+        auto_fill_rules,
+        on_update,
+        profile,
+        page_id=0,
+        auto_fill_script=None,
+        identity=None,
+    ):
         super().__init__()
+        self.identity = identity
         self._on_update = on_update
         self._auto_fill_rules = auto_fill_rules
+        self._auto_fill_script = auto_fill_script
+        self._page_id = page_id
+        self._credentials = None
+        self._credentials_script = None
         page = QWebEnginePage(profile, self)
         self.setPage(page)
-        cookie_store = self.page().profile().cookieStore()
-        cookie_store.cookieAdded.connect(self._on_cookie_added)
+        self.page().loadStarted.connect(self._update_credentials_script)
         self.page().loadFinished.connect(self._on_load_finished)
 
     def createWindow(self, type):
@@ -158,6 +525,9 @@ class WebBrowser(QWebEngineView):
             return self._popupWindow.view()
 
     def authenticate_at(self, url, credentials):
+        global pages_requested
+        pages_requested = True
+
         script_source = pkg_resources.resource_string(__name__, "user.js").decode()
         script = QWebEngineScript()
         script.setInjectionPoint(QWebEngineScript.InjectionPoint.DocumentCreation)
@@ -167,36 +537,41 @@ class WebBrowser(QWebEngineView):
 
         if credentials:
             logger.info("Initiating autologin", cred=credentials)
-            for url_pattern, rules in self._auto_fill_rules.items():
-                script = QWebEngineScript()
-                script.setInjectionPoint(QWebEngineScript.InjectionPoint.DocumentReady)
-                script.setWorldId(QWebEngineScript.ScriptWorldId.ApplicationWorld)
-                script.setSourceCode(
-                    f"""
-// ==UserScript==
-// @include {url_pattern}
-// ==/UserScript==
-
-function autoFill() {{
-    {get_selectors(rules, credentials)}
-    setTimeout(autoFill, 1000);
-}}
-autoFill();
-"""
-                )
-                self.page().scripts().insert(script)
+            if self._auto_fill_script is None:
+                self._auto_fill_script = autofill.get_script(self._auto_fill_rules)
+
+            # Credentials are kept out of the cached script of the rules
+            self._credentials = credentials
+            self._update_credentials_script()
+
+            script = QWebEngineScript()
+            script.setInjectionPoint(QWebEngineScript.InjectionPoint.DocumentReady)
+            script.setWorldId(QWebEngineScript.ScriptWorldId.ApplicationWorld)
+            script.setSourceCode(self._auto_fill_script)
+            self.page().scripts().insert(script)
 
         self.load(QUrl(url))
 
-    def _on_cookie_added(self, cookie):
-        logger.debug("Cookie set", name=to_str(cookie.name()))
-        self._on_update(SetCookie(to_str(cookie.name()), to_str(cookie.value())))
+    def _update_credentials_script(self):
+        # Replaced on every page load, so that TOTP codes are always current
+        if self._credentials is None:
+            return
+        if self._credentials_script is not None:
+            self.page().scripts().remove(self._credentials_script)
+        script = QWebEngineScript()
+        script.setInjectionPoint(QWebEngineScript.InjectionPoint.DocumentCreation)
+        script.setWorldId(QWebEngineScript.ScriptWorldId.ApplicationWorld)
+        script.setSourceCode(
+            autofill.get_credentials_script(self._auto_fill_rules, self._credentials)
+        )
+        self.page().scripts().insert(script)
+        self._credentials_script = script
 
     def _on_load_finished(self, success):
         url = self.page().url().toString()
-        logger.debug("Page loaded", url=url)
+        logger.debug("Page loaded", url=url, page=self._page_id)
 
-        self._on_update(Url(url))
+        self._on_update(Url(url, self._page_id))
 
 
 class WebPopupWindow(QWidget):
@@ -232,30 +607,3 @@ class WebPopupWindow(QWidget):
 
 def to_str(qval):
     return bytes(qval).decode()
-
-
-def get_selectors(rules, credentials):
-    statements = []
-    for rule in rules:
-        selector = json.dumps(rule.selector)
-        if rule.action == "stop":
-            statements.append(
-                f"""var elem = document.querySelector({selector}); if (elem) {{ return; }}"""
-            )
-        elif rule.fill:
-            value = json.dumps(getattr(credentials, rule.fill, None))
-            if value:
-                statements.append(
-                    f"""var elem = document.querySelector({selector}); if (elem) {{ elem.dispatchEvent(new Event("focus")); elem.value = {value}; elem.dispatchEvent(new Event("blur")); }}"""
-                )
-            else:
-                logger.warning(
-                    "Credential info not available",
-                    type=rule.fill,
-                    possibilities=dir(credentials),
-                )
-        elif rule.action == "click":
-            statements.append(
-                f"""var elem = document.querySelector({selector}); if (elem) {{ elem.dispatchEvent(new Event("focus")); elem.click(); }}"""
-            )
-    return "\n".join(statements)
@@ -7,7 +7,7 @@ import os
 import sys
 
 import openconnect_sso
-from openconnect_sso import app, config, __version__
+from openconnect_sso import __version__
 
 
 def create_argparser():
@@ -32,6 +32,14 @@ def create_argparser():
         default=False,
     )
 
+    server_settings.add_argument(
+        "--fastest",
+        help="Measure the latency of each gateway in the profile and connect to the fastest one. "
+        "Results are reused for 10 minutes",
+        action="store_true",
+        default=False,
+    )
+
     server_settings.add_argument("--proxy", help="Use a proxy server")
 
     server_settings.add_argument(
@@ -39,7 +47,10 @@ def create_argparser():
         "--server",
         help="VPN server to connect to. The following forms are accepted: "
         "vpn.server.com, vpn.server.com/usergroup, "
-        "https://vpn.server.com, https.vpn.server.com.usergroup",
+        "https://vpn.server.com, https.vpn.server.com.usergroup. "
+        "Can be given multiple times together with --authenticate json, "
+        "to log in to several servers with a single SSO login",
+        action="append",
     )
 
     auth_settings = parser.add_argument_group(
@@ -70,15 +81,49 @@ def create_argparser():
         default=False,
     )
 
+    auth_settings.add_argument(
+        "--session-cache-lifetime",
+        help="Reuse the session token of a previous login for this many seconds instead of opening the browser again. Sessions printed with --authenticate are reused as well, even if another openconnect has already logged them out. Disabled by default",
+        type=int,
+        metavar="SECONDS",
+        default=0,
+    )
+
     parser.add_argument(
         "--browser-display-mode",
-        help="Controls how the browser window is displayed. 'hidden' mode only works with saved credentials. Choices: {%(choices)s}",
-        choices=["shown", "hidden"],
+        help="Controls how the browser window is displayed. 'hidden' mode only works with saved credentials, 'headless' is the same using as little memory as possible. Choices: {%(choices)s}",
+        choices=["shown", "hidden", "headless"],
         metavar="DISPLAY-MODE",
         nargs="?",
         default="shown",
     )
 
+    parser.add_argument(
+        "--browser-daemon",
+        help="Authenticate using a long-lived browser process which is reused by subsequent runs. "
+        "It is started on demand and exits after being idle for a while. "
+        "It can also be managed by running `python -m openconnect_sso.browser.daemon`",
+        action="store_true",
+        default=False,
+    )
+
+    parser.add_argument(
+        "--sso-replay",
+        help="Try to log in with plain HTTP requests first, reusing the identity provider "
+        "session of previous logins. The browser is only started if the identity "
+        "provider asks for input",
+        action="store_true",
+        default=False,
+    )
+
+    parser.add_argument(
+        "--reconnect",
+        help="Restart openconnect when the connection is lost, logging in again if "
+        "the session has ended. Gives up after repeated failures",
+        action="store_true",
+        default=False,
+    )
+
     parser.add_argument(
         "--on-disconnect",
         help="Command to run when disconnecting from VPN server",
@@ -95,6 +140,19 @@ def create_argparser():
         default="4.7.00136",
     )
 
+    parser.add_argument(
+        "--metrics-json",
+        help="Append the duration of each phase of the login to this file as JSON lines",
+        metavar="FILE",
+    )
+
+    parser.add_argument(
+        "--metrics-prometheus",
+        help="Write the duration of each phase of the login to this file for the "
+        "textfile collector of the Prometheus node exporter",
+        metavar="FILE",
+    )
+
     parser.add_argument(
         "-l",
         "--log-level",
@@ -115,6 +173,13 @@ def create_argparser():
     credentials_group.add_argument(
         "-u", "--user", help="Authenticate as the given user", default=None
     )
+    credentials_group.add_argument(
+        "-i",
+        "--identity",
+        help="Authenticate as the named identity of the configuration file, "
+        "which has a browser profile of its own",
+        default=None,
+    )
     return parser
 
 
@@ -152,14 +217,24 @@ def main():
     parser = create_argparser()
     args = parser.parse_args()
 
-    if (args.profile_path or args.use_profile_selector) and (
+    # Imported only now, so that e.g. --help and --version return quickly
+    from openconnect_sso import app, config
+
+    if (args.profile_path or args.use_profile_selector or args.fastest) and (
         args.server or args.usergroup
     ):
         parser.error(
-            "--profile/--profile-selector and --server/--usergroup are mutually exclusive"
+            "--profile/--profile-selector/--fastest and --server/--usergroup are mutually exclusive"
         )
 
-    if not args.profile_path and not args.server and not config.load().default_profile:
+    if args.server and len(args.server) > 1 and args.authenticate != "json":
+        parser.error("Multiple --server arguments require --authenticate json")
+
+    if args.fastest and args.proxy:
+        parser.error("--fastest cannot measure gateway latency through --proxy")
+
+    cfg = config.load()
+    if not args.profile_path and not args.server and not cfg.default_profile:
         if os.path.exists("/opt/cisco/anyconnect/profile"):
             args.profile_path = "/opt/cisco/anyconnect/profile"
         else:
@@ -167,12 +242,16 @@ def main():
                 "No AnyConnect profile can be found. One of --profile or --server arguments required."
             )
 
-    if args.use_profile_selector and not args.profile_path:
+    if args.fastest and not args.profile_path:
+        if os.path.exists("/opt/cisco/anyconnect/profile"):
+            args.profile_path = "/opt/cisco/anyconnect/profile"
+
+    if (args.use_profile_selector or args.fastest) and not args.profile_path:
         parser.error(
             "No AnyConnect profile can be found. --profile argument is required."
         )
 
-    return app.run(args)
+    return app.run(args, cfg)
 
 
 if __name__ == "__main__":
@@ -1,4 +1,9 @@
+import copy
 import enum
+import os
+import re
+import tempfile
+import time
 from pathlib import Path
 from urllib.parse import urlparse, urlunparse
 
@@ -14,17 +19,45 @@ logger = structlog.get_logger()
 
 APP_NAME = "openconnect-sso"
 
+# Secrets read from the keyring are reused for this long, in seconds
+SECRETS_CACHE_TTL = 300
+
+# Password and TOTP secret of each user name, with the time they expire
+_secrets_cache = {}
+
+# Names of identities are used in file names of their browser profiles
+_IDENTITY_NAME = re.compile(r"^[A-Za-z0-9_-]+$")
+
+# Identity of the configuration file as last loaded or saved, and its contents
+# as returned by `Config.as_dict`
+_snapshot = None
+
+
+def _file_key(path):
+    try:
+        stat = path.stat()
+    except OSError:
+        return None
+    return str(path), stat.st_ino, stat.st_mtime_ns, stat.st_size
+
 
 def load():
+    """Return the configuration, only parsing the file again if it changed"""
+    global _snapshot
+
     path = xdg.BaseDirectory.load_first_config(APP_NAME)
     if not path:
         return Config()
     config_path = Path(path) / "config.toml"
-    if not config_path.exists():
+    key = _file_key(config_path)
+    if key is None:
         return Config()
+    if _snapshot is not None and _snapshot[0] == key:
+        return Config.from_dict(copy.deepcopy(_snapshot[1]))
+
     with config_path.open() as config_file:
         try:
-            return Config.from_dict(toml.load(config_file))
+            config = Config.from_dict(toml.load(config_file))
         except Exception:
             logger.error(
                 "Could not load configuration file, ignoring",
@@ -32,19 +65,43 @@ def load():
                 exc_info=True,
             )
             return Config()
+    _snapshot = key, config.as_dict()
+    return config
 
 
 def save(config):
+    """Write the configuration unless it is the same as the one on disk
+
+    The file is replaced atomically, so that concurrent runs never read a
+    partially written one.
+    """
+    global _snapshot
+
     path = xdg.BaseDirectory.save_config_path(APP_NAME)
     config_path = Path(path) / "config.toml"
+    data = config.as_dict()
+    key = _file_key(config_path)
+    if _snapshot is not None and _snapshot == (key, data):
+        logger.debug("Configuration unchanged, not saving", path=config_path)
+        return
+
     try:
-        config_path.touch()
-        with config_path.open("w") as config_file:
-            toml.dump(config.as_dict(), config_file)
+        fd, tmp_path = tempfile.mkstemp(dir=path, prefix=".config.toml-")
+        try:
+            with os.fdopen(fd, "w") as config_file:
+                toml.dump(data, config_file)
+            if key is not None:
+                os.chmod(tmp_path, config_path.stat().st_mode & 0o777)
+            os.replace(tmp_path, config_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
     except Exception:
         logger.error(
             "Could not save configuration file", path=config_path, exc_info=True
         )
+        return
+    _snapshot = _file_key(config_path), data
 
 
 @attr.s
@@ -103,17 +160,71 @@ def get_default_auto_fill_rules():
     }
 
 
+def get_default_blocked_domains():
+    return [
+        "google-analytics.com",
+        "googletagmanager.com",
+        "doubleclick.net",
+        "browser.events.data.microsoft.com",
+        "dc.services.visualstudio.com",
+        "clarity.ms",
+    ]
+
+
+@attr.s
+class RequestFilter(ConfigNode):
+    """Requests not needed to log in, which the browser does not make
+
+    `enabled` is one of "hidden" (only with hidden or headless browser display
+    mode), "always" or "never". Navigation of the main frame is never blocked, and
+    hosts under `allow_domains` are never blocked at all.
+    """
+
+    enabled = attr.ib(default="hidden")
+    block_resource_types = attr.ib(
+        factory=lambda: [
+            "image",
+            "font",
+            "media",
+            "favicon",
+            "ping",
+            "prefetch",
+            "csp_report",
+        ]
+    )
+    block_domains = attr.ib(factory=get_default_blocked_domains)
+    allow_domains = attr.ib(factory=list)
+
+    def is_enabled(self, display_mode):
+        if self.enabled == "hidden":
+            return display_mode != DisplayMode.SHOWN
+        return self.enabled == "always"
+
+
 @attr.s
 class Credentials(ConfigNode):
+    """A user name whose secrets are stored in the keyring
+
+    Secrets are fetched together when first needed and cached in memory for
+    `SECRETS_CACHE_TTL` seconds, as keyring lookups can be slow or prompt to
+    unlock the keyring.
+    """
+
     username = attr.ib()
 
+    def resolve(self):
+        """Return the credentials along with their secrets"""
+        now = time.monotonic()
+        cached = _secrets_cache.get(self.username)
+        if cached is None or cached[0] <= now:
+            cached = (now + SECRETS_CACHE_TTL, *_fetch_secrets(self.username))
+            _secrets_cache[self.username] = cached
+        _, password, totp_secret = cached
+        return ResolvedCredentials(self.username, password, totp_secret)
+
     @property
     def password(self):
-        try:
-            return keyring.get_password(APP_NAME, self.username)
-        except keyring.errors.KeyringError:
-            logger.info("Cannot retrieve saved password from keyring.")
-            return ""
+        return self.resolve().password
 
     @password.setter
     def password(self, value):
@@ -121,15 +232,11 @@ class Credentials(ConfigNode):
             keyring.set_password(APP_NAME, self.username, value)
         except keyring.errors.KeyringError:
             logger.info("Cannot save password to keyring.")
+        self._cache(password=value)
 
     @property
     def totp(self):
-        try:
-            totpsecret = keyring.get_password(APP_NAME, "totp/" + self.username)
-            return pyotp.TOTP(totpsecret).now() if totpsecret else None
-        except keyring.errors.KeyringError:
-            logger.info("Cannot retrieve saved totp info from keyring.")
-            return ""
+        return self.resolve().totp
 
     @totp.setter
     def totp(self, value):
@@ -137,6 +244,80 @@ class Credentials(ConfigNode):
             keyring.set_password(APP_NAME, "totp/" + self.username, value)
         except keyring.errors.KeyringError:
             logger.info("Cannot save totp secret to keyring.")
+        self._cache(totp_secret=value)
+
+    def _cache(self, **secrets):
+        resolved = attr.evolve(self.resolve(), **secrets)
+        _secrets_cache[self.username] = (
+            time.monotonic() + SECRETS_CACHE_TTL,
+            resolved.password,
+            resolved.totp_secret,
+        )
+
+
+def _fetch_secrets(username):
+    password = ""
+    totp_secret = None
+    try:
+        password = keyring.get_password(APP_NAME, username)
+    except keyring.errors.KeyringError:
+        logger.info("Cannot retrieve saved password from keyring.")
+    else:
+        try:
+            totp_secret = keyring.get_password(APP_NAME, "totp/" + username)
+        except keyring.errors.KeyringError:
+            logger.info("Cannot retrieve saved totp info from keyring.")
+    return password, totp_secret
+
+
+@attr.s(frozen=True)
+class ResolvedCredentials(ConfigNode):
+    """:class:`Credentials` with their secrets, which never touches the keyring
+
+    This is what the browser process receives. TOTP codes are generated from
+    the secret whenever they are read.
+    """
+
+    username = attr.ib()
+    password = attr.ib(default=None, repr=False)
+    totp_secret = attr.ib(default=None, repr=False)
+
+    def resolve(self):
+        return self
+
+    @property
+    def totp(self):
+        return pyotp.TOTP(self.totp_secret).now() if self.totp_secret else None
+
+
+def check_identity_name(name):
+    if not _IDENTITY_NAME.match(name):
+        raise ValueError(f"Invalid identity name: {name!r}")
+    return name
+
+
+@attr.s
+class Identity(ConfigNode):
+    """A user with a browser profile of its own
+
+    Cookies of each identity are stored apart from those of the others, so
+    that several identities can be logged in at the same time.
+    """
+
+    username = attr.ib(default=None)
+
+    @property
+    def credentials(self):
+        return Credentials(self.username) if self.username else None
+
+
+def _to_identities(identities):
+    return {
+        check_identity_name(name): identity
+        if isinstance(identity, Identity)
+        else Identity.from_dict(identity)
+        for name, identity in identities.items()
+    }
 
 
 @attr.s
@@ -150,8 +331,18 @@ class Config(ConfigNode):
         },
     )
     on_disconnect = attr.ib(converter=str, default="")
+    request_filter = attr.ib(
+        factory=RequestFilter,
+        converter=lambda d: RequestFilter.from_dict(d) if isinstance(d, dict) else d,
+    )
+    identities = attr.ib(factory=dict, converter=_to_identities)
+    # How to log in at identity providers, by URL pattern of the login page:
+    # "browser" (the default) or "form" for plain HTML forms
+    login_backends = attr.ib(factory=dict)
 
 
 class DisplayMode(enum.Enum):
     HIDDEN = 0
     SHOWN = 1
+    # Hidden, using as little memory as possible, see `browser.headless`
+    HEADLESS = 2
@@ -0,0 +1,230 @@
+"""Timing of the phases of a login
+
+Each phase is recorded as a :class:`Span`, logged when it finishes and
+optionally exported as JSON lines or in the format of the Prometheus
+node_exporter textfile collector. Measurements other than durations, e.g. the
+memory used by the browser, are recorded as a :class:`Gauge`.
+"""
+
+import collections
+import contextlib
+import itertools
+import json
+import os
+import tempfile
+import time
+from pathlib import Path
+
+import attr
+import structlog
+
+logger = structlog.get_logger()
+
+PREFIX = "openconnect_sso"
+
+# Long-running processes, e.g. the auth broker or --reconnect, record
+# measurements for every login. Only the most recent ones are kept.
+MAX_RECORDS = 1000
+
+_spans = collections.deque(maxlen=MAX_RECORDS)
+_gauges = collections.deque(maxlen=MAX_RECORDS)
+
+# Measurements are numbered in the order they are recorded, so that JSON lines
+# files only get the ones not written to them yet
+_sequence = itertools.count(1)
+_written = {}
+
+
+@attr.s
+class Span:
+    phase = attr.ib()
+    labels = attr.ib(factory=dict)
+    timestamp = attr.ib(factory=time.time)
+    started = attr.ib(factory=time.perf_counter, repr=False)
+    duration = attr.ib(default=None)
+    error = attr.ib(default=None)
+    sequence = attr.ib(default=0, init=False, repr=False, eq=False)
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def finish(self, error=None, **labels):
+        if self.duration is not None:
+            return
+        self.duration = time.perf_counter() - self.started
+        self.error = error
+        self.labels.update(labels)
+        self.sequence = next(_sequence)
+        _spans.append(self)
+        logger.info(
+            "Phase finished",
+            phase=self.phase,
+            duration_ms=round(self.duration * 1000, 1),
+            error=error,
+            **self.labels,
+        )
+
+
+@attr.s
+class Gauge:
+    name = attr.ib()
+    value = attr.ib()
+    labels = attr.ib(factory=dict)
+    timestamp = attr.ib(factory=time.time)
+    sequence = attr.ib(factory=lambda: next(_sequence), repr=False, eq=False)
+
+
+def gauge(name, value, **labels):
+    """Record the measurement `value` of `name`"""
+    g = Gauge(name, value, labels)
+    _gauges.append(g)
+    logger.info("Measured", metric=name, value=value, **labels)
+    return g
+
+
+def start(phase, **labels):
+    return Span(phase, labels)
+
+
+@contextlib.contextmanager
+def span(phase, **labels):
+    """Time the enclosed block, exceptions are recorded as failures"""
+    s = start(phase, **labels)
+    try:
+        yield s
+    except BaseException as exc:
+        s.finish(error=type(exc).__name__)
+        raise
+    s.finish(error=s.error)
+
+
+def spans():
+    return list(_spans)
+
+
+def gauges():
+    return list(_gauges)
+
+
+def reset():
+    _spans.clear()
+    _gauges.clear()
+    _written.clear()
+
+
+def export(json_lines=None, prometheus=None):
+    """Write the metrics recorded so far to the given files, if any
+
+    Called after each login and again on exit, errors are only logged.
+    """
+    try:
+        if json_lines:
+            write_json_lines(json_lines)
+        if prometheus:
+            write_prometheus(prometheus)
+    except OSError:
+        logger.warn("Could not write metrics", exc_info=True)
+
+
+def write_json_lines(path, spans=None, gauges=None):
+    """Append one JSON object per finished span and per gauge to `path`
+
+    By default, only the measurements not yet written to `path` are appended.
+    """
+    written = _written.get(str(path), 0)
+    if spans is None:
+        spans = [s for s in _spans if s.sequence > written]
+    if gauges is None:
+        gauges = [g for g in _gauges if g.sequence > written]
+    latest = max((r.sequence for r in (*_spans, *_gauges)), default=written)
+    with Path(path).open("a") as f:
+        for s in spans:
+            f.write(
+                json.dumps(
+                    {
+                        "timestamp": s.timestamp,
+                        "phase": s.phase,
+                        "duration": s.duration,
+                        "ok": s.ok,
+                        "error": s.error,
+                        **s.labels,
+                    }
+                )
+                + "\n"
+            )
+        for g in gauges:
+            f.write(
+                json.dumps(
+                    {
+                        "timestamp": g.timestamp,
+                        "metric": g.name,
+                        "value": g.value,
+                        **g.labels,
+                    }
+                )
+                + "\n"
+            )
+
+    _written[str(path)] = latest
+
+
+def write_prometheus(path, spans=None, gauges=None):
+    """Replace `path` with the metrics of the last login
+
+    Spans of the same phase and labels, e.g. a page loaded several times, are
+    summed up. Of gauges with the same name and labels, the last one is kept.
+    """
+    spans = _spans if spans is None else spans
+    gauges = _gauges if gauges is None else gauges
+    durations = {}
+    successes = {}
+    for s in spans:
+        key = _prometheus_labels(phase=s.phase, **s.labels)
+        durations[key] = durations.get(key, 0) + s.duration
+        successes[key] = successes.get(key, True) and s.ok
+
+    lines = [
+        f"# HELP {PREFIX}_phase_duration_seconds Duration of the phases of the last login",
+        f"# TYPE {PREFIX}_phase_duration_seconds gauge",
+        *(
+            f"{PREFIX}_phase_duration_seconds{{{key}}} {value:.6f}"
+            for key, value in durations.items()
+        ),
+        f"# HELP {PREFIX}_phase_success Whether the phases of the last login succeeded",
+        f"# TYPE {PREFIX}_phase_success gauge",
+        *(
+            f"{PREFIX}_phase_success{{{key}}} {int(value)}"
+            for key, value in successes.items()
+        ),
+        f"# HELP {PREFIX}_last_run_timestamp_seconds Time of the last login",
+        f"# TYPE {PREFIX}_last_run_timestamp_seconds gauge",
+        f"{PREFIX}_last_run_timestamp_seconds {time.time():.3f}",
+    ]
+
+    values = {}
+    for g in gauges:
+        values.setdefault(g.name, {})[_prometheus_labels(**g.labels)] = g.value
+    for name, series in values.items():
+        lines.append(f"# TYPE {PREFIX}_{name} gauge")
+        lines.extend(
+            f"{PREFIX}_{name}{{{key}}} {value}" for key, value in series.items()
+        )
+
+    # The collector may read the file at any time, it must never be partial
+    path = Path(path)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}-")
+    with os.fdopen(fd, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, path)
+
+
+def _prometheus_labels(**labels):
+    return ",".join(
+        f'{name}="{_escape(value)}"' for name, value in sorted(labels.items())
+    )
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
@@ -0,0 +1,215 @@
+"""Measure the latency of VPN gateways to pick the fastest one"""
+
+import asyncio
+import json
+import os
+import ssl
+import tempfile
+import time
+from pathlib import Path
+from urllib.parse import urlparse
+
+import attr
+import structlog
+import xdg.BaseDirectory
+
+from openconnect_sso.authenticator import create_auth_init_request
+from openconnect_sso.config import APP_NAME
+
+logger = structlog.get_logger()
+
+DEFAULT_TIMEOUT = 5  # seconds
+DEFAULT_CACHE_TTL = 600  # seconds
+
+
+@attr.s
+class ProbeResult:
+    vpn_url = attr.ib()
+    tcp_connect = attr.ib(default=None)
+    tls_handshake = attr.ib(default=None)
+    auth_init = attr.ib(default=None)
+    status = attr.ib(default=None)
+    error = attr.ib(default=None)
+    timestamp = attr.ib(factory=time.time)
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    @property
+    def total(self):
+        if not self.ok:
+            return float("inf")
+        return sum(
+            t
+            for t in (self.tcp_connect, self.tls_handshake, self.auth_init)
+            if t is not None
+        )
+
+
+class _ResponseProtocol(asyncio.Protocol):
+    def __init__(self):
+        self.data = bytearray()
+        self.closed = asyncio.get_event_loop().create_future()
+
+    def data_received(self, data):
+        self.data += data
+
+    def eof_received(self):
+        return False
+
+    def connection_lost(self, exc):
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+
+def _init_request(host, url, version):
+    body = create_auth_init_request(host, host.vpn_url, version)
+    headers = {
+        "Host": url.netloc,
+        "User-Agent": f"AnyConnect Linux_64 {version}",
+        "Accept": "*/*",
+        "Accept-Encoding": "identity",
+        "X-Transcend-Version": "1",
+        "X-Aggregate-Auth": "1",
+        "X-Support-HTTP-Auth": "true",
+        "Content-Type": "application/x-www-form-urlencoded",
+        "Content-Length": str(len(body)),
+        "Connection": "close",
+    }
+    head = f"POST {url.path or '/'} HTTP/1.1\r\n" + "".join(
+        f"{k}: {v}\r\n" for k, v in headers.items()
+    )
+    return head.encode() + b"\r\n" + body
+
+
+def _status_code(response):
+    """Return the status code of an HTTP response, `None` if it is malformed"""
+    status_line = bytes(response).split(b"\r\n", 1)[0].split()
+    try:
+        return int(status_line[1])
+    except (IndexError, ValueError):
+        return None
+
+
+async def probe(host, version, timeout=DEFAULT_TIMEOUT):
+    """Time TCP connect, TLS handshake and the auth init request to `host`"""
+    url = urlparse(host.vpn_url)
+    use_tls = url.scheme == "https"
+    port = url.port or (443 if use_tls else 80)
+    result = ProbeResult(host.vpn_url)
+    loop = asyncio.get_event_loop()
+    transport = None
+    try:
+        start = time.perf_counter()
+        transport, protocol = await asyncio.wait_for(
+            loop.create_connection(_ResponseProtocol, url.hostname, port), timeout
+        )
+        result.tcp_connect = time.perf_counter() - start
+
+        if use_tls:
+            # Only latency is measured and no credentials are sent, gateways
+            # with self-signed certificates are probed as well
+            context = ssl.create_default_context()
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+            start = time.perf_counter()
+            transport = await asyncio.wait_for(
+                loop.start_tls(
+                    transport, protocol, context, server_hostname=url.hostname
+                ),
+                timeout,
+            )
+            result.tls_handshake = time.perf_counter() - start
+
+        start = time.perf_counter()
+        transport.write(_init_request(host, url, version))
+        await asyncio.wait_for(protocol.closed, timeout)
+        result.auth_init = time.perf_counter() - start
+
+        result.status = _status_code(protocol.data)
+        if result.status is None or result.status >= 400:
+            result.error = f"Unexpected HTTP status: {result.status}"
+    except (OSError, asyncio.TimeoutError, ssl.SSLError) as exc:
+        result.error = repr(exc)
+    finally:
+        if transport is not None:
+            transport.close()
+
+    logger.info(
+        "Gateway probed",
+        address=host.vpn_url,
+        tcp_ms=_ms(result.tcp_connect),
+        tls_ms=_ms(result.tls_handshake),
+        auth_init_ms=_ms(result.auth_init),
+        error=result.error,
+    )
+    return result
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 1)
+
+
+class ProbeCache:
+    def __init__(self, path=None, ttl=DEFAULT_CACHE_TTL):
+        if path is None:
+            path = Path(xdg.BaseDirectory.save_cache_path(APP_NAME)) / "probes.json"
+        self.path = Path(path)
+        self.ttl = ttl
+        try:
+            with self.path.open() as cache_file:
+                self._results = {
+                    url: ProbeResult(**result)
+                    for url, result in json.load(cache_file).items()
+                }
+        except FileNotFoundError:
+            self._results = {}
+        except (ValueError, TypeError, AttributeError):
+            logger.warn("Ignoring malformed probe cache", path=str(self.path))
+            self._results = {}
+
+    def get(self, vpn_url):
+        result = self._results.get(vpn_url)
+        # Unreachable gateways are probed again, they might be back already
+        if result and result.ok and time.time() - result.timestamp < self.ttl:
+            return result
+        return None
+
+    def update(self, results):
+        for result in results:
+            self._results[result.vpn_url] = result
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.path.parent, prefix=".probes-")
+            with os.fdopen(fd, "w") as cache_file:
+                json.dump(
+                    {url: attr.asdict(r) for url, r in self._results.items()},
+                    cache_file,
+                )
+            os.replace(tmp_path, self.path)
+        except OSError:
+            logger.warn("Could not save probe cache", path=str(self.path))
+
+
+async def probe_gateways(hosts, version, cache=None, timeout=DEFAULT_TIMEOUT):
+    """Probe `hosts` concurrently and return them ordered from the fastest
+
+    Returns a list of `(host, ProbeResult)` pairs. Recent results are reused
+    from `cache`.
+    """
+    if cache is None:
+        cache = ProbeCache()
+
+    results = {host.vpn_url: cache.get(host.vpn_url) for host in hosts}
+    to_probe = {host.vpn_url: host for host in hosts if results[host.vpn_url] is None}
+    if to_probe:
+        probed = await asyncio.gather(
+            *(probe(host, version, timeout) for host in to_probe.values())
+        )
+        cache.update(probed)
+        results.update((r.vpn_url, r) for r in probed)
+
+    return sorted(
+        ((host, results[host.vpn_url]) for host in hosts),
+        key=lambda item: item[1].total,
+    )
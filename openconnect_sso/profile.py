@@ -1,48 +1,140 @@
+import concurrent.futures
+import json
+import os
+import tempfile
 from pathlib import Path
 
 import structlog
-from lxml import objectify
+import xdg.BaseDirectory
+from lxml import etree
 
-from openconnect_sso.config import HostProfile
+from openconnect_sso.config import APP_NAME, HostProfile
 
 logger = structlog.get_logger()
 
 ns = {"enc": "http://schemas.xmlsoap.org/encoding/"}
 
+INDEX_VERSION = 1
+
 
 def _get_profiles_from_one_file(path):
     logger.info("Loading profiles from file", path=path.name)
 
-    with path.open() as f:
-        xml = objectify.parse(f)
-
-    hostentries = xml.xpath(
-        "//enc:AnyConnectProfile/enc:ServerList/enc:HostEntry", namespaces=ns
-    )
-
     profiles = []
-    for entry in hostentries:
-        profiles.append(
-            HostProfile(
-                name=entry.HostName,
-                address=entry.HostAddress,
-                user_group=entry.UserGroup,
+    for _, entry in etree.iterparse(
+        str(path), events=("end",), tag=f"{{{ns['enc']}}}HostEntry"
+    ):
+        parent = entry.getparent()
+        if parent is not None and parent.tag == f"{{{ns['enc']}}}ServerList":
+            profiles.append(
+                HostProfile(
+                    name=entry.findtext("enc:HostName", "", ns),
+                    address=entry.findtext("enc:HostAddress", "", ns),
+                    user_group=entry.findtext("enc:UserGroup", "", ns),
+                )
             )
-        )
+        # Keep memory usage low on large profiles
+        entry.clear()
+        while entry.getprevious() is not None:
+            del entry.getparent()[0]
 
     logger.debug("AnyConnect profiles parsed", path=path.name, profiles=profiles)
     return profiles
 
 
-def get_profiles(path: Path):
+def _profile_files(path):
     if path.is_file():
-        profile_files = [path]
+        return [path]
     elif path.is_dir():
-        profile_files = path.glob("*.xml")
+        return sorted(path.glob("*.xml"))
     else:
         raise ValueError("No profile file found", path.name)
 
-    profiles = []
-    for p in profile_files:
-        profiles.extend(_get_profiles_from_one_file(p))
-    return profiles
+
+class ProfileIndex:
+    """Persistent cache of parsed AnyConnect profiles
+
+    Files are only parsed again when their modification time or size changes.
+    """
+
+    def __init__(self, index_path=None):
+        if index_path is None:
+            index_path = (
+                Path(xdg.BaseDirectory.save_cache_path(APP_NAME)) / "profiles.json"
+            )
+        self.index_path = Path(index_path)
+        self._files = self._load()
+
+    def _load(self):
+        try:
+            with self.index_path.open() as index_file:
+                index = json.load(index_file)
+            if index.get("version") == INDEX_VERSION:
+                return index["files"]
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError, TypeError):
+            logger.warn("Ignoring malformed profile index", path=str(self.index_path))
+        return {}
+
+    def _save(self):
+        try:
+            fd, tmp_path = tempfile.mkstemp(
+                dir=self.index_path.parent, prefix=".profiles-"
+            )
+            with os.fdopen(fd, "w") as index_file:
+                json.dump({"version": INDEX_VERSION, "files": self._files}, index_file)
+            os.replace(tmp_path, self.index_path)
+        except OSError:
+            logger.warn(
+                "Could not save profile index", path=str(self.index_path), exc_info=True
+            )
+
+    def get_profiles(self, path: Path):
+        profile_files = _profile_files(path)
+
+        stats = {}
+        stale = []
+        for p in profile_files:
+            key = str(p.resolve())
+            st = p.stat()
+            stats[key] = {"mtime_ns": st.st_mtime_ns, "size": st.st_size}
+            entry = self._files.get(key)
+            if (
+                entry is None
+                or entry["mtime_ns"] != st.st_mtime_ns
+                or entry["size"] != st.st_size
+            ):
+                stale.append((key, p))
+
+        if stale:
+            with concurrent.futures.ThreadPoolExecutor() as executor:
+                parsed = executor.map(
+                    lambda item: _get_profiles_from_one_file(item[1]), stale
+                )
+                for (key, _), profiles in zip(stale, parsed):
+                    self._files[key] = {
+                        **stats[key],
+                        "profiles": [p.as_dict() for p in profiles],
+                    }
+
+        # Forget files removed from the directory
+        if path.is_dir():
+            directory = str(path.resolve())
+            for key in list(self._files):
+                if os.path.dirname(key) == directory and key not in stats:
+                    del self._files[key]
+                    stale.append((key, None))
+
+        if stale:
+            self._save()
+
+        return [
+            HostProfile.from_dict(profile)
+            for key in stats
+            for profile in self._files[key]["profiles"]
+        ]
+
+
+def get_profiles(path: Path):
+    return ProfileIndex().get_profiles(path)
@@ -1,16 +1,333 @@
+import asyncio
+import urllib.request
+from http.cookiejar import eff_request_host
+from urllib.parse import urljoin, urlparse
+
+import requests
+import requests.adapters
 import structlog
+from lxml import html
 
-from openconnect_sso.browser import Browser
+from openconnect_sso import metrics
+from openconnect_sso.browser import autofill, cookie_store
 
 log = structlog.get_logger()
 
+MAX_REPLAY_STEPS = 20
+REPLAY_TIMEOUT = 10  # seconds
+FORM_POOL_SIZE = 4
+USER_AGENT = (
+    "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) QtWebEngine/6.4.0 Chrome/102.0.5005.177 Safari/537.36"
+)
+
+# Input types which do not need a user to fill them in
+_AUTOMATIC_INPUTS = {"hidden", "submit", "button", "image"}
+
+# Connections to identity providers are shared by form logins, not their cookies
+_form_adapter = None
+
+
+def login_backend(login_backends, url):
+    """Return the backend logging in at `url`, see `Config.login_backends`"""
+    for pattern, backend in login_backends.items():
+        if autofill.url_matches(pattern, url):
+            return backend
+    return "browser"
+
+
+async def authenticate_in_browser(
+    browser, auth_info, credentials, page=0, identity=None
+):
+    """Log in at the identity provider in `page` of `browser`
+
+    Returns as soon as the token cookie is set, the final page does not need
+    to finish loading.
+    """
+    with metrics.span("browser_login", idp=urlparse(auth_info.login_url).netloc):
+        token = browser.expect_cookie(
+            auth_info.token_cookie_name, auth_info.login_final_url, identity, page
+        )
+        await browser.authenticate_at(
+            auth_info.login_url,
+            credentials,
+            page,
+            (auth_info.token_cookie_name, auth_info.login_final_url),
+            identity,
+        )
+
+        final_page = asyncio.ensure_future(
+            _final_page_loaded(browser, auth_info.login_final_url, page)
+        )
+        try:
+            await asyncio.wait([token, final_page], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            final_page.cancel()
+            token.cancel()
+
+        if token.done() and not token.cancelled():
+            log.debug("Token cookie received", page=page)
+            return token.result()
+        # Raises if the browser has exited
+        final_page.result()
+
+    return browser.cookie(
+        auth_info.token_cookie_name, auth_info.login_final_url, identity
+    )
+
+
+async def _final_page_loaded(browser, login_final_url, page):
+    url = None
+    while url != login_final_url:
+        url = await browser.page_loaded(page)
+        log.debug("Browser loaded page", url=url, page=page)
+
+
+async def authenticate_with_http(auth_info, proxy=None, cookies=None, identity=None):
+    """Try to log in with plain HTTP requests, reusing the browser's cookies
+
+    Works when the identity provider still has a session, so that it only
+    redirects and posts auto-submitted forms. Returns `None` as soon as a page
+    needs user input. Unless given, cookies are read from the browser profile
+    of `identity`.
+    """
+    with metrics.span("http_login", idp=urlparse(auth_info.login_url).netloc) as span:
+        token = await asyncio.get_event_loop().run_in_executor(
+            None, _replay, auth_info, proxy, cookies, identity
+        )
+        span.labels["result"] = "token" if token else "fallback"
+    return token
+
+
+def _replay(auth_info, proxy, cookies, identity):
+    session = requests.Session()
+    session.proxies = {"http": proxy, "https": proxy}
+    session.headers["User-Agent"] = USER_AGENT
+    if cookies is None:
+        cookies = cookie_store.load_cookies(identity=identity)
+    # A token cookie left over from a previous login must not be taken for the
+    # one of this login, only a token set by the replayed requests counts
+    for cookie in cookies:
+        if cookie.name != auth_info.token_cookie_name:
+            session.cookies.set_cookie(cookie)
+
+    method, url, data = "GET", auth_info.login_url, None
+    try:
+        for _ in range(MAX_REPLAY_STEPS):
+            response = session.request(
+                method,
+                url,
+                params=data if method == "GET" else None,
+                data=data if method != "GET" else None,
+                timeout=REPLAY_TIMEOUT,
+            )
+            log.debug("HTTP login step", url=_without_query(response.url))
+            token = _token_cookie(session.cookies, auth_info)
+            if token:
+                return token
+            if not response.ok:
+                break
+            step = _next_step(response)
+            if step is None:
+                log.info(
+                    "Identity provider needs user input, falling back to the browser",
+                    url=_without_query(response.url),
+                )
+                return None
+            method, url, data = step
+    except (requests.RequestException, ValueError):
+        log.warn("HTTP login failed, falling back to the browser", exc_info=True)
+        return None
+
+    log.info("HTTP login did not finish, falling back to the browser")
+    return None
+
+
+def _token_cookie(cookies, auth_info):
+    # The cookie jar stores cookies of hosts without a dot, e.g. "localhost",
+    # with a ".local" suffix
+    hosts = eff_request_host(urllib.request.Request(auth_info.login_final_url))
+    for cookie in cookies:
+        domain = cookie.domain.lstrip(".")
+        if cookie.name == auth_info.token_cookie_name and any(
+            host == domain or host.endswith("." + domain) for host in hosts
+        ):
+            return cookie.value
+    return None
+
+
+def _next_step(response):
+    """Return the request made by the page without user input, if any"""
+    if not response.content or "html" not in response.headers.get(
+        "Content-Type", "html"
+    ):
+        return None
+    document = html.fromstring(response.content, base_url=response.url)
+
+    for field in document.xpath("//input|//select|//textarea"):
+        input_type = field.get("type", "text").lower() if field.tag == "input" else None
+        if input_type not in _AUTOMATIC_INPUTS:
+            return None
+
+    for form in document.forms:
+        if form.xpath(".//input[@type='hidden' and @name]"):
+            action = urljoin(response.url, form.get("action") or "")
+            return form.method.upper(), action, dict(form.form_values())
+
+    for content in document.xpath(
+        "//meta[translate(@http-equiv, 'REFRESH', 'refresh')='refresh']/@content"
+    ):
+        _, _, target = content.partition("=")
+        if target:
+            return "GET", urljoin(response.url, target.strip(" '\"")), None
+
+    return None
+
+
+def _without_query(url):
+    parts = urlparse(url)
+    return f"{parts.scheme}://{parts.netloc}{parts.path}"
+
+
+async def authenticate_with_form(auth_info, credentials, auto_fill_rules, proxy=None):
+    """Log in by filling in and submitting HTML forms, without a browser
+
+    The auto-fill rules of each page are applied to its forms, the same way
+    the browser does. Pages submitting themselves are followed as well.
+    Returns `None` if a page cannot be handled this way, e.g. as it needs
+    JavaScript, or a "stop" rule matched.
+    """
+    with metrics.span("form_login", idp=urlparse(auth_info.login_url).netloc) as span:
+        token = await asyncio.get_event_loop().run_in_executor(
+            None,
+            _fill_forms,
+            auth_info,
+            credentials and credentials.resolve(),
+            auto_fill_rules,
+            proxy,
+        )
+        span.labels["result"] = "token" if token else "fallback"
+    return token
+
+
+class _NeedsBrowser(Exception):
+    pass
+
+
+def _form_session(proxy):
+    global _form_adapter
+    if _form_adapter is None:
+        _form_adapter = requests.adapters.HTTPAdapter(
+            pool_connections=FORM_POOL_SIZE, pool_maxsize=FORM_POOL_SIZE
+        )
+    # Not closed when done, which would close the shared connections
+    session = requests.Session()
+    session.mount("https://", _form_adapter)
+    session.mount("http://", _form_adapter)
+    session.proxies = {"http": proxy, "https": proxy}
+    session.headers["User-Agent"] = USER_AGENT
+    return session
+
+
+def _fill_forms(auth_info, credentials, auto_fill_rules, proxy):
+    session = _form_session(proxy)
+    method, url, data = "GET", auth_info.login_url, None
+    try:
+        for _ in range(MAX_REPLAY_STEPS):
+            response = session.request(
+                method,
+                url,
+                params=data if method == "GET" else None,
+                data=data if method != "GET" else None,
+                timeout=REPLAY_TIMEOUT,
+            )
+            log.debug("Form login step", url=_without_query(response.url))
+            token = _token_cookie(session.cookies, auth_info)
+            if token:
+                return token
+            if not response.ok:
+                break
+            step = _form_step(response, auto_fill_rules, credentials)
+            if step is None:
+                step = _next_step(response)
+            if step is None:
+                raise _NeedsBrowser("No form to submit")
+            method, url, data = step
+    except _NeedsBrowser as exc:
+        log.info(
+            "Form login needs a browser, falling back to it",
+            url=_without_query(response.url),
+            reason=str(exc),
+        )
+        return None
+    except (requests.RequestException, ValueError):
+        log.warn("Form login failed, falling back to the browser", exc_info=True)
+        return None
+
+    log.info("Form login did not finish, falling back to the browser")
+    return None
+
+
+def _form_step(response, auto_fill_rules, credentials):
+    """Return the request made by applying the auto-fill rules to the page"""
+    rules = autofill.rules_for_url(auto_fill_rules, response.url)
+    if (
+        not rules
+        or not response.content
+        or "html" not in response.headers.get("Content-Type", "html")
+    ):
+        return None
+    document = html.fromstring(response.content, base_url=response.url)
+
+    filled = None
+    for rule in rules:
+        try:
+            elements = autofill.css_to_xpath(rule.selector)(document)
+        except ValueError:
+            log.warn("Unsupported selector, rule ignored", selector=rule.selector)
+            continue
+        if not elements:
+            continue
+        element = elements[0]
+        if rule.action == "stop":
+            raise _NeedsBrowser(f"Stopped by {rule.selector}")
+        if rule.fill:
+            if element.tag not in ("input", "textarea", "select"):
+                raise _NeedsBrowser(f"Cannot fill in <{element.tag}>")
+            value = getattr(credentials, rule.fill, None)
+            if value:
+                element.value = value
+                filled = element
+        elif rule.action == "click":
+            return _click(element)
+
+    if filled is not None:
+        # As if Enter was pressed in the last field filled in
+        return _submit(_form_of(filled))
+    return None
+
+
+def _form_of(element):
+    form = next(element.iterancestors("form"), None)
+    if form is None:
+        raise _NeedsBrowser("Element is not part of a form")
+    return form
+
 
-async def authenticate_in_browser(proxy, auth_info, credentials, display_mode):
-    async with Browser(proxy, display_mode) as browser:
-        await browser.authenticate_at(auth_info.login_url, credentials)
+def _click(element):
+    if element.tag == "a" and element.get("href"):
+        return "GET", urljoin(element.base_url, element.get("href")), None
+    default_type = "submit" if element.tag == "button" else "text"
+    if element.tag in ("button", "input") and element.get(
+        "type", default_type
+    ).lower() in ("submit", "image"):
+        return _submit(_form_of(element), element)
+    raise _NeedsBrowser(f"Cannot click on <{element.tag}>")
 
-        while browser.url != auth_info.login_final_url:
-            await browser.page_loaded()
-            log.debug("Browser loaded page", url=browser.url)
 
-    return browser.cookies[auth_info.token_cookie_name]
+def _submit(form, button=None):
+    data = list(form.form_values())
+    if button is not None and button.get("name"):
+        data.append((button.get("name"), button.get("value", "")))
+    action = urljoin(form.base_url, form.get("action") or "")
+    return form.method.upper(), action, data
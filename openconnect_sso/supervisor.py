@@ -0,0 +1,145 @@
+"""Keep the VPN connection up by restarting openconnect when it exits
+
+Each exit of openconnect is classified by its exit status. A lost connection
+is first retried with the same session token, which the gateway accepts for a
+while. Only if the token is rejected is a new login made, which the caller
+does with the cheapest method available (see :func:`supervise`).
+"""
+
+import enum
+import signal
+import time
+
+import attr
+import requests
+import structlog
+
+from openconnect_sso import metrics
+from openconnect_sso.authenticator import AuthenticationError
+
+logger = structlog.get_logger()
+
+# A connection which stayed up for this long resets the backoff, in seconds
+STABLE_CONNECTION = 60
+MAX_FAILURES = 10
+
+
+class ExitReason(enum.Enum):
+    USER = "user"  # disconnect requested, e.g. by a signal
+    REJECTED = "rejected"  # session token rejected, a new login is needed
+    DISCONNECTED = "disconnected"  # connection lost, the token may still work
+    FATAL = "fatal"  # restarting would not help
+
+
+# Exit statuses of openconnect, besides those of `run_openconnect` itself
+_EXIT_REASONS = {
+    0: ExitReason.USER,
+    1: ExitReason.DISCONNECTED,
+    2: ExitReason.REJECTED,
+}
+_USER_SIGNALS = {signal.SIGINT, signal.SIGTERM, signal.SIGHUP}
+
+
+def classify_exit(returncode):
+    if returncode < 0:
+        # Killed by a signal; only restart if it was not asked to stop
+        if -returncode in _USER_SIGNALS:
+            return ExitReason.USER
+        return ExitReason.DISCONNECTED
+    return _EXIT_REASONS.get(returncode, ExitReason.FATAL)
+
+
+@attr.s
+class Backoff:
+    initial = attr.ib(default=1.0)
+    maximum = attr.ib(default=60.0)
+    factor = attr.ib(default=2.0)
+
+    def delay(self, failures):
+        """Return the time to wait after `failures` consecutive failures"""
+        return min(self.maximum, self.initial * self.factor**failures)
+
+
+@attr.s
+class Outage:
+    reason = attr.ib()
+    duration = attr.ib()
+
+
+def supervise(
+    auth_response,
+    connect,
+    authenticate,
+    backoff=None,
+    max_failures=MAX_FAILURES,
+    sleep=time.sleep,
+    clock=time.monotonic,
+):
+    """Run `connect(auth_response)` until it exits for good
+
+    `connect` runs openconnect and returns its exit status. `authenticate`
+    returns a new :class:`AuthCompleteResponse` and is called when the session
+    token is rejected. Gives up after `max_failures` consecutive attempts which
+    did not stay connected for `STABLE_CONNECTION` seconds.
+
+    Returns the last exit status and the outages in between.
+    """
+    backoff = backoff or Backoff()
+    outages = []
+    outage = None
+    failures = 0
+    login = False
+    while True:
+        if login:
+            try:
+                auth_response = authenticate()
+            except (AuthenticationError, requests.RequestException) as exc:
+                logger.warn("Could not log in again", error=str(exc))
+                if failures >= max_failures:
+                    logger.error("Giving up reconnecting", failures=failures)
+                    break
+                sleep(backoff.delay(failures))
+                failures += 1
+                continue
+            login = False
+
+        if outage is not None:
+            span, reason, stopped = outage
+            span.finish(attempts=failures)
+            outages.append(Outage(reason, clock() - stopped))
+            outage = None
+
+        started = clock()
+        returncode = connect(auth_response)
+        reason = classify_exit(returncode)
+        if reason in (ExitReason.USER, ExitReason.FATAL):
+            logger.info("OpenConnect exited", returncode=returncode, reason=reason)
+            break
+        if clock() - started >= STABLE_CONNECTION:
+            failures = 0
+        if failures >= max_failures:
+            logger.error("Giving up reconnecting", failures=failures)
+            break
+
+        outage = metrics.start("outage", reason=reason.value), reason, clock()
+        login = reason is ExitReason.REJECTED
+        delay = backoff.delay(failures)
+        failures += 1
+        logger.warn(
+            "OpenConnect exited, reconnecting",
+            returncode=returncode,
+            reason=reason,
+            delay=delay,
+            attempt=failures,
+        )
+        sleep(delay)
+
+    if outage is not None:
+        outage[0].finish(error="GaveUp", attempts=failures)
+    if outages:
+        logger.info(
+            "Connection outages",
+            count=len(outages),
+            total_seconds=round(sum(o.duration for o in outages), 1),
+        )
+    return returncode, outages
@@ -0,0 +1,95 @@
+import json
+import time
+
+import attr
+import keyring
+import keyring.errors
+import structlog
+
+from openconnect_sso.config import APP_NAME
+
+logger = structlog.get_logger()
+
+DEFAULT_LIFETIME = 3600  # seconds
+
+
+@attr.s
+class CachedSession:
+    host = attr.ib(converter=str)
+    session_token = attr.ib(converter=str)
+    server_cert_hash = attr.ib(converter=str)
+    expires_at = attr.ib(converter=float)
+
+    def is_valid(self, now=None):
+        if now is None:
+            now = time.time()
+        return bool(
+            self.host
+            and self.session_token
+            and self.server_cert_hash
+            and now < self.expires_at
+        )
+
+
+def _key(vpn_url, username, identity=None):
+    key = f"session/{vpn_url}/{username or ''}"
+    # Identities do not share sessions, even with the same user name
+    return f"{key}/{identity}" if identity else key
+
+
+def load(vpn_url, username, identity=None):
+    """Return a still valid :class:`CachedSession` or ``None``
+
+    Sessions are stored in the user's keyring, so they are encrypted at rest
+    the same way saved passwords are.
+    """
+    key = _key(vpn_url, username, identity)
+    try:
+        data = keyring.get_password(APP_NAME, key)
+    except keyring.errors.KeyringError:
+        logger.info("Cannot retrieve cached session from keyring.")
+        return None
+    if not data:
+        return None
+
+    try:
+        session = CachedSession(**json.loads(data))
+    except (TypeError, ValueError):
+        logger.warn("Ignoring malformed cached session", key=key)
+        invalidate(vpn_url, username, identity)
+        return None
+
+    if not session.is_valid():
+        logger.debug("Cached session expired", key=key)
+        invalidate(vpn_url, username, identity)
+        return None
+    return session
+
+
+def store(
+    vpn_url, username, host, auth_response, lifetime=DEFAULT_LIFETIME, identity=None
+):
+    session = CachedSession(
+        host=host,
+        session_token=auth_response.session_token,
+        server_cert_hash=auth_response.server_cert_hash,
+        expires_at=time.time() + lifetime,
+    )
+    try:
+        keyring.set_password(
+            APP_NAME,
+            _key(vpn_url, username, identity),
+            json.dumps(attr.asdict(session)),
+        )
+    except keyring.errors.KeyringError:
+        logger.info("Cannot save session to keyring.")
+    return session
+
+
+def invalidate(vpn_url, username, identity=None):
+    try:
+        keyring.delete_password(APP_NAME, _key(vpn_url, username, identity))
+    except keyring.errors.PasswordDeleteError:
+        pass
+    except keyring.errors.KeyringError:
+        logger.info("Cannot delete cached session from keyring.")
@@ -0,0 +1,238 @@
+"""Run openconnect and follow the state of the tunnel from its output
+
+openconnect reports its progress as text only. Lines of interest are turned
+into :class:`Event` objects, e.g. when the CSTP (TLS) channel is connected,
+when DTLS comes up or why the session ended. The time it takes to get the
+tunnel up is recorded as metrics.
+
+The output is still shown on the terminal and is also kept in a rotating log
+file, which is written by a background thread, so that a slow disk never
+holds up reading the output of openconnect.
+"""
+
+import asyncio
+import logging
+import logging.handlers
+import queue
+import re
+import sys
+import time
+
+import attr
+import structlog
+
+from openconnect_sso import metrics
+
+logger = structlog.get_logger()
+
+LOG_MAX_BYTES = 1024 * 1024
+# Output is read in chunks of this size, lines may be longer
+READ_CHUNK_SIZE = 64 * 1024
+LOG_BACKUP_COUNT = 3
+# Time openconnect has to log out after being interrupted, in seconds
+EXIT_TIMEOUT = 5
+
+_PATTERNS = [
+    (name, re.compile(pattern))
+    for name, pattern in [
+        ("https_connected", r"^Connected to HTTPS on (?P<host>\S+)"),
+        (
+            "cstp_connected",
+            r"^CSTP connected\. DPD (?P<dpd>\d+), Keepalive (?P<keepalive>\d+)",
+        ),
+        ("address_assigned", r"^Connected as (?P<address>[^,]+), using (?P<via>.+)"),
+        (
+            "dtls_established",
+            r"^Established DTLS connection \(using (?P<library>[^)]+)\)\."
+            r"(?: Ciphersuite (?P<cipher>.+?)\.?)?$",
+        ),
+        ("dtls_failed", r"^DTLS handshake failed: (?P<error>.*)"),
+        ("rekey", r"^(?P<channel>CSTP|DTLS) rekey due"),
+        (
+            "dead_peer",
+            r"^(?P<channel>CSTP|DTLS) Dead Peer Detection detected dead peer",
+        ),
+        ("server_disconnect", r"^Received server disconnect: \S+ '(?P<reason>.*)'"),
+        ("exiting", r"^(?P<reason>.+); exiting\.$"),
+    ]
+]
+
+
+@attr.s
+class Event:
+    name = attr.ib()
+    fields = attr.ib(factory=dict)
+    timestamp = attr.ib(factory=time.time)
+    # Seconds since openconnect was started
+    elapsed = attr.ib(default=None)
+
+
+def parse_line(line):
+    """Return the :class:`Event` reported by a line of output, if any"""
+    line = line.strip()
+    for name, pattern in _PATTERNS:
+        match = pattern.match(line)
+        if match:
+            return Event(
+                name, {k: v for k, v in match.groupdict().items() if v is not None}
+            )
+    return None
+
+
+class TunnelState:
+    """Follows the events of one openconnect process"""
+
+    def __init__(self, gateway, on_event=None, clock=time.monotonic):
+        self.events = []
+        self._on_event = on_event
+        self._clock = clock
+        self._started = clock()
+        self._tunnel = metrics.start("tunnel_up", gateway=gateway)
+        self._dtls = metrics.start("dtls_up", gateway=gateway)
+
+    @property
+    def tunnel_up(self):
+        return self._tunnel.duration is not None
+
+    @property
+    def dtls_up(self):
+        return self._dtls.duration is not None and self._dtls.ok
+
+    @property
+    def disconnect_reason(self):
+        for event in reversed(self.events):
+            if event.name in ("server_disconnect", "exiting"):
+                return event.fields["reason"]
+        return None
+
+    def feed(self, line):
+        event = parse_line(line)
+        if event is None:
+            return None
+        event.elapsed = self._clock() - self._started
+        self.events.append(event)
+        logger.debug("OpenConnect event", name=event.name, **event.fields)
+
+        if event.name == "cstp_connected":
+            self._tunnel.finish()
+        elif event.name == "dtls_established":
+            self._dtls.finish(cipher=event.fields.get("cipher", ""))
+        elif event.name in ("dead_peer", "server_disconnect"):
+            logger.warn("OpenConnect reported", name=event.name, **event.fields)
+
+        if self._on_event:
+            self._on_event(event)
+        return event
+
+    def close(self, returncode):
+        if not self.tunnel_up:
+            self._tunnel.finish(error=f"exit code {returncode}")
+        elif not self.dtls_up:
+            logger.warn("DTLS was not established, the tunnel only used TLS")
+        self._dtls.finish(error="NotEstablished")
+        logger.info(
+            "OpenConnect session ended",
+            returncode=returncode,
+            reason=self.disconnect_reason,
+            dtls=self.dtls_up,
+        )
+
+
+class OutputLog:
+    """Rotating log of the output of openconnect, written in the background"""
+
+    def __init__(self, path, max_bytes=LOG_MAX_BYTES, backup_count=LOG_BACKUP_COUNT):
+        handler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=max_bytes, backupCount=backup_count, delay=True
+        )
+        handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+        self._handler = handler
+        self._queue = queue.SimpleQueue()
+        self._listener = logging.handlers.QueueListener(self._queue, handler)
+        # Not registered with `logging`, so that lines do not reach the
+        # handlers of the root logger
+        self._logger = logging.Logger("openconnect")
+        self._logger.addHandler(logging.handlers.QueueHandler(self._queue))
+
+    def __enter__(self):
+        self._listener.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._listener.stop()
+        self._handler.close()
+
+    def write(self, line):
+        self._logger.info(line.rstrip("\n"))
+
+
+async def run(command_line, session_token, state, output_log=None, echo=True):
+    """Run openconnect, feeding its output to `state` line by line
+
+    `session_token` is written to its standard input. Returns the exit status.
+    With `echo`, its standard output and error are copied to ours.
+    """
+    process = await asyncio.create_subprocess_exec(
+        *command_line,
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+
+    async def follow(stream, echo_to):
+        async for raw_line in _lines(stream):
+            line = raw_line.decode(errors="replace")
+            if echo:
+                echo_to.write(line)
+                echo_to.flush()
+            if output_log is not None:
+                output_log.write(line)
+            state.feed(line)
+
+    try:
+        process.stdin.write(session_token)
+        await process.stdin.drain()
+        process.stdin.close()
+
+        await asyncio.gather(
+            follow(process.stdout, sys.stdout), follow(process.stderr, sys.stderr)
+        )
+        returncode = await process.wait()
+    except BaseException:
+        # e.g. cancelled on CTRL-C, which openconnect receives as well
+        await _stop(process)
+        raise
+    state.close(returncode)
+    return returncode
+
+
+async def _lines(stream):
+    """Yield the lines of `stream`, however long they are
+
+    `StreamReader.readline` fails on lines longer than its buffer limit.
+    """
+    pending = []
+    while True:
+        chunk = await stream.read(READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        *lines, rest = chunk.split(b"\n")
+        for line in lines:
+            yield b"".join(pending) + line + b"\n"
+            pending = []
+        if rest:
+            pending.append(rest)
+    if pending:
+        yield b"".join(pending)
+
+
+async def _stop(process):
+    try:
+        await asyncio.wait_for(process.wait(), EXIT_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warn("OpenConnect did not exit, terminating it")
+        try:
+            process.terminate()
+        except ProcessLookupError:
+            pass
+        await process.wait()
@@ -1,3 +1,108 @@
 import os
 
+import pytest
+from werkzeug import Response
+
 os.environ["COVERAGE_PROCESS_START"] = ".coveragerc"
+
+AUTH_REQUEST = """<?xml version="1.0" encoding="UTF-8"?>
+<config-auth client="vpn" type="auth-request" aggregate-auth-version="2">
+    <opaque is-for="sg">
+        <tunnel-group>group</tunnel-group>
+        <auth-method>single-sign-on-v2</auth-method>
+    </opaque>
+    <auth id="main">
+        <title>Login</title>
+        <message>Please complete the authentication process in the AnyConnect Login window.</message>
+        <banner></banner>
+        <sso-v2-login>{login_url}</sso-v2-login>
+        <sso-v2-login-final>{login_final_url}</sso-v2-login-final>
+        <sso-v2-token-cookie-name>{token_cookie_name}</sso-v2-token-cookie-name>
+        <form>
+            <input type="sso" name="sso-token"></input>
+        </form>
+    </auth>
+</config-auth>
+"""
+
+AUTH_COMPLETE = """<?xml version="1.0" encoding="UTF-8"?>
+<config-auth client="vpn" type="complete" aggregate-auth-version="2">
+    <session-id>1</session-id>
+    <session-token>{session_token}</session-token>
+    <auth id="success">
+        <message>Success</message>
+    </auth>
+    <config client="vpn" type="private">
+        <vpn-base-config>
+            <server-cert-hash>{server_cert_hash}</server-cert-hash>
+        </vpn-base-config>
+    </config>
+</config-auth>
+"""
+
+
+class Gateway:
+    """Emulates the config-auth exchange of an AnyConnect gateway"""
+
+    token_cookie_name = "acSamlv2Token"
+    session_token = "session-token"
+    server_cert_hash = "pin-sha256:server-cert-hash"
+
+    def __init__(self, httpserver):
+        self.httpserver = httpserver
+        self.url = httpserver.url_for("/")
+        self.login_url = httpserver.url_for("/login")
+        self.login_final_url = httpserver.url_for("/+CSCOE+/saml_ac_login.html")
+        self.sso_tokens = []
+        httpserver.expect_request("/", method="GET").respond_with_data("")
+        httpserver.expect_request("/", method="POST").respond_with_handler(
+            self.config_auth
+        )
+
+    def config_auth(self, request):
+        body = request.get_data(as_text=True)
+        if 'type="init"' in body:
+            return Response(
+                AUTH_REQUEST.format(
+                    login_url=self.login_url,
+                    login_final_url=self.login_final_url,
+                    token_cookie_name=self.token_cookie_name,
+                ),
+                content_type="text/xml",
+            )
+        if 'type="auth-reply"' in body:
+            start = body.index("<sso-token>") + len("<sso-token>")
+            self.sso_tokens.append(body[start : body.index("</sso-token>")])
+            return Response(
+                AUTH_COMPLETE.format(
+                    session_token=self.session_token,
+                    server_cert_hash=self.server_cert_hash,
+                ),
+                content_type="text/xml",
+            )
+        return Response("Unexpected request", status=400)
+
+
+@pytest.fixture
+def gateway(httpserver):
+    return Gateway(httpserver)
+
+
+@pytest.fixture
+def browser_events(monkeypatch):
+    """Replaces the browser of the authenticator, returns the events it records"""
+    events = []
+
+    class FakeBrowser:
+        def __init__(self, proxy, display_mode, use_daemon, cfg=None):
+            pass
+
+        async def __aenter__(self):
+            events.append("browser started")
+            return self
+
+        async def __aexit__(self, *exc_info):
+            events.append("browser stopped")
+
+    monkeypatch.setattr("openconnect_sso.authenticator.Browser", FakeBrowser)
+    return events
@@ -0,0 +1,308 @@
+import asyncio
+import time
+from urllib.parse import urlparse
+from unittest.mock import sentinel
+
+import pytest
+from werkzeug import Response
+
+from lxml import etree
+
+from openconnect_sso.authenticator import (
+    AuthCompleteResponse,
+    AuthRequestResponse,
+    AuthResponseError,
+    Authenticator,
+    _create_auth_finish_request,
+    authenticate_batch,
+    create_auth_init_request,
+    parse_response,
+)
+from openconnect_sso.config import Config, DisplayMode, HostProfile
+from tests.conftest import AUTH_COMPLETE, AUTH_REQUEST
+
+
+async def fake_browser_login(browser, auth_request_response):
+    assert browser is sentinel.browser
+    return "sso-token"
+
+
+@pytest.mark.asyncio
+async def test_authenticate(gateway, monkeypatch):
+    auth = Authenticator(
+        HostProfile(gateway.url, "", "group"), version="4.7.00136", cfg=Config()
+    )
+    monkeypatch.setattr(auth, "_authenticate_in_browser", fake_browser_login)
+
+    response = await auth.authenticate(DisplayMode.HIDDEN, browser=sentinel.browser)
+
+    assert response.session_token == gateway.session_token
+    assert response.server_cert_hash == gateway.server_cert_hash
+    assert gateway.sso_tokens == ["sso-token"]
+
+
+@pytest.mark.asyncio
+async def test_requests_do_not_block_event_loop(httpserver):
+    def slow_response(request):
+        time.sleep(0.3)
+        return Response("")
+
+    httpserver.expect_request("/").respond_with_handler(slow_response)
+    auth = Authenticator(
+        HostProfile(httpserver.url_for("/"), "", "group"), cfg=Config()
+    )
+
+    ticks = 0
+
+    async def tick():
+        nonlocal ticks
+        while True:
+            ticks += 1
+            await asyncio.sleep(0.01)
+
+    ticker = asyncio.ensure_future(tick())
+    await auth._detect_authentication_target_url()
+    ticker.cancel()
+
+    assert ticks > 10
+
+
+@pytest.mark.asyncio
+async def test_browser_starts_before_contacting_gateway(
+    gateway, monkeypatch, browser_events
+):
+    events = browser_events
+
+    async def browser_login(browser, auth_request_response):
+        events.append("login")
+        return "sso-token"
+
+    auth = Authenticator(HostProfile(gateway.url, "", "group"), cfg=Config())
+    monkeypatch.setattr(auth, "_authenticate_in_browser", browser_login)
+    detect = auth._detect_authentication_target_url
+
+    async def detect_authentication_target_url():
+        events.append("gateway contacted")
+        await detect()
+
+    monkeypatch.setattr(
+        auth, "_detect_authentication_target_url", detect_authentication_target_url
+    )
+
+    await auth.authenticate(DisplayMode.HIDDEN)
+
+    assert events == [
+        "browser started",
+        "gateway contacted",
+        "login",
+        "browser stopped",
+    ]
+
+
+def fake_browser_logins(monkeypatch, authenticators, events):
+    for auth in authenticators:
+
+        async def browser_login(browser, auth_request_response, page):
+            events.append(f"login started {page}")
+            await asyncio.sleep(0.01)
+            events.append(f"login finished {page}")
+            return f"sso-token-{page}"
+
+        monkeypatch.setattr(auth, "_authenticate_in_browser", browser_login)
+
+
+def with_token_cookie_host(monkeypatch, auth, host):
+    initiate = auth._initiate
+
+    async def initiate_elsewhere():
+        response = await initiate()
+        parts = urlparse(response.login_final_url)
+        response.login_final_url = parts._replace(
+            netloc=f"{host}:{parts.port}"
+        ).geturl()
+        return response
+
+    monkeypatch.setattr(auth, "_initiate", initiate_elsewhere)
+
+
+@pytest.mark.asyncio
+async def test_batch_logs_in_to_first_gateway_before_the_others(
+    gateway, monkeypatch, browser_events
+):
+    events = browser_events
+    authenticators = [
+        Authenticator(HostProfile(gateway.url, "", "group"), cfg=Config())
+        for _ in range(3)
+    ]
+    fake_browser_logins(monkeypatch, authenticators, events)
+    with_token_cookie_host(monkeypatch, authenticators[2], "vpn2.example.com")
+
+    responses = await authenticate_batch(authenticators, DisplayMode.HIDDEN)
+
+    assert [r.session_token for r in responses] == [gateway.session_token] * 3
+    assert sorted(gateway.sso_tokens) == ["sso-token-0", "sso-token-1", "sso-token-2"]
+    assert events[:3] == ["browser started", "login started 0", "login finished 0"]
+    assert events[3:5] == ["login started 1", "login started 2"]
+    assert events[-1] == "browser stopped"
+
+
+@pytest.mark.asyncio
+async def test_batch_logs_in_to_groups_of_one_host_in_turn(
+    gateway, monkeypatch, browser_events
+):
+    events = browser_events
+    authenticators = [
+        Authenticator(HostProfile(gateway.url, "", group), cfg=Config())
+        for group in ["groupA", "groupB", "groupC"]
+    ]
+    fake_browser_logins(monkeypatch, authenticators, events)
+
+    await authenticate_batch(authenticators, DisplayMode.HIDDEN)
+
+    # Their token cookies are set on the same host, one login at a time
+    assert events[1:-1] == [
+        f"login {step} {page}" for page in range(3) for step in ["started", "finished"]
+    ]
+    assert sorted(gateway.sso_tokens) == ["sso-token-0", "sso-token-1", "sso-token-2"]
+
+
+@pytest.mark.asyncio
+async def test_batch_logs_in_identities_in_parallel(
+    gateway, monkeypatch, browser_events
+):
+    events = browser_events
+
+    authenticators = [
+        Authenticator(
+            HostProfile(gateway.url, "", "group"), identity=identity, cfg=Config()
+        )
+        for identity in ["service", "personal", "service", "personal"]
+    ]
+    for auth in authenticators:
+
+        async def browser_login(browser, auth_request_response, page, auth=auth):
+            events.append(f"login started {page} {auth.identity}")
+            await asyncio.sleep(0.01)
+            events.append(f"login finished {page} {auth.identity}")
+            return f"sso-token-{page}"
+
+        monkeypatch.setattr(auth, "_authenticate_in_browser", browser_login)
+
+    await authenticate_batch(authenticators, DisplayMode.HIDDEN)
+
+    assert events[1:3] == ["login started 0 service", "login started 1 personal"]
+    assert set(events[3:5]) == {"login finished 0 service", "login finished 1 personal"}
+    assert set(events[5:7]) == {"login started 2 service", "login started 3 personal"}
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("replayed_token", ["sso-token", None])
+async def test_browser_is_started_only_if_sso_replay_fails(
+    gateway, monkeypatch, browser_events, replayed_token
+):
+    events = browser_events
+
+    async def http_login(auth_request_response):
+        events.append("http login")
+        return replayed_token
+
+    async def browser_login(browser, auth_request_response):
+        events.append("browser login")
+        return "sso-token"
+
+    auth = Authenticator(HostProfile(gateway.url, "", "group"), cfg=Config())
+    monkeypatch.setattr(auth, "_authenticate_with_http", http_login)
+    monkeypatch.setattr(auth, "_authenticate_in_browser", browser_login)
+
+    await auth.authenticate(DisplayMode.HIDDEN, sso_replay=True)
+
+    assert gateway.sso_tokens == ["sso-token"]
+    if replayed_token:
+        assert events == ["http login"]
+    else:
+        assert events == [
+            "http login",
+            "browser started",
+            "browser login",
+            "browser stopped",
+        ]
+
+
+class XmlResponse:
+    def __init__(self, content):
+        self.content = content.encode() if isinstance(content, str) else content
+
+    def raise_for_status(self):
+        pass
+
+
+AUTH_REQUEST_XML = AUTH_REQUEST.format(
+    login_url="https://idp.example.com/login?a=1&amp;b=2",
+    login_final_url="https://vpn.example.com/final",
+    token_cookie_name="acSamlv2Token",
+)
+
+
+def test_responses_are_parsed():
+    request = parse_response(XmlResponse(AUTH_REQUEST_XML))
+    complete = parse_response(
+        XmlResponse(AUTH_COMPLETE.format(session_token="st", server_cert_hash="h"))
+    )
+
+    assert isinstance(request, AuthRequestResponse)
+    assert request.auth_title == "Login"
+    assert request.auth_error == ""
+    assert request.login_url == "https://idp.example.com/login?a=1&b=2"
+    assert request.token_cookie_name == "acSamlv2Token"
+    assert isinstance(complete, AuthCompleteResponse)
+    assert (complete.session_token, complete.server_cert_hash) == ("st", "h")
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        b"",
+        b"not xml",
+        b"<config-auth type='auth-request'><auth",
+        AUTH_REQUEST_XML.replace("<sso-v2-login>", "<other>").replace(
+            "</sso-v2-login>", "</other>"
+        ),
+        AUTH_REQUEST_XML.replace('id="main"', 'id="other"'),
+        AUTH_COMPLETE.format(session_token="st", server_cert_hash="h").replace(
+            "session-token", "other"
+        ),
+    ],
+)
+def test_malformed_responses_are_rejected(content):
+    with pytest.raises(AuthResponseError):
+        parse_response(XmlResponse(content))
+
+
+def test_entities_are_not_expanded(tmp_path):
+    secret = tmp_path / "secret"
+    secret.write_text("secret")
+    content = AUTH_REQUEST_XML.replace(
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        f'<?xml version="1.0"?><!DOCTYPE x [<!ENTITY e SYSTEM "file://{secret}">]>',
+    ).replace("<title>Login</title>", "<title>&e;</title>")
+
+    assert "secret" not in parse_response(XmlResponse(content)).auth_title
+
+
+def test_requests_contain_escaped_fields():
+    host = HostProfile("https://vpn.example.com", "", "a&b")
+    auth_info = parse_response(XmlResponse(AUTH_REQUEST_XML))
+
+    init = etree.fromstring(
+        create_auth_init_request(host, "https://vpn.example.com/?x=<y>", "4.7")
+    )
+    finish = etree.fromstring(
+        _create_auth_finish_request(host, auth_info, "token<&>", "4.7")
+    )
+
+    assert init.findtext("group-select") == "a&b"
+    assert init.findtext("group-access") == "https://vpn.example.com/?x=<y>"
+    assert init.find("version").get("who") == "vpn"
+    assert finish.get("type") == "auth-reply"
+    assert finish.findtext("opaque/tunnel-group") == "group"
+    assert finish.findtext("auth/sso-token") == "token<&>"
@@ -0,0 +1,107 @@
+import attr
+import lxml.html
+import pytest
+
+from openconnect_sso.browser import autofill
+from openconnect_sso.config import AutoFillRule
+
+
+@attr.s
+class Credentials:
+    username = attr.ib()
+    password = attr.ib(default=None)
+
+
+RULES = {
+    "https://login.example.com/*": [
+        AutoFillRule(selector="div[id=passwordError]", action="stop"),
+        AutoFillRule(selector="input[type=email]", fill="username"),
+        AutoFillRule(selector="input[name=passwd]", fill="password"),
+        AutoFillRule(selector="input[type=submit]", action="click"),
+    ],
+    "https://*.idp.example.com:8443/*": [
+        AutoFillRule(selector="input[name=user]", fill="username"),
+    ],
+    "https://*": [AutoFillRule(selector="button", action="click")],
+}
+
+
+def test_patterns_are_indexed_by_host():
+    index = autofill.build_index(RULES)
+
+    assert index["hosts"] == {"login.example.com": [0]}
+    assert index["wildcard"] == [1, 2]
+    assert index["entries"][0]["rules"][:2] == [
+        {"selector": "div[id=passwordError]", "action": "stop"},
+        {"selector": "input[type=email]", "action": "fill", "fill": "username"},
+    ]
+
+
+def test_compiled_script_does_not_contain_credentials():
+    script = autofill.compile_rules(RULES)
+
+    assert "MutationObserver" in script
+    assert "setTimeout" not in script
+    assert "secret" not in script
+    assert autofill.CREDENTIALS_VARIABLE in script
+
+
+def test_credentials_script_only_contains_referred_values():
+    script = autofill.get_credentials_script(
+        {"https://*": [AutoFillRule(selector="input", fill="username")]},
+        Credentials("user", "secret"),
+    )
+
+    assert script == f'var {autofill.CREDENTIALS_VARIABLE} = {{"username": "user"}};\n'
+
+
+def test_compiled_script_is_cached_by_rules(tmp_path, monkeypatch):
+    script = autofill.get_script(RULES, tmp_path)
+    (cached,) = tmp_path.glob("autofill-*.js")
+    assert cached.read_text() == script
+
+    def fail(rules):
+        pytest.fail("Cached script is compiled again")
+
+    monkeypatch.setattr(autofill, "compile_rules", fail)
+    assert autofill.get_script(RULES, tmp_path) == script
+
+
+def test_changed_rules_replace_cached_script(tmp_path):
+    autofill.get_script(RULES, tmp_path)
+    rules = {**RULES, "https://other.example.com/*": []}
+
+    assert r"other\\.example\\.com" in autofill.get_script(rules, tmp_path)
+    assert len(list(tmp_path.glob("autofill-*.js"))) == 1
+
+
+SELECTOR_DOCUMENT = """<html><body><form id="login">
+<input type="email" name="user"><input class="btn primary" type="submit" value="Go">
+<div data-lang="en-GB"><button name="next">Next</button></div>
+</form></body></html>"""
+
+
+@pytest.mark.parametrize(
+    "selector, names",
+    [
+        ("input[type=email]", ["user"]),
+        ("form#login input.primary", [None]),
+        ("form > input", ["user", None]),
+        ("form > button", []),
+        ("div[data-lang|=en] button", ["next"]),
+        ("input[type^=sub], [name$='ext']", [None, "next"]),
+        ("[class~=btn]", [None]),
+    ],
+)
+def test_selectors_are_translated_to_xpath(selector, names):
+    document = lxml.html.fromstring(SELECTOR_DOCUMENT)
+
+    elements = autofill.css_to_xpath(selector)(document)
+
+    assert [e.get("name") for e in elements] == names
+
+
+@pytest.mark.parametrize("selector", ["a + b", "input:focus", "div::before", ""])
+def test_unsupported_selectors_are_rejected(selector):
+    with pytest.raises(ValueError):
+        autofill.css_to_xpath(selector)
@@ -0,0 +1,227 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import socket
+
+import pytest
+
+from openconnect_sso import broker, metrics
+from openconnect_sso.authenticator import AuthenticationError, Authenticator
+from openconnect_sso.config import Config, DisplayMode, HostProfile
+
+
+class Clock:
+    now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def logins(gateway):
+    """Logs in to the gateway stand-in, counting the logins"""
+    counts = {}
+
+    async def authenticate(host, username, identity):
+        counts[username] = counts.get(username, 0) + 1
+        auth = Authenticator(host, version="4.7.00136", cfg=Config())
+
+        async def browser_login(browser, auth_request_response):
+            # Leave time for other requests to pile up
+            await asyncio.sleep(0.1)
+            return f"sso-token-{username}"
+
+        auth._authenticate_in_browser = browser_login
+        return await auth.authenticate(DisplayMode.HIDDEN, browser=object())
+
+    authenticate.counts = counts
+    return authenticate
+
+
+@contextlib.asynccontextmanager
+async def served(path, authenticate):
+    server = asyncio.ensure_future(broker.serve(broker.Broker(authenticate), path))
+    try:
+        while True:
+            try:
+                _, writer = await asyncio.open_unix_connection(path)
+            except OSError:
+                await asyncio.sleep(0.01)
+            else:
+                writer.close()
+                break
+        yield path
+    finally:
+        server.cancel()
+        await asyncio.gather(server, return_exceptions=True)
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "broker.sock")
+
+
+@pytest.mark.asyncio
+async def test_concurrent_clients_share_logins(path, gateway, logins):
+    users = [f"user{i}" for i in range(4)]
+
+    async with served(path, logins):
+        responses = await asyncio.gather(
+            *(
+                broker.request(path, gateway.url, user=users[i % len(users)])
+                for i in range(200)
+            )
+        )
+
+    assert logins.counts == {user: 1 for user in users}
+    assert sorted(gateway.sso_tokens) == [f"sso-token-{user}" for user in users]
+    assert {r["cookie"] for r in responses} == {gateway.session_token}
+    assert {r["fingerprint"] for r in responses} == {gateway.server_cert_hash}
+
+
+@pytest.mark.asyncio
+async def test_invalidated_session_is_logged_in_again(path, gateway, logins):
+    async with served(path, logins):
+        await broker.request(path, gateway.url, user="user")
+        await broker.request(path, gateway.url, user="user", invalidate=True)
+        await broker.request(path, gateway.url, user="user")
+
+    assert logins.counts == {"user": 2}
+
+
+@pytest.mark.asyncio
+async def test_clients_of_other_users_are_rejected(path, gateway, logins, monkeypatch):
+    other_uid = os.getuid() + 1
+    monkeypatch.setattr(broker.os, "getuid", lambda: other_uid)
+
+    async with served(path, logins):
+        with pytest.raises(broker.BrokerError, match="Permission denied"):
+            await broker.request(path, gateway.url)
+    assert not logins.counts
+
+
+@pytest.mark.asyncio
+async def test_sessions_expire():
+    clock = Clock()
+    logins = []
+
+    async def authenticate(host, username, identity):
+        logins.append(username)
+        return AuthResponse()
+
+    b = broker.Broker(authenticate, lifetime=60, clock=clock)
+    host = HostProfile("vpn.example.com", "", "")
+    await b.get(host)
+    clock.now += 30
+    await b.get(host)
+    assert len(logins) == 1
+
+    clock.now += 30
+    b.evict()
+    assert not b._sessions
+    await b.get(host)
+    assert len(logins) == 2
+
+
+@pytest.mark.asyncio
+async def test_identities_do_not_share_sessions():
+    logins = []
+
+    async def authenticate(host, username, identity):
+        logins.append((username, identity))
+        await asyncio.sleep(0.01)
+        return AuthResponse()
+
+    b = broker.Broker(authenticate)
+    requests = [
+        {"server": "vpn.example.com", "user": "user", "identity": identity}
+        for identity in ["service", "personal", "service", None]
+    ]
+
+    await asyncio.gather(*(b.handle(request) for request in requests))
+
+    assert len(logins) == 3
+    assert set(logins) == {("user", None), ("user", "personal"), ("user", "service")}
+    assert "error" in await b.handle({"server": "vpn", "identity": "../x"})
+
+
+@pytest.mark.asyncio
+async def test_failed_login_is_reported_to_every_waiter():
+    async def authenticate(host, username, identity):
+        await asyncio.sleep(0.01)
+        raise AuthenticationError("rejected")
+
+    b = broker.Broker(authenticate)
+    request = {"server": "vpn.example.com"}
+
+    responses = await asyncio.gather(b.handle(request), b.handle(request))
+
+    assert all("rejected" in r["error"] for r in responses)
+    assert json.dumps(await b.handle({})) == '{"error": "Invalid request"}'
+    assert json.dumps(await b.handle([])) == '{"error": "Invalid request"}'
+
+
+@pytest.mark.asyncio
+async def test_unexpected_errors_are_reported_to_the_client(path):
+    async def authenticate(host, username, identity):
+        raise KeyError("session-token")
+
+    async with served(path, authenticate):
+        with pytest.raises(broker.BrokerError, match="KeyError"):
+            await broker.request(path, "vpn.example.com")
+
+
+@pytest.mark.asyncio
+async def test_running_broker_is_not_replaced(path, logins):
+    async with served(path, logins):
+        with pytest.raises(broker.BrokerError, match="already serving"):
+            await broker.serve(broker.Broker(logins), path)
+
+        assert await broker.request(path, "vpn.example.com", invalidate=True) == {}
+
+
+@pytest.mark.asyncio
+async def test_stale_socket_is_replaced(path, logins):
+    stale = socket.socket(socket.AF_UNIX)
+    stale.bind(path)
+    stale.close()
+
+    async with served(path, logins):
+        assert await broker.request(path, "vpn.example.com", invalidate=True) == {}
+
+
+class AuthResponse:
+    session_token = "token"
+    server_cert_hash = "hash"
+
+
+@pytest.mark.asyncio
+async def test_metrics_are_exported_after_each_login(
+    gateway, tmp_path, monkeypatch, browser_events
+):
+    async def browser_login(self, browser, auth_request_response, page=0):
+        return "sso-token"
+
+    monkeypatch.setattr(Authenticator, "_authenticate_in_browser", browser_login)
+    metrics.reset()
+    path = tmp_path / "metrics.jsonl"
+    args = argparse.Namespace(
+        proxy=None,
+        ac_version="4.7.00136",
+        browser_display_mode="hidden",
+        browser_daemon=False,
+        sso_replay=False,
+        metrics_json=str(path),
+        metrics_prometheus=None,
+    )
+    authenticate = broker._authenticator(args, Config())
+    host = HostProfile(gateway.url, "", "group")
+
+    await authenticate(host, None, None)
+    await authenticate(host, None, None)
+
+    phases = [json.loads(line)["phase"] for line in path.read_text().splitlines()]
+    assert phases.count("complete") == 2
+    assert not metrics.spans()
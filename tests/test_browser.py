@@ -1,8 +1,11 @@
-import attr
+import asyncio
 import pytest
 import sys
 
+from werkzeug import Response
+
 from openconnect_sso.browser import Browser, DisplayMode
+from openconnect_sso.config import ResolvedCredentials
 
 
 @pytest.mark.asyncio
@@ -39,14 +42,37 @@ async def test_browser_cookies_accessible(httpserver):
             headers={"Set-Cookie": "cookie-name=cookie-value"},
         )
         auth_url = httpserver.url_for("/authenticate")
-        cred = Credentials("username", "password")
+        cred = ResolvedCredentials("username", "password")
 
         await browser.authenticate_at(auth_url, cred)
         await browser.page_loaded()
         assert browser.cookies.get("cookie-name") == "cookie-value"
 
 
-@attr.s
-class Credentials:
-    username = attr.ib()
-    password = attr.ib()
+@pytest.mark.xfail(
+    sys.platform in ["darwin", "win32"],
+    reason="https://github.com/vlaci/openconnect-sso/issues/23",
+)
+@pytest.mark.asyncio
+async def test_identities_do_not_share_cookies(httpserver):
+    def login(request):
+        if "identity" in request.cookies:
+            return Response("<html><body>Logged in</body></html>")
+        identity = request.args["identity"]
+        return Response(
+            "<html><body>Hello</body></html>",
+            headers={"Set-Cookie": f"identity={identity}"},
+        )
+
+    httpserver.expect_request("/login").respond_with_handler(login)
+    auth_url = httpserver.url_for("/login")
+
+    async with Browser(display_mode=DisplayMode.HIDDEN) as browser:
+        for page, identity in enumerate(["service", "personal"]):
+            await browser.authenticate_at(
+                f"{auth_url}?identity={identity}", None, page, identity=identity
+            )
+        await asyncio.gather(browser.page_loaded(0), browser.page_loaded(1))
+
+        assert browser.cookie("identity", auth_url, "service") == "service"
+        assert browser.cookie("identity", auth_url, "personal") == "personal"
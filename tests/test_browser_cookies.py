@@ -0,0 +1,103 @@
+import asyncio
+
+import pytest
+
+from openconnect_sso.browser import Browser, ipc
+from openconnect_sso.browser.browser import Terminated
+
+
+@pytest.mark.asyncio
+async def test_cookie_is_looked_up_by_domain():
+    browser = Browser()
+    for domain, value in [
+        ("vpn1.example.com", "token-1"),
+        ("vpn2.example.com", "token-2"),
+        (".example.com", "shared"),
+    ]:
+        browser._cookie_jar[None, domain.lstrip("."), "acSamlv2Token"] = value
+
+    assert browser.cookie("acSamlv2Token", "https://vpn1.example.com/x") == "token-1"
+    assert browser.cookie("acSamlv2Token", "https://vpn2.example.com/x") == "token-2"
+    assert browser.cookie("acSamlv2Token", "https://vpn3.example.com/x") == "shared"
+    with pytest.raises(KeyError):
+        browser.cookie("acSamlv2Token", "https://example.org/")
+
+
+@pytest.mark.asyncio
+async def test_expected_cookie_resolves_on_first_matching_cookie():
+    browser = Browser()
+    browser._set_cookie(ipc.SetCookie("acSamlv2Token", "stale", "vpn.example.com"))
+    token = browser.expect_cookie("acSamlv2Token", "https://vpn.example.com/final")
+
+    browser._set_cookie(ipc.SetCookie("acSamlv2Token", "other", "vpn2.example.com"))
+    browser._set_cookie(ipc.SetCookie("session", "x", "vpn.example.com"))
+    assert not token.done()
+
+    browser._set_cookie(ipc.SetCookie("acSamlv2Token", "fresh", ".example.com"))
+    assert await token == "fresh"
+    assert not browser._cookie_waiters
+
+
+@pytest.mark.asyncio
+async def test_cookies_of_identities_are_kept_apart():
+    browser = Browser()
+    url = "https://vpn.example.com/final"
+    service = browser.expect_cookie("acSamlv2Token", url, identity="service")
+    personal = browser.expect_cookie("acSamlv2Token", url, identity="personal")
+
+    browser._set_cookie(
+        ipc.SetCookie("acSamlv2Token", "token-p", "vpn.example.com", "personal")
+    )
+    assert not service.done()
+    assert await personal == "token-p"
+
+    browser._set_cookie(
+        ipc.SetCookie("acSamlv2Token", "token-s", "vpn.example.com", "service")
+    )
+    assert await service == "token-s"
+    assert browser.cookie("acSamlv2Token", url, identity="personal") == "token-p"
+    with pytest.raises(KeyError):
+        browser.cookie("acSamlv2Token", url)
+
+
+@pytest.mark.asyncio
+async def test_token_cookie_is_only_given_to_its_page():
+    browser = Browser()
+    url = "https://vpn.example.com/+CSCOE+/saml_ac_login.html"
+    group_a = browser.expect_cookie("acSamlv2Token", url, page=1)
+    group_b = browser.expect_cookie("acSamlv2Token", url, page=2)
+
+    browser._set_cookie(
+        ipc.SetCookie("acSamlv2Token", "token-b", "vpn.example.com", page=2)
+    )
+    assert not group_a.done()
+    assert await group_b == "token-b"
+
+    # Without a page, the cookie goes to the page waiting longest
+    other = browser.expect_cookie("acSamlv2Token", url, page=3)
+    browser._set_cookie(ipc.SetCookie("acSamlv2Token", "token-a", "vpn.example.com"))
+    assert await group_a == "token-a"
+    assert not other.done()
+
+
+class GarbledBrowserProcess:
+    pid = None
+
+    async def wait(self):
+        pass
+
+    async def get_state_async(self):
+        raise ipc.ProtocolError("truncated frame")
+
+
+@pytest.mark.asyncio
+async def test_invalid_message_terminates_waiting_pages():
+    browser = Browser()
+    browser.browser_proc = GarbledBrowserProcess()
+    browser.running = True
+
+    await asyncio.wait_for(browser._update_status(), 1)
+
+    assert not browser.running
+    with pytest.raises(Terminated):
+        await asyncio.wait_for(browser.page_loaded(), 1)
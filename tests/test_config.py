@@ -0,0 +1,81 @@
+import pytest
+import xdg.BaseDirectory
+
+from openconnect_sso import config
+
+
+@pytest.fixture
+def config_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(xdg.BaseDirectory, "xdg_config_home", str(tmp_path))
+    monkeypatch.setattr(xdg.BaseDirectory, "xdg_config_dirs", [str(tmp_path)])
+    monkeypatch.setattr(config, "_snapshot", None)
+    path = tmp_path / config.APP_NAME
+    path.mkdir()
+    return path
+
+
+@pytest.fixture
+def toml_loads(monkeypatch):
+    calls = []
+    load = config.toml.load
+
+    def counting_load(f):
+        calls.append(f.name)
+        return load(f)
+
+    monkeypatch.setattr(config.toml, "load", counting_load)
+    return calls
+
+
+def test_config_is_parsed_only_when_changed(config_dir, toml_loads):
+    (config_dir / "config.toml").write_text('on_disconnect = "true"\n')
+
+    assert config.load().on_disconnect == "true"
+    assert config.load().on_disconnect == "true"
+    assert len(toml_loads) == 1
+
+    (config_dir / "config.toml").write_text('on_disconnect = "echo bye"\n')
+    assert config.load().on_disconnect == "echo bye"
+    assert len(toml_loads) == 2
+
+
+def test_loaded_configs_are_independent(config_dir):
+    (config_dir / "config.toml").write_text("")
+
+    config.load().request_filter.block_domains.append("example.com")
+
+    assert "example.com" not in config.load().request_filter.block_domains
+
+
+def test_unchanged_config_is_not_saved(config_dir):
+    path = config_dir / "config.toml"
+    config.save(config.Config(on_disconnect="true"))
+    written = path.stat()
+
+    cfg = config.load()
+    config.save(cfg)
+    assert path.stat().st_ino == written.st_ino
+
+    cfg.on_disconnect = "echo bye"
+    config.save(cfg)
+    assert path.stat().st_ino != written.st_ino
+    assert config.load().on_disconnect == "echo bye"
+    assert [p.name for p in config_dir.iterdir()] == ["config.toml"]
+
+
+def test_identities_are_loaded(config_dir):
+    (config_dir / "config.toml").write_text(
+        '[identities.service]\nusername = "svc@example.com"\n\n'
+        "[identities.personal]\n"
+    )
+
+    cfg = config.load()
+
+    assert cfg.identities["service"].credentials.username == "svc@example.com"
+    assert cfg.identities["personal"].credentials is None
+    assert config.Config.from_dict(cfg.as_dict()) == cfg
+
+
+def test_invalid_identity_names_are_rejected():
+    with pytest.raises(ValueError):
+        config.Config(identities={"../x": {}})
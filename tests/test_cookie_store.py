@@ -0,0 +1,57 @@
+import sqlite3
+
+import pytest
+
+from openconnect_sso.browser import cookie_store
+
+NOW = 1_700_000_000
+
+
+def chromium_time(timestamp):
+    return (timestamp + cookie_store._CHROMIUM_EPOCH_OFFSET) * 1_000_000
+
+
+def test_unexpired_cookies_are_loaded(tmp_path):
+    path = tmp_path / "Cookies"
+    db = sqlite3.connect(path)
+    db.execute(
+        "CREATE TABLE cookies (host_key TEXT, name TEXT, value TEXT, path TEXT, "
+        "expires_utc INTEGER, is_secure INTEGER, encrypted_value BLOB)"
+    )
+    db.executemany(
+        "INSERT INTO cookies VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [
+            (".idp.example.com", "session", "s", "/", chromium_time(NOW + 60), 1, b""),
+            ("idp.example.com", "expired", "e", "/", chromium_time(NOW - 60), 1, b""),
+            ("idp.example.com", "encrypted", "", "/", 0, 1, b"v10..."),
+            ("idp.example.com", "no-expiry", "n", "/app", 0, 0, b""),
+        ],
+    )
+    db.commit()
+    db.close()
+
+    cookies = {c.name: c for c in cookie_store.load_cookies(path, now=NOW)}
+
+    assert sorted(cookies) == ["no-expiry", "session"]
+    assert cookies["session"].domain == ".idp.example.com"
+    assert cookies["session"].secure
+    assert cookies["session"].expires == NOW + 60
+    assert cookies["no-expiry"].path == "/app"
+
+
+def test_missing_database_yields_no_cookies(tmp_path):
+    assert list(cookie_store.load_cookies(tmp_path / "Cookies")) == []
+
+
+def test_identities_have_profiles_of_their_own(monkeypatch, tmp_path):
+    monkeypatch.setattr(cookie_store.xdg.BaseDirectory, "xdg_data_home", str(tmp_path))
+
+    paths = {
+        cookie_store.storage_path(identity)
+        for identity in (None, "service", "personal")
+    }
+
+    assert len(paths) == 3
+    assert cookie_store.profile_name("service") == "openconnect-sso-service"
+    with pytest.raises(ValueError):
+        cookie_store.storage_path("../default")
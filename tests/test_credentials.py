@@ -0,0 +1,59 @@
+import pyotp
+import pytest
+
+from openconnect_sso import config
+from openconnect_sso.config import Credentials
+
+
+class CountingKeyring:
+    def __init__(self, passwords):
+        self.passwords = passwords
+        self.lookups = 0
+
+    def get_password(self, service, key):
+        self.lookups += 1
+        return self.passwords.get(key)
+
+    def set_password(self, service, key, value):
+        self.passwords[key] = value
+
+
+@pytest.fixture
+def keyring(monkeypatch):
+    kr = CountingKeyring({"user": "pass", "totp/user": pyotp.random_base32()})
+    monkeypatch.setattr(config.keyring, "get_password", kr.get_password)
+    monkeypatch.setattr(config.keyring, "set_password", kr.set_password)
+    monkeypatch.setattr(config, "_secrets_cache", {})
+    return kr
+
+
+def test_secrets_are_fetched_once(keyring):
+    credentials = Credentials("user")
+
+    assert credentials.password == "pass"
+    assert credentials.totp == pyotp.TOTP(keyring.passwords["totp/user"]).now()
+    assert Credentials("user").resolve().password == "pass"
+    assert keyring.lookups == 2
+
+
+def test_secrets_are_fetched_again_when_expired(keyring, monkeypatch):
+    monkeypatch.setattr(config, "SECRETS_CACHE_TTL", 0)
+    Credentials("user").resolve()
+    Credentials("user").resolve()
+
+    assert keyring.lookups == 4
+
+
+def test_saved_secrets_are_cached(keyring):
+    credentials = Credentials("other")
+    credentials.password = "new-pass"
+
+    assert credentials.password == "new-pass"
+    assert keyring.passwords["other"] == "new-pass"
+
+
+def test_resolved_credentials_hide_secrets(keyring):
+    resolved = Credentials("user").resolve()
+
+    assert "pass" not in repr(resolved)
+    assert resolved.totp == pyotp.TOTP(keyring.passwords["totp/user"]).now()
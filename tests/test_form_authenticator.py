@@ -0,0 +1,172 @@
+import pyotp
+import pytest
+from werkzeug import Response
+
+from openconnect_sso.authenticator import Authenticator
+from openconnect_sso.config import (
+    AutoFillRule,
+    Config,
+    DisplayMode,
+    HostProfile,
+    ResolvedCredentials,
+)
+from openconnect_sso.saml_authenticator import authenticate_with_form, login_backend
+
+TOTP_SECRET = pyotp.random_base32()
+
+USERNAME_PAGE = """<html><body><form method="post" action="/password">
+<input type="hidden" name="flow" value="1">
+<input type="email" name="login"><input type="submit" value="Next">
+</form></body></html>"""
+
+PASSWORD_PAGE = """<html><body>{error}<form method="post" action="/otp">
+<input type="hidden" name="login" value="{login}">
+<input type="password" name="passwd"><button type="submit" name="next" value="1">Sign in</button>
+</form></body></html>"""
+
+OTP_PAGE = """<html><body><form method="post" action="/verify">
+<input type="text" name="otc"><input type="submit" value="Verify">
+</form></body></html>"""
+
+SAML_POST = """<html><body onload="document.forms[0].submit()">
+<form method="post" action="/acs"><input type="hidden" name="SAMLResponse" value="assertion">
+</form></body></html>"""
+
+RULES = {
+    "http://*": [
+        AutoFillRule(selector="div[id=passwordError]", action="stop"),
+        AutoFillRule(selector="input[type=email]", fill="username"),
+        AutoFillRule(selector="input[name=passwd]", fill="password"),
+        AutoFillRule(selector="form > button[type=submit]", action="click"),
+        AutoFillRule(selector="input[name=otc]", fill="totp"),
+    ]
+}
+
+
+class FormIdp:
+    """An identity provider asking for user name, password and TOTP code on
+    separate pages, without any JavaScript"""
+
+    password = "secret-password"
+
+    def __init__(self, httpserver, login_final_url):
+        self.login_final_url = login_final_url
+        httpserver.expect_request("/login", method="GET").respond_with_data(
+            USERNAME_PAGE, content_type="text/html"
+        )
+        httpserver.expect_request("/password", method="POST").respond_with_handler(
+            self.password_page
+        )
+        httpserver.expect_request("/otp", method="POST").respond_with_handler(
+            self.otp_page
+        )
+        httpserver.expect_request("/verify", method="POST").respond_with_handler(
+            self.verify
+        )
+        httpserver.expect_request("/acs", method="POST").respond_with_handler(self.acs)
+
+    def password_page(self, request):
+        assert request.form["flow"] == "1"
+        page = PASSWORD_PAGE.format(error="", login=request.form["login"])
+        return Response(page, content_type="text/html")
+
+    def otp_page(self, request):
+        assert request.form["next"] == "1"
+        if request.form["passwd"] != self.password:
+            page = PASSWORD_PAGE.format(
+                error='<div id="passwordError">Incorrect password</div>',
+                login=request.form["login"],
+            )
+            return Response(page, content_type="text/html")
+        return Response(OTP_PAGE, content_type="text/html")
+
+    def verify(self, request):
+        assert pyotp.TOTP(TOTP_SECRET).verify(request.form["otc"], valid_window=1)
+        return Response(SAML_POST, content_type="text/html")
+
+    def acs(self, request):
+        assert request.form["SAMLResponse"] == "assertion"
+        return Response(
+            status=302,
+            headers={
+                "Location": self.login_final_url,
+                "Set-Cookie": "acSamlv2Token=sso-token; Path=/",
+            },
+        )
+
+
+@pytest.fixture
+def idp(gateway, httpserver):
+    FormIdp(httpserver, gateway.login_final_url)
+    httpserver.expect_request("/+CSCOE+/saml_ac_login.html").respond_with_data("")
+    return gateway
+
+
+def credentials(password=FormIdp.password):
+    return ResolvedCredentials("user@example.com", password, TOTP_SECRET)
+
+
+@pytest.mark.asyncio
+async def test_form_login_fills_in_every_page(idp):
+    token = await authenticate_with_form(idp, credentials(), RULES)
+
+    assert token == "sso-token"
+
+
+@pytest.mark.asyncio
+async def test_stop_rule_falls_back_to_browser(idp):
+    token = await authenticate_with_form(idp, credentials("wrong-password"), RULES)
+
+    assert token is None
+
+
+@pytest.mark.asyncio
+async def test_page_without_rules_falls_back_to_browser(idp):
+    token = await authenticate_with_form(idp, credentials(), {})
+
+    assert token is None
+
+
+@pytest.mark.asyncio
+async def test_rule_filling_in_other_elements_falls_back_to_browser(idp):
+    rules = {"http://*": [AutoFillRule(selector="form", fill="username")]}
+
+    token = await authenticate_with_form(idp, credentials(), rules)
+
+    assert token is None
+
+
+def test_first_matching_backend_is_used():
+    backends = {"https://idp.example.com/*": "form", "https://*": "browser"}
+
+    assert login_backend(backends, "https://idp.example.com/login") == "form"
+    assert login_backend(backends, "https://other.example.com/login") == "browser"
+    assert login_backend({}, "https://idp.example.com/login") == "browser"
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("password", [FormIdp.password, "wrong-password"])
+async def test_browser_is_only_used_if_form_login_fails(
+    idp, monkeypatch, browser_events, password
+):
+    events = browser_events
+
+    async def browser_login(browser, auth_request_response):
+        events.append("browser login")
+        return "browser-token"
+
+    cfg = Config(login_backends={idp.login_url: "form"})
+    cfg.auto_fill_rules = RULES
+    auth = Authenticator(
+        HostProfile(idp.url, "", "group"), credentials=credentials(password), cfg=cfg
+    )
+    monkeypatch.setattr(auth, "_authenticate_in_browser", browser_login)
+
+    await auth.authenticate(DisplayMode.HIDDEN)
+
+    if password == FormIdp.password:
+        assert events == ["browser started", "browser stopped"]
+        assert idp.sso_tokens == ["sso-token"]
+    else:
+        assert events == ["browser started", "browser login", "browser stopped"]
+        assert idp.sso_tokens == ["browser-token"]
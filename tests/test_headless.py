@@ -0,0 +1,19 @@
+from openconnect_sso.browser import headless
+
+
+def test_chromium_flags_are_set():
+    environ = {}
+    headless.configure(environ)
+
+    flags = environ["QTWEBENGINE_CHROMIUM_FLAGS"].split()
+    assert "--renderer-process-limit=1" in flags
+    assert "--disable-gpu" in flags
+
+
+def test_flags_of_the_user_take_precedence():
+    environ = {"QTWEBENGINE_CHROMIUM_FLAGS": "--renderer-process-limit=2"}
+    headless.configure(environ)
+
+    flags = environ["QTWEBENGINE_CHROMIUM_FLAGS"].split()
+    assert flags[-1] == "--renderer-process-limit=2"
+    assert "--renderer-process-limit=1" in flags
@@ -0,0 +1,59 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+# Import times depend on the load of the machine, budgets are only checked on
+# request, e.g. when measuring startup locally
+CHECK_BUDGETS = os.environ.get("IMPORT_TIME_BUDGETS") == "1"
+
+
+def import_module(module):
+    """Import `module` in a fresh interpreter
+
+    Returns the cumulative import time in seconds and the set of loaded modules
+    """
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-X",
+            "importtime",
+            "-c",
+            f"import sys, {module}; print(*sys.modules, sep='\\n')",
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    total_us = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line.split("|")
+        # Nested imports are indented further, they are already accounted for
+        if cumulative.strip().isdigit() and not name[1:].startswith(" "):
+            total_us += int(cumulative)
+    return total_us / 1e6, {m.split(".")[0] for m in result.stdout.split()}
+
+
+@pytest.mark.parametrize(
+    ("module", "budget", "forbidden"),
+    (
+        # --help, --version and argument errors
+        (
+            "openconnect_sso.cli",
+            0.3,
+            {"PyQt6", "prompt_toolkit", "requests", "lxml", "keyring"},
+        ),
+        # Everything needed until a cached session token is used
+        ("openconnect_sso.app", 1.0, {"PyQt6", "prompt_toolkit"}),
+        ("openconnect_sso.browser", 1.0, {"PyQt6"}),
+    ),
+)
+def test_import_time(module, budget, forbidden):
+    elapsed, modules = import_module(module)
+
+    assert not modules & forbidden
+    if CHECK_BUDGETS:
+        assert elapsed < budget
@@ -0,0 +1,39 @@
+import pytest
+
+from openconnect_sso.browser import ipc
+from openconnect_sso.config import ResolvedCredentials
+
+
+def test_messages_survive_roundtrip():
+    messages = [
+        ipc.Url("https://example.com/"),
+        ipc.SetCookie("name", "value"),
+        ipc.StartupInfo(
+            "https://example.com/", ResolvedCredentials("user", "pass", "secret")
+        ),
+        ipc.StartupInfo("https://example.com/", None),
+        ipc.Ping(),
+    ]
+
+    decoder = ipc.Decoder()
+    assert decoder.feed(b"".join(ipc.encode(m) for m in messages)) == messages
+
+
+def test_decoder_waits_for_complete_frames():
+    data = ipc.encode(ipc.Url("https://example.com/"))
+    decoder = ipc.Decoder()
+
+    assert decoder.feed(data[:3]) == []
+    assert decoder.feed(data[3:-1]) == []
+    assert decoder.feed(data[-1:]) == [ipc.Url("https://example.com/")]
+
+
+def test_unknown_message_is_rejected():
+    payload = b'{"type": "Unknown"}'
+    with pytest.raises(ipc.ProtocolError):
+        ipc.Decoder().feed(len(payload).to_bytes(4, "big") + payload)
+
+
+def test_messages_default_to_first_page():
+    assert ipc.Url("https://example.com/").page == 0
+    assert ipc.StartupInfo("https://example.com/", None).page == 0
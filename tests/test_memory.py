@@ -0,0 +1,49 @@
+import os
+
+import pytest
+
+from openconnect_sso.browser import memory
+
+PAGE_SIZE = memory._PAGE_SIZE
+
+
+@pytest.fixture
+def proc(tmp_path):
+    # The browser (10) runs a zygote (11) with two renderers (12, 13)
+    processes = [
+        (1, 0, "init", 100),
+        (10, 1, "python3", 50),
+        (11, 10, "QtWebEngineProcess", 20),
+        (12, 11, "QtWebEngine (renderer) x", 200),
+        (13, 11, "QtWebEngineProcess", 100),
+        (20, 1, "other", 1000),
+    ]
+    for pid, ppid, name, pages in processes:
+        path = tmp_path / str(pid)
+        path.mkdir()
+        (path / "stat").write_text(f"{pid} ({name}) S {ppid} {pid} {pid} 0 -1\n")
+        (path / "statm").write_text(f"{pages * 2} {pages} 0 0 0 0 0\n")
+    return tmp_path
+
+
+def test_process_tree(proc):
+    assert sorted(memory.process_tree(10, proc)) == [10, 11, 12, 13]
+    assert memory.process_tree(20, proc) == [20]
+
+
+def test_peak_rss_of_process_tree(proc):
+    peak = memory.PeakRss(10, proc=proc)
+    assert peak.sample() == 370 * PAGE_SIZE
+
+    # A renderer exited
+    for path in (proc / "12").iterdir():
+        path.unlink()
+    (proc / "12").rmdir()
+
+    assert memory.tree_rss(10, proc) == 170 * PAGE_SIZE
+    assert peak.sample() == 370 * PAGE_SIZE
+
+
+@pytest.mark.skipif(not memory.PeakRss.supported(), reason="/proc is not available")
+def test_rss_of_this_process():
+    assert memory.tree_rss(os.getpid()) >= memory.rss(os.getpid()) > 0
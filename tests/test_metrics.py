@@ -0,0 +1,110 @@
+import json
+
+import pytest
+
+from openconnect_sso import metrics
+
+
+@pytest.fixture(autouse=True)
+def clean_spans():
+    metrics.reset()
+    yield
+    metrics.reset()
+
+
+def test_span_records_duration():
+    with metrics.span("detect", gateway="https://vpn.example.com"):
+        pass
+
+    (span,) = metrics.spans()
+    assert span.phase == "detect"
+    assert span.ok
+    assert span.duration >= 0
+    assert span.labels == {"gateway": "https://vpn.example.com"}
+
+
+def test_span_records_failure():
+    with pytest.raises(ValueError):
+        with metrics.span("init"):
+            raise ValueError()
+
+    (span,) = metrics.spans()
+    assert span.error == "ValueError"
+
+
+def test_span_is_finished_once():
+    span = metrics.start("page_load")
+    span.finish(url="https://idp.example.com/")
+    span.finish(url="https://idp.example.com/other")
+
+    assert metrics.spans() == [span]
+    assert span.labels == {"url": "https://idp.example.com/"}
+
+
+def test_write_json_lines(tmp_path):
+    path = tmp_path / "metrics.jsonl"
+    with metrics.span("detect", gateway="https://vpn.example.com"):
+        pass
+
+    metrics.write_json_lines(path)
+    with metrics.span("tunnel_up"):
+        pass
+    # Only what was recorded since is appended
+    metrics.write_json_lines(path)
+
+    lines = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [line["phase"] for line in lines] == ["detect", "tunnel_up"]
+    assert lines[0]["gateway"] == "https://vpn.example.com"
+    assert lines[0]["ok"] is True
+
+
+def test_write_prometheus_sums_repeated_phases(tmp_path):
+    path = tmp_path / "openconnect_sso.prom"
+    spans = [
+        metrics.Span("page_load", {"url": "https://idp/"}, duration=0.5),
+        metrics.Span("page_load", {"url": "https://idp/"}, duration=0.25),
+        metrics.Span("init", {"gateway": 'a"b'}, duration=1, error="HTTPError"),
+    ]
+
+    metrics.write_prometheus(path, spans)
+
+    content = path.read_text()
+    assert (
+        'openconnect_sso_phase_duration_seconds{phase="page_load",url="https://idp/"} 0.750000'
+        in content
+    )
+    assert 'openconnect_sso_phase_success{gateway="a\\"b",phase="init"} 0' in content
+    assert "openconnect_sso_last_run_timestamp_seconds" in content
+
+
+def test_gauges_are_exported(tmp_path):
+    metrics.gauge("browser_peak_rss_bytes", 100, display_mode="headless")
+    metrics.gauge("browser_peak_rss_bytes", 200, display_mode="headless")
+
+    metrics.write_json_lines(tmp_path / "metrics.jsonl")
+    metrics.write_prometheus(tmp_path / "openconnect_sso.prom")
+
+    lines = [
+        json.loads(line)
+        for line in (tmp_path / "metrics.jsonl").read_text().splitlines()
+    ]
+    assert [line["value"] for line in lines] == [100, 200]
+    assert lines[0]["metric"] == "browser_peak_rss_bytes"
+    content = (tmp_path / "openconnect_sso.prom").read_text()
+    assert (
+        'openconnect_sso_browser_peak_rss_bytes{display_mode="headless"} 200\n'
+        in content
+    )
+    assert "# TYPE openconnect_sso_browser_peak_rss_bytes gauge" in content
+
+
+def test_only_recent_measurements_are_kept():
+    for i in range(metrics.MAX_RECORDS + 10):
+        with metrics.span("init", attempt=i):
+            pass
+        metrics.gauge("browser_peak_rss_bytes", i)
+
+    assert len(metrics.spans()) == metrics.MAX_RECORDS
+    assert metrics.spans()[0].labels["attempt"] == 10
+    assert [g.value for g in metrics.gauges()][-1] == metrics.MAX_RECORDS + 9
+    assert len(metrics.gauges()) == metrics.MAX_RECORDS
@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+
+from openconnect_sso import probe
+from openconnect_sso.config import HostProfile
+
+
+@pytest.mark.asyncio
+async def test_probe_measures_gateway(gateway):
+    result = await probe.probe(HostProfile(gateway.url, "", "group"), "4.7.00136")
+
+    assert result.ok, result.error
+    assert result.status == 200
+    assert result.tcp_connect > 0
+    assert result.tls_handshake is None
+    assert result.auth_init > 0
+
+
+@pytest.mark.asyncio
+async def test_probe_reports_unreachable_gateway(unused_tcp_port):
+    url = f"http://127.0.0.1:{unused_tcp_port}/"
+
+    result = await probe.probe(HostProfile(url, "", "group"), "4.7.00136")
+
+    assert not result.ok
+    assert result.total == float("inf")
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("response", [b"", b"garbage\r\n", b"HTTP/1.1 OK\r\n\r\n"])
+async def test_probe_reports_malformed_response(response):
+    async def respond(reader, writer):
+        await reader.read(1)
+        writer.write(response)
+        writer.close()
+
+    server = await asyncio.start_server(respond, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    try:
+        result = await probe.probe(
+            HostProfile(f"http://127.0.0.1:{port}/", "", "group"), "4.7.00136"
+        )
+    finally:
+        server.close()
+
+    assert not result.ok
+    assert result.status is None
+
+
+@pytest.mark.asyncio
+async def test_gateways_are_ranked_and_cached(tmp_path, monkeypatch):
+    latencies = {"https://slow": 0.3, "https://fast": 0.1, "https://down": None}
+    probed = []
+
+    async def fake_probe(host, version, timeout):
+        probed.append(host.vpn_url)
+        latency = latencies[host.vpn_url]
+        if latency is None:
+            return probe.ProbeResult(host.vpn_url, error="unreachable")
+        return probe.ProbeResult(host.vpn_url, tcp_connect=latency, auth_init=latency)
+
+    monkeypatch.setattr(probe, "probe", fake_probe)
+    hosts = [HostProfile(url, "", url) for url in latencies]
+    cache_path = tmp_path / "probes.json"
+
+    ranked = await probe.probe_gateways(hosts, "", probe.ProbeCache(cache_path))
+
+    assert [h.vpn_url for h, _ in ranked] == [
+        "https://fast",
+        "https://slow",
+        "https://down",
+    ]
+
+    probed.clear()
+    ranked = await probe.probe_gateways(hosts, "", probe.ProbeCache(cache_path))
+
+    assert probed == ["https://down"]
+    assert ranked[0][1].total == pytest.approx(0.2)
+
+    probed.clear()
+    await probe.probe_gateways(hosts, "", probe.ProbeCache(cache_path, ttl=0))
+
+    assert sorted(probed) == sorted(latencies)
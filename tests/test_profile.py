@@ -0,0 +1,98 @@
+import os
+
+import pytest
+
+from openconnect_sso import profile
+from openconnect_sso.config import HostProfile
+
+PROFILE = """<?xml version="1.0" encoding="UTF-8"?>
+<AnyConnectProfile xmlns="http://schemas.xmlsoap.org/encoding/">
+    <ServerList>
+        {entries}
+    </ServerList>
+</AnyConnectProfile>
+"""
+
+HOST_ENTRY = """
+        <HostEntry>
+            <HostName>{name}</HostName>
+            <HostAddress>{name}.example.com</HostAddress>
+            <UserGroup>group</UserGroup>
+        </HostEntry>
+"""
+
+
+def write_profile(path, *names):
+    path.write_text(
+        PROFILE.format(entries="".join(HOST_ENTRY.format(name=n) for n in names))
+    )
+
+
+@pytest.fixture
+def parsed_files(monkeypatch):
+    parsed = []
+    parse = profile._get_profiles_from_one_file
+
+    def get_profiles_from_one_file(path):
+        parsed.append(path.name)
+        return parse(path)
+
+    monkeypatch.setattr(
+        profile, "_get_profiles_from_one_file", get_profiles_from_one_file
+    )
+    return parsed
+
+
+def test_profiles_are_parsed(tmp_path):
+    write_profile(tmp_path / "a.xml", "first", "second")
+    write_profile(tmp_path / "b.xml", "third")
+    index = profile.ProfileIndex(tmp_path / "index.json")
+
+    assert index.get_profiles(tmp_path) == [
+        HostProfile("first.example.com", "group", "first"),
+        HostProfile("second.example.com", "group", "second"),
+        HostProfile("third.example.com", "group", "third"),
+    ]
+
+
+def test_unchanged_files_are_not_parsed_again(tmp_path, parsed_files):
+    profile_dir = tmp_path / "profiles"
+    profile_dir.mkdir()
+    write_profile(profile_dir / "a.xml", "first")
+    write_profile(profile_dir / "b.xml", "second")
+    profile.ProfileIndex(tmp_path / "index.json").get_profiles(profile_dir)
+    parsed_files.clear()
+
+    profiles = profile.ProfileIndex(tmp_path / "index.json").get_profiles(profile_dir)
+
+    assert parsed_files == []
+    assert [p.name for p in profiles] == ["first", "second"]
+
+
+def test_changed_files_are_parsed_again(tmp_path, parsed_files):
+    profile_dir = tmp_path / "profiles"
+    profile_dir.mkdir()
+    write_profile(profile_dir / "a.xml", "first")
+    write_profile(profile_dir / "b.xml", "second")
+    index = profile.ProfileIndex(tmp_path / "index.json")
+    index.get_profiles(profile_dir)
+    parsed_files.clear()
+
+    write_profile(profile_dir / "b.xml", "changed")
+    stat = (profile_dir / "b.xml").stat()
+    os.utime(profile_dir / "b.xml", ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    (profile_dir / "a.xml").unlink()
+
+    profiles = index.get_profiles(profile_dir)
+
+    assert parsed_files == ["b.xml"]
+    assert [p.name for p in profiles] == ["changed"]
+
+
+def test_malformed_index_is_ignored(tmp_path):
+    write_profile(tmp_path / "a.xml", "first")
+    (tmp_path / "index.json").write_text("{garbage")
+
+    profiles = profile.ProfileIndex(tmp_path / "index.json").get_profiles(tmp_path)
+
+    assert [p.name for p in profiles] == ["first"]
@@ -0,0 +1,49 @@
+from openconnect_sso.browser.request_filter import RequestPolicy
+from openconnect_sso.config import Config, DisplayMode, RequestFilter
+
+
+def test_default_policy_blocks_assets_and_telemetry():
+    policy = RequestPolicy(RequestFilter())
+
+    assert policy.should_block("image", "aadcdn.msftauth.net")
+    assert policy.should_block("font", "aadcdn.msftauth.net")
+    assert policy.should_block("script", "www.googletagmanager.com")
+    assert not policy.should_block("script", "aadcdn.msftauth.net")
+    assert not policy.should_block("xhr", "login.microsoftonline.com")
+
+    assert policy.summary() == {
+        "blocked": 3,
+        "by_type": {"image": 1, "font": 1, "script": 1},
+        "by_host": {"aadcdn.msftauth.net": 2, "www.googletagmanager.com": 1},
+    }
+
+
+def test_main_frame_is_never_blocked():
+    policy = RequestPolicy(RequestFilter(block_domains=["idp.example.com"]))
+
+    assert not policy.should_block("main_frame", "idp.example.com")
+    assert policy.should_block("sub_frame", "idp.example.com")
+
+
+def test_allowed_domains_override_blocking():
+    policy = RequestPolicy(RequestFilter(allow_domains=["captcha.example.com"]))
+
+    assert not policy.should_block("image", "captcha.example.com")
+    assert not policy.should_block("image", "img.captcha.example.com")
+    assert policy.should_block("image", "example.com")
+
+
+def test_filter_is_enabled_in_hidden_mode_by_default():
+    request_filter = Config.from_dict({}).request_filter
+
+    assert request_filter.is_enabled(DisplayMode.HIDDEN)
+    assert request_filter.is_enabled(DisplayMode.HEADLESS)
+    assert not request_filter.is_enabled(DisplayMode.SHOWN)
+    assert RequestFilter(enabled="always").is_enabled(DisplayMode.SHOWN)
+    assert not RequestFilter(enabled="never").is_enabled(DisplayMode.HIDDEN)
+
+
+def test_filter_survives_config_roundtrip():
+    cfg = Config(request_filter={"enabled": "always", "allow_domains": ["a.com"]})
+
+    assert Config.from_dict(cfg.as_dict()).request_filter == cfg.request_filter
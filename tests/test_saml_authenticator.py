@@ -0,0 +1,124 @@
+import asyncio
+from urllib.parse import urlparse
+
+import attr
+import pytest
+from requests.cookies import RequestsCookieJar
+from werkzeug import Response
+
+from openconnect_sso.browser import Browser, ipc
+from openconnect_sso.saml_authenticator import (
+    authenticate_in_browser,
+    authenticate_with_http,
+)
+
+LOGIN_FORM = """<html><body><form method="post" action="/login">
+<input type="hidden" name="flow" value="1"><input type="email" name="login">
+</form></body></html>"""
+
+SAML_POST = """<html><body onload="document.forms[0].submit()">
+<form method="post" action="/acs"><input type="hidden" name="SAMLResponse" value="assertion">
+<noscript><input type="submit" value="Continue"></noscript></form></body></html>"""
+
+
+@attr.s
+class AuthInfo:
+    login_url = attr.ib()
+    login_final_url = attr.ib()
+    token_cookie_name = attr.ib(default="acSamlv2Token")
+
+
+@pytest.fixture
+def idp(httpserver):
+    """An identity provider which signs in without user input if it has a session"""
+
+    def login(request):
+        if request.cookies.get("idp-session") != "valid":
+            return Response(LOGIN_FORM, content_type="text/html")
+        return Response(SAML_POST, content_type="text/html")
+
+    def acs(request):
+        assert request.form["SAMLResponse"] == "assertion"
+        return Response(
+            status=302,
+            headers={
+                "Location": "/final",
+                "Set-Cookie": "acSamlv2Token=sso-token; Path=/",
+            },
+        )
+
+    httpserver.expect_request("/redirect").respond_with_data(
+        '<html><head><meta http-equiv="Refresh" content="0; url=/login"></head></html>',
+        content_type="text/html",
+    )
+    httpserver.expect_request("/login").respond_with_handler(login)
+    httpserver.expect_request("/acs", method="POST").respond_with_handler(acs)
+    httpserver.expect_request("/final").respond_with_data("")
+    return AuthInfo(httpserver.url_for("/redirect"), httpserver.url_for("/final"))
+
+
+def idp_cookies(value):
+    cookies = RequestsCookieJar()
+    cookies.set("idp-session", value)
+    return cookies
+
+
+@pytest.mark.asyncio
+async def test_login_is_replayed_with_idp_session(idp):
+    token = await authenticate_with_http(idp, cookies=idp_cookies("valid"))
+
+    assert token == "sso-token"
+
+
+@pytest.mark.asyncio
+async def test_interactive_page_falls_back_to_browser(idp):
+    token = await authenticate_with_http(idp, cookies=idp_cookies("expired"))
+
+    assert token is None
+
+
+@pytest.mark.asyncio
+async def test_stored_token_cookie_is_not_taken_for_a_new_one(idp):
+    cookies = idp_cookies("expired")
+    cookies.set(
+        "acSamlv2Token", "stale-token", domain=urlparse(idp.login_final_url).hostname
+    )
+
+    token = await authenticate_with_http(idp, cookies=cookies)
+
+    assert token is None
+
+
+class TokenBeforeFinalPageBrowser(Browser):
+    """Sets the token cookie but never finishes loading the final page"""
+
+    def __init__(self):
+        super().__init__()
+        self.running = True
+        self.startup_info = None
+
+    async def authenticate_at(
+        self, url, credentials, page=0, token_cookie=None, identity=None
+    ):
+        self.startup_info = (url, page, token_cookie)
+        self._queue(page).put_nowait(url)
+        self.loop.call_soon(
+            self._set_cookie, ipc.SetCookie("acSamlv2Token", "sso-token", "vpn.com")
+        )
+
+
+@pytest.mark.asyncio
+async def test_browser_login_finishes_when_token_cookie_is_set():
+    browser = TokenBeforeFinalPageBrowser()
+    auth_info = AuthInfo("https://idp.com/login", "https://vpn.com/final")
+
+    token = await asyncio.wait_for(
+        authenticate_in_browser(browser, auth_info, None, page=1), 1
+    )
+
+    assert token == "sso-token"
+    assert browser.startup_info == (
+        "https://idp.com/login",
+        1,
+        ("acSamlv2Token", "https://vpn.com/final"),
+    )
@@ -0,0 +1,106 @@
+import signal
+
+import pytest
+
+from openconnect_sso import supervisor
+from openconnect_sso.authenticator import AuthenticationError
+from openconnect_sso.supervisor import Backoff, ExitReason, classify_exit
+
+
+@pytest.mark.parametrize(
+    ("returncode", "reason"),
+    [
+        (0, ExitReason.USER),
+        (1, ExitReason.DISCONNECTED),
+        (2, ExitReason.REJECTED),
+        (20, ExitReason.FATAL),
+        (-signal.SIGTERM, ExitReason.USER),
+        (-signal.SIGKILL, ExitReason.DISCONNECTED),
+    ],
+)
+def test_exit_is_classified(returncode, reason):
+    assert classify_exit(returncode) is reason
+
+
+def test_backoff_is_exponential_up_to_maximum():
+    backoff = Backoff(initial=1, maximum=5)
+    assert [backoff.delay(n) for n in range(5)] == [1, 2, 4, 5, 5]
+
+
+class Session:
+    """Runs fake openconnect processes, each lasting `durations` seconds"""
+
+    def __init__(self, returncodes, durations=None, logins=None):
+        self.returncodes = list(returncodes)
+        self.durations = list(durations or [0] * len(self.returncodes))
+        self.logins = list(logins or [])
+        self.now = 0
+        self.tokens = []
+        self.delays = []
+
+    def connect(self, auth_response):
+        self.tokens.append(auth_response)
+        self.now += self.durations.pop(0)
+        return self.returncodes.pop(0)
+
+    def authenticate(self):
+        login = self.logins.pop(0)
+        if isinstance(login, Exception):
+            raise login
+        return login
+
+    def sleep(self, delay):
+        self.delays.append(delay)
+        self.now += delay
+
+    def supervise(self, **kwargs):
+        return supervisor.supervise(
+            "token",
+            self.connect,
+            self.authenticate,
+            sleep=self.sleep,
+            clock=lambda: self.now,
+            **kwargs,
+        )
+
+
+def test_token_is_reused_until_rejected():
+    session = Session([1, 2, 0], logins=["new-token"])
+
+    returncode, outages = session.supervise()
+
+    assert returncode == 0
+    assert session.tokens == ["token", "token", "new-token"]
+    assert [o.reason for o in outages] == [
+        ExitReason.DISCONNECTED,
+        ExitReason.REJECTED,
+    ]
+    assert [o.duration for o in outages] == [1, 2]
+
+
+def test_backoff_is_reset_by_stable_connection():
+    session = Session([1, 1, 1, 0], durations=[0, 0, 3600, 0])
+
+    session.supervise()
+
+    assert session.delays == [1, 2, 1]
+
+
+def test_failed_login_is_retried():
+    session = Session([2, 0], logins=[AuthenticationError(), "new-token"])
+
+    returncode, _ = session.supervise()
+
+    assert returncode == 0
+    assert session.tokens == ["token", "new-token"]
+    assert session.delays == [1, 2]
+
+
+def test_gives_up_after_repeated_failures():
+    session = Session([1] * 4)
+
+    returncode, outages = session.supervise(max_failures=3)
+
+    assert returncode == 1
+    assert len(session.tokens) == 4
+    assert len(outages) == 3
@@ -0,0 +1,97 @@
+import time
+
+import attr
+import keyring.errors
+import pytest
+
+from openconnect_sso import token_cache
+
+
+class MemoryKeyring:
+    def __init__(self):
+        self.passwords = {}
+
+    def get_password(self, service, key):
+        return self.passwords.get((service, key))
+
+    def set_password(self, service, key, value):
+        self.passwords[(service, key)] = value
+
+    def delete_password(self, service, key):
+        try:
+            del self.passwords[(service, key)]
+        except KeyError:
+            raise keyring.errors.PasswordDeleteError(key)
+
+
+@pytest.fixture
+def memory_keyring(monkeypatch):
+    kr = MemoryKeyring()
+    monkeypatch.setattr(token_cache.keyring, "get_password", kr.get_password)
+    monkeypatch.setattr(token_cache.keyring, "set_password", kr.set_password)
+    monkeypatch.setattr(token_cache.keyring, "delete_password", kr.delete_password)
+    return kr
+
+
+@attr.s
+class AuthResponse:
+    session_token = attr.ib(default="token")
+    server_cert_hash = attr.ib(default="pin-sha256:hash")
+
+
+def auth_response():
+    return AuthResponse()
+
+
+def test_stored_session_is_returned(memory_keyring):
+    token_cache.store(
+        "https://vpn", "user", "https://vpn/group", auth_response(), lifetime=60
+    )
+
+    session = token_cache.load("https://vpn", "user")
+
+    assert session.host == "https://vpn/group"
+    assert session.session_token == "token"
+    assert session.server_cert_hash == "pin-sha256:hash"
+
+
+def test_sessions_are_keyed_by_host_and_user(memory_keyring):
+    token_cache.store("https://vpn", "user", "https://vpn", auth_response())
+
+    assert token_cache.load("https://vpn", "other") is None
+    assert token_cache.load("https://other", "user") is None
+    assert token_cache.load("https://vpn", "user", "service") is None
+
+
+def test_sessions_of_identities_are_kept_apart(memory_keyring):
+    token_cache.store("https://vpn", "user", "https://vpn", auth_response())
+    token_cache.store(
+        "https://vpn", "user", "https://vpn/s", auth_response(), identity="service"
+    )
+
+    assert token_cache.load("https://vpn", "user").host == "https://vpn"
+    assert token_cache.load("https://vpn", "user", "service").host == "https://vpn/s"
+    token_cache.invalidate("https://vpn", "user", "service")
+    assert token_cache.load("https://vpn", "user") is not None
+
+
+def test_expired_session_is_dropped(memory_keyring, monkeypatch):
+    token_cache.store("https://vpn", None, "https://vpn", auth_response(), lifetime=1)
+    now = time.time()
+    monkeypatch.setattr(token_cache.time, "time", lambda: now + 2)
+
+    assert token_cache.load("https://vpn", None) is None
+    assert memory_keyring.passwords == {}
+
+
+def test_malformed_session_is_dropped(memory_keyring):
+    memory_keyring.set_password(
+        token_cache.APP_NAME, "session/https://vpn/", "{garbage"
+    )
+
+    assert token_cache.load("https://vpn", None) is None
+    assert memory_keyring.passwords == {}
+
+
+def test_invalidate_missing_session_is_noop(memory_keyring):
+    token_cache.invalidate("https://vpn", "user")
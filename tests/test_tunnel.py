@@ -0,0 +1,121 @@
+import sys
+import textwrap
+
+import pytest
+
+from openconnect_sso import metrics, tunnel
+
+OUTPUT = """\
+POST https://vpn.example.com/
+Connected to 192.0.2.1:443
+SSL negotiation with vpn.example.com
+Connected to HTTPS on vpn.example.com with ciphersuite (TLS1.3)-(ECDHE-SECP256R1)-(RSA-PSS-RSAE-SHA256)-(AES-256-GCM)
+Got CONNECT response: HTTP/1.1 200 OK
+CSTP connected. DPD 30, Keepalive 20
+Connected as 10.0.0.2, using SSL + LZ4, with DTLS in progress
+Established DTLS connection (using GnuTLS). Ciphersuite (DTLS1.2)-(ECDHE-RSA)-(AES-256-GCM).
+CSTP rekey due
+Received server disconnect: 0b 'Session expired'
+Session terminated by server; exiting.
+"""
+
+
+def test_milestones_are_parsed():
+    events = [tunnel.parse_line(line) for line in OUTPUT.splitlines()]
+
+    assert [(e.name, e.fields) for e in events if e] == [
+        ("https_connected", {"host": "vpn.example.com"}),
+        ("cstp_connected", {"dpd": "30", "keepalive": "20"}),
+        (
+            "address_assigned",
+            {"address": "10.0.0.2", "via": "SSL + LZ4, with DTLS in progress"},
+        ),
+        (
+            "dtls_established",
+            {"library": "GnuTLS", "cipher": "(DTLS1.2)-(ECDHE-RSA)-(AES-256-GCM)"},
+        ),
+        ("rekey", {"channel": "CSTP"}),
+        ("server_disconnect", {"reason": "Session expired"}),
+        ("exiting", {"reason": "Session terminated by server"}),
+    ]
+
+
+def test_tls_only_session_is_reported():
+    metrics.reset()
+    state = tunnel.TunnelState("https://vpn.example.com/")
+    state.feed("CSTP connected. DPD 30, Keepalive 20\n")
+    state.feed("DTLS handshake failed: Resource temporarily unavailable\n")
+    state.feed("User cancelled (SIGINT); exiting.\n")
+    state.close(0)
+
+    spans = {s.phase: s for s in metrics.spans()}
+    assert spans["tunnel_up"].ok
+    assert not spans["dtls_up"].ok
+    assert not state.dtls_up
+    assert state.disconnect_reason == "User cancelled (SIGINT)"
+
+
+@pytest.mark.asyncio
+async def test_output_is_streamed_to_state_and_log(tmp_path):
+    script = textwrap.dedent(
+        f"""
+        import sys
+        assert sys.stdin.read() == "session-token"
+        sys.stderr.write({OUTPUT!r})
+        sys.exit(1)
+        """
+    )
+    events = []
+    state = tunnel.TunnelState("https://vpn.example.com/", on_event=events.append)
+
+    with tunnel.OutputLog(tmp_path / "openconnect.log") as output_log:
+        returncode = await tunnel.run(
+            [sys.executable, "-c", script],
+            b"session-token",
+            state,
+            output_log,
+            echo=False,
+        )
+
+    assert returncode == 1
+    assert [e.name for e in events][-2:] == ["server_disconnect", "exiting"]
+    assert all(e.elapsed is not None for e in events)
+    assert state.dtls_up
+    assert "CSTP connected" in (tmp_path / "openconnect.log").read_text()
+
+
+class FedLines(list):
+    feed = list.append
+
+    def close(self, returncode):
+        pass
+
+
+@pytest.mark.asyncio
+async def test_output_is_echoed_to_the_same_stream(capfd):
+    # Longer than the buffer limit of `StreamReader.readline`
+    length = 200000
+    script = textwrap.dedent(
+        f"""
+        import sys
+        sys.stdout.write("POST https://vpn.example.com/\\n")
+        sys.stdout.write("x" * {length} + "\\nno newline")
+        sys.stderr.write("Failed to connect\\n")
+        """
+    )
+    lines = FedLines()
+
+    returncode = await tunnel.run([sys.executable, "-c", script], b"", lines)
+
+    assert returncode == 0
+    out, err = capfd.readouterr()
+    assert out == f"POST https://vpn.example.com/\n{'x' * length}\nno newline"
+    assert err == "Failed to connect\n"
+    assert sorted(lines) == sorted(
+        [
+            "POST https://vpn.example.com/\n",
+            "x" * length + "\n",
+            "no newline",
+            "Failed to connect\n",
+        ]
+    )